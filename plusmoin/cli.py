@@ -52,8 +52,12 @@ def run_start(logger, no_daemon):
                 logger.error(traceback.format_exc())
 
 
-def run_stop(logger):
-    """ Stop plusmoin """
+def read_pid():
+    """ Return the pid of the running daemon, or exit if there is none
+
+    Returns:
+        int: The pid of the running daemon
+    """
     # Look for pid file
     if not os.path.exists(config['pid_file']):
         sys.stderr.write(
@@ -83,6 +87,12 @@ def run_stop(logger):
             )
         )
         sys.exit(1)
+    return pid
+
+
+def run_stop(logger):
+    """ Stop plusmoin """
+    pid = read_pid()
 
     # SIGTERM and wait.
     try:
@@ -109,9 +119,21 @@ def run_stop(logger):
 
 
 def run_reload(logger):
-    """ Reload plusmoin """
-    sys.stderr.write("Not implemented\n")
-    exit(1)
+    """ Reload plusmoin
+
+    The daemon reads its configuration file again when it receives SIGHUP.
+    """
+    pid = read_pid()
+    try:
+        print "Sending SIGHUP to {}...".format(pid)
+        os.kill(pid, signal.SIGHUP)
+    except OSError:
+        sys.stderr.write(
+            'Error attempting to reload process {}'.format(pid)
+        )
+        sys.exit(1)
+    print "Done!"
+    sys.exit(0)
 
 
 def run_status(logger):
@@ -163,6 +185,12 @@ def run(argv=None):
     # Dispatch
     if command == 'start':
         run_start(logger, no_daemon)
+    elif command == 'stop':
+        run_stop(logger)
+    elif command == 'reload':
+        run_reload(logger)
+    elif command == 'status':
+        run_status(logger)
 
 if __name__ == '__main__':
     run()
\ No newline at end of file
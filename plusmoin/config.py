@@ -1,22 +1,60 @@
 import json
+import os
+
 import jsmin
 
 config = {}
+_config_file = None
 
 _defaults = {
     'heartbeat': 60,
+    'heartbeat_overrun': 'skip',
+    'heartbeat_precision': 'seconds',
+    'heartbeat_writer_interval': None,
+    'heartbeat_trigger_on_change': False,
+    'heartbeat_trigger_keepalive': 0,
     'max_sync_delay': 120,
     'min_sync_delay': 60,
     'connect_timeout': 60,
+    'probe_concurrency': 10,
+    'startup_poll_interval': 1,
+    'probe_timeout': 60,
+    'engine': 'threads',
     'is_slave_statement': 'SELECT pg_is_in_recovery()',
+    'wal_lag': False,
+    'wal_lsn_statement': None,
+    'discovery': False,
+    'discovery_statement': (
+        'SELECT host(client_addr), application_name FROM pg_stat_replication'
+    ),
+    'discovery_port': 5432,
+    'discovery_forget_after': None,
+    'max_sync_bytes': None,
+    'recover_sync_bytes': None,
     'nodes': [],
     'log_level': 'error',
     'log_file': '/var/log/plusmoin/plusmoin.log',
     'pid_file': '/var/run/plusmoin/plusmoin.pid',
     'status_file': '/var/run/plusmoin/status.json',
+    'status_etag_file': False,
+    'state_file': None,
+    'event_log': None,
+    'event_log_max_size': 10485760,
+    'event_log_max_age': 0,
+    'event_log_backups': 5,
+    'event_log_fsync_interval': 0,
+    'http_address': '127.0.0.1',
+    'http_port': None,
+    'http_max_wait': 60,
+    'agent_check_address': '127.0.0.1',
+    'agent_check_port': None,
     'user': 'nobody',
     'triggers': {},
-    'trigger_timeout': 60
+    'persistent_triggers': [],
+    'trigger_plugins': {},
+    'plugin_concurrency': 4,
+    'trigger_timeout': 60,
+    'trigger_concurrency': 4
 }
 
 _required = ['dbname', 'user', 'password']
@@ -35,7 +73,7 @@ def read_config(file_name):
     @param file_name: File name to JSON configuration file
     @raises: ConfigRequired
     """
-    global config
+    global config, _config_file
     with open(file_name) as f:
         json_config = json.loads(jsmin.jsmin(f.read()))
     for key in _defaults:
@@ -45,4 +83,17 @@ def read_config(file_name):
         if key not in json_config:
             raise ConfigRequired(key)
     for key in json_config:
-        config[key] = json_config[key]
\ No newline at end of file
+        config[key] = json_config[key]
+    # The daemon changes its working directory, so keep an absolute path
+    _config_file = os.path.abspath(file_name)
+
+
+def reload_config():
+    """Read the configuration file last given to read_config again
+
+    The running configuration is only changed if the file could be read and
+    has all the required items.
+
+    @raises: IOError, ValueError, ConfigRequired
+    """
+    read_config(_config_file)
\ No newline at end of file
@@ -1,5 +1,5 @@
-import time
 from plusmoin.lib import db
+from plusmoin.lib.probe import probe_node, write_heartbeats
 
 
 class Cluster(object):
@@ -19,21 +19,47 @@ class Cluster(object):
         recover_sync_delay (ind): Maximum sync delay between master and slave
             for a node to come back up.
         master (Node, optional): The master node. Defaults to None.
+        max_sync_bytes (int, optional): Maximum replay lag between master and
+            slave, in bytes, when WAL positions are fetched. Defaults to None
+            (no limit)
+        recover_sync_bytes (int, optional): Maximum replay lag between master
+            and slave, in bytes, for a node to come back up. Defaults to None
+            (no limit)
+        external_heartbeat (bool, optional): If True, the heartbeat of the
+            current master is written by a HeartbeatWriter, and updating the
+            cluster only checks that it is recent. Nodes that become master
+            still get a heartbeat written straight away. Defaults to False
     """
     def __init__(self, cluster_id, max_sync_delay,
-                 recover_sync_delay, master=None):
+                 recover_sync_delay, master=None, max_sync_bytes=None,
+                 recover_sync_bytes=None, external_heartbeat=False):
         self.cluster_id = cluster_id
         self.master = master
         self.timestamp = 0
         self.max_sync_delay = max_sync_delay
         self.recover_sync_delay = recover_sync_delay
+        self.max_sync_bytes = max_sync_bytes
+        self.recover_sync_bytes = recover_sync_bytes
+        self.external_heartbeat = external_heartbeat
         self.slaves = []
         self.lost = []
         self._dict = None
 
-    def update_cluster(self):
+    def update_cluster(self, probes=None, timeout=None, heartbeats=None):
         """Update the cluster's node and their status.
 
+        Args:
+            probes (dict, optional): Dictionary of Node to ProbeResult, as
+                returned by plusmoin.lib.probe.probe_nodes. Nodes that have
+                a result in there are not probed again. Defaults to None.
+            timeout (float, optional): Maximum time, in seconds, writing the
+                master's heartbeat may take before the master is considered
+                lost. Defaults to None (no limit).
+            heartbeats (dict, optional): Dictionary of Node to DbError or
+                None, as returned by plusmoin.lib.probe.write_heartbeats.
+                Masters that have an entry in there do not get their
+                heartbeat written again. Defaults to None.
+
         Returns:
             dict: A dictionary defining: {
                     'master_down': False or <Node> if the master went down,
@@ -44,7 +70,7 @@ class Cluster(object):
                            anymore]
                 }
         """
-        new_timestamp = int(time.time())
+        new_timestamp = db.heartbeat_timestamp()
         new_slaves = []
         new_lost = []
         status = {
@@ -56,10 +82,16 @@ class Cluster(object):
         }
         # Update the master
         if self.has_master:
-            self.timestamp = self.master.timestamp
+            if probes is not None and self.master in probes:
+                # An external heartbeat may have moved on since the slaves
+                # were probed; compare them with the master as it was then.
+                self.timestamp = probes[self.master].previous_timestamp
+            else:
+                self.timestamp = self.master.timestamp
             master_update = self._update_nodes(
                 new_timestamp,
-                self.max_sync_delay, [self.master]
+                self.max_sync_delay, [self.master], probes,
+                self.max_sync_bytes, timeout, heartbeats
             )
             if master_update['master'] is None:
                 status['master_down'] = self.master
@@ -71,7 +103,8 @@ class Cluster(object):
         # Update the slaves
         slave_update = self._update_nodes(
             new_timestamp,
-            self.max_sync_delay, self.slaves
+            self.max_sync_delay, self.slaves, probes, self.max_sync_bytes,
+            timeout
         )
         if slave_update['master'] is not None:
             status['master_down'] = False
@@ -86,7 +119,8 @@ class Cluster(object):
         # Update the lost nodes
         lost_update = self._update_nodes(
             new_timestamp,
-            self.recover_sync_delay, self.lost
+            self.recover_sync_delay, self.lost, probes,
+            self.recover_sync_bytes, timeout
         )
         if lost_update['master'] is not None:
             status['master_down'] = False
@@ -103,13 +137,23 @@ class Cluster(object):
 
         return status
 
-    def _update_nodes(self, new_timestamp, delay, nodes):
+    def _update_nodes(self, new_timestamp, delay, nodes, probes=None,
+                      byte_delay=None, timeout=None, heartbeats=None):
         """Perform an update on a list of nodes and sort them into categories.
 
         Args:
             new_timestamp (int): The current iteration's timestamp
             delay (int): Acceptable delay to bring a node up or down
             nodes (list of Node): Nodes to perform an update on
+            probes (dict, optional): Dictionary of Node to ProbeResult for
+                nodes that have already been probed. Defaults to None.
+            byte_delay (int, optional): Acceptable replay lag, in bytes, to
+                bring a node up or down. Only applies to nodes for which the
+                lag is known. Defaults to None (no limit).
+            timeout (float, optional): Maximum time, in seconds, writing a
+                master's heartbeat may take. Defaults to None (no limit).
+            heartbeats (dict, optional): Dictionary of Node to the outcome of
+                heartbeat writes already made. Defaults to None.
 
         Returns:
             dict: A dictionary including the nodes from the provided list,
@@ -121,13 +165,21 @@ class Cluster(object):
                     'out':    Nodes that do not belong here
                 }
         """
+        if heartbeats is None:
+            heartbeats = {}
         new_master = None
         new_slaves = []
         new_lost = []
         new_out = []
         for node in nodes:
             try:
-                node.refresh_role()
+                if probes is not None and node in probes:
+                    probe = probes[node]
+                else:
+                    probe = probe_node(node)
+                if probe.error is not None:
+                    raise probe.error
+                prev_ts = probe.previous_timestamp
                 if not node.is_slave:
                     if ((self.has_master and self.master != node)
                             or new_master is not None):
@@ -136,13 +188,31 @@ class Cluster(object):
                     else:
                         try:
                             # We have a master!
-                            node.update_heartbeat(new_timestamp)
+                            if (self.external_heartbeat
+                                    and self.master == node):
+                                # Written by the heartbeat writer; make sure
+                                # it is still moving.
+                                if new_timestamp - node.timestamp > delay:
+                                    raise db.DbError()
+                            elif node in heartbeats:
+                                # Written along with the other masters
+                                if heartbeats[node] is not None:
+                                    raise heartbeats[node]
+                            else:
+                                error = write_heartbeats(
+                                    [node], new_timestamp, timeout
+                                )[node]
+                                if error is not None:
+                                    raise error
                             new_master = node
                         except db.DbError:
                             new_lost.append(node)
                 elif self.has_master:
-                    node.refresh_info()
-                    if self.timestamp - node.timestamp > delay:
+                    self._update_lag(node)
+                    if (self.timestamp - node.timestamp > delay
+                            or (byte_delay is not None
+                                and node.replay_lag_bytes is not None
+                                and node.replay_lag_bytes > byte_delay)):
                         # Node is out of sync
                         new_lost.append(node)
                     elif node.cluster_id != self.cluster_id:
@@ -154,8 +224,6 @@ class Cluster(object):
                 else:
                     # We don't have a master - so we can't tell much, but if the
                     # node updates it might belong to somewhere else!
-                    prev_ts = node.timestamp
-                    node.refresh_info()
                     if node.timestamp != prev_ts and node.cluster_id != self.cluster_id:
                         new_out.append(node)
                     else:
@@ -170,6 +238,23 @@ class Cluster(object):
             'out': new_out
         }
 
+    def _update_lag(self, node):
+        """Compute how far a slave's WAL positions are behind the master's
+
+        Args:
+            node (Node): The slave node
+        """
+        master_position = self.master.wal_position
+        if master_position is None or node.wal_position is None:
+            node.replay_lag_bytes = None
+        else:
+            node.replay_lag_bytes = max(master_position - node.wal_position, 0)
+        if master_position is None or node.wal_received is None:
+            node.receive_lag_bytes = None
+        else:
+            node.receive_lag_bytes = max(master_position - node.wal_received,
+                                         0)
+
     def add_node(self, node):
         """Adds a node to the cluster
 
@@ -1,8 +1,20 @@
 import logging
+import re
 import psycopg2
+import psycopg2.errorcodes
+import threading
+import time
 import traceback
 from contextlib import contextmanager
 from plusmoin.config import config
+from plusmoin.lib import metrics
+
+# Heartbeat table timestamps from this value upwards are in milliseconds
+# rather than seconds (in seconds, it would be over 3000 years from now).
+MILLISECONDS_THRESHOLD = 10 ** 11
+
+# Application names of replicas that give their own address
+REPLICA_NAME = re.compile(r'^(.+):(\d+)$')
 
 
 class DbError(Exception):
@@ -15,19 +27,166 @@ class DbError(Exception):
     pass
 
 
-@contextmanager
-def get_connection(host, port):
-    """Create and yield a new database connection to the given host/port
+class NoHeartbeatError(DbError):
+    """Exception raised when a slave has no heartbeat information.
+
+    The node answered, so its role is known, but it has not (yet) replicated
+    a heartbeat from its master.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """Keeps one long lived database connection per node
+
+    Connections are created on first use, and checked before each re-use. A
+    connection that is found to be broken (either before use, or because an
+    error happened while it was in use) is discarded, and a new one will be
+    created on the next request.
+
+    Connections are opened in autocommit mode, so that read-only statements
+    do not leave sessions idle in transaction between two heartbeats.
+    """
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self, host, port):
+        """Yield a healthy connection to the given host/port
+
+        Args:
+            host (str): Hostname of the server
+            port (int): Port of the server
+
+        Yields:
+            psycopg2.connection: The database connection
+
+        Raises:
+            DbError: On any error (timeout, credentials, etc.)
+        """
+        key = (host, port)
+        with self._lock:
+            connection = self._connections.pop(key, None)
+        if connection is not None and not self._is_healthy(connection):
+            self._close(connection)
+            connection = None
+        if connection is None:
+            connection = self._connect(host, port)
+        try:
+            yield connection
+        except Exception:
+            if not self._is_healthy(connection):
+                self._close(connection)
+                connection = None
+            raise
+        finally:
+            if connection is not None:
+                with self._lock:
+                    # A probe that outlived its deadline may hand its
+                    # connection back after a new one was created.
+                    extra = self._connections.pop(key, None)
+                    self._connections[key] = connection
+                if extra is not None:
+                    self._close(extra)
+
+    def close(self, host, port):
+        """Close the pooled connection to the given host/port, if any
+
+        Args:
+            host (str): Hostname of the server
+            port (int): Port of the server
+        """
+        with self._lock:
+            connection = self._connections.pop((host, port), None)
+        if connection is not None:
+            self._close(connection)
+
+    def close_all(self):
+        """Close all pooled connections"""
+        with self._lock:
+            connections = self._connections.values()
+            self._connections = {}
+        for connection in connections:
+            self._close(connection)
+
+    def _connect(self, host, port):
+        """Create a new database connection to the given host/port
+
+        Args:
+            host (str): Hostname of the server
+            port (int): Port of the server
+
+        Returns:
+            psycopg2.connection: The database connection
+
+        Raises:
+            DbError: On any error (timeout, credentials, etc.)
+        """
+        try:
+            with metrics.connect_seconds.time(node='{}:{}'.format(host, port)):
+                connection = psycopg2.connect(**connection_details(host, port))
+            connection.autocommit = True
+        except psycopg2.Error as e:
+            # Can be no server, wrong credentials, timeout, etc.
+            logger = logging.getLogger()
+            logger.error("Could not connect to {}:{}: {}".format(
+                host, port, traceback.format_exc()
+            ))
+            raise DbError()
+        return connection
+
+    def _is_healthy(self, connection):
+        """Check whether a connection can be re-used
+
+        This does not send a query to the server; instead it consumes any
+        pending input on the socket, which is enough to detect connections
+        that were terminated by the server (restart, admin shutdown, etc.)
+
+        Args:
+            connection (psycopg2.connection): The connection to check
+
+        Returns:
+            bool: True if the connection can be re-used
+        """
+        if connection.closed:
+            return False
+        try:
+            connection.poll()
+        except psycopg2.Error:
+            return False
+        status = connection.get_transaction_status()
+        return status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def _close(self, connection):
+        """Close a connection, ignoring errors
+
+        Args:
+            connection (psycopg2.connection): The connection to close
+        """
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+pool = ConnectionPool()
+
+
+def connection_details(host, port):
+    """Return the connection parameters for the given host/port
+
+    When a probe_timeout is configured, the parameters make sure that no
+    single operation can block for longer than that: the connection timeout
+    is capped, a statement_timeout is set on the session, and TCP keepalives
+    (and, with libpq 12 or later, a TCP user timeout) detect dead peers.
 
     Args:
         host (str): Hostname of the server
         port (int): Port of the server
 
-    Yields:
-        psycopg2.connection: The database connection
-
-    Raises:
-        DbError: On any error (timeout, credentials, etc.)
+    Returns:
+        dict: Keyword arguments for psycopg2.connect
     """
     details = {
         'host': host,
@@ -37,19 +196,37 @@ def get_connection(host, port):
         'dbname': config['dbname'],
         'connect_timeout': config['connect_timeout']
     }
-    try:
-        connection = psycopg2.connect(**details)
-    except psycopg2.Error as e:
-        # Can be no server, wrong credentials, timeout, etc.
-        logger = logging.getLogger()
-        logger.error("Could not connect to {}:{}: {}".format(
-            host, port, traceback.format_exc()
-        ))
-        raise DbError()
-    try:
-        yield connection
-    finally:
-        connection.close()
+    timeout = config.get('probe_timeout')
+    if timeout:
+        details['connect_timeout'] = max(
+            1, int(min(config['connect_timeout'], timeout))
+        )
+        details['options'] = '-c statement_timeout={}'.format(
+            int(timeout * 1000)
+        )
+        details['keepalives'] = 1
+        details['keepalives_idle'] = max(1, int(timeout / 3))
+        details['keepalives_interval'] = max(1, int(timeout / 9))
+        details['keepalives_count'] = 3
+        if getattr(psycopg2, '__libpq_version__', 0) >= 120000:
+            details['tcp_user_timeout'] = int(timeout * 1000)
+    return details
+
+
+def get_connection(host, port):
+    """Return a context manager yielding a pooled connection to host/port
+
+    Args:
+        host (str): Hostname of the server
+        port (int): Port of the server
+
+    Returns:
+        A context manager yielding a psycopg2.connection
+
+    Raises:
+        DbError: On any error (timeout, credentials, etc.)
+    """
+    return pool.connection(host, port)
 
 
 def is_slave(connection):
@@ -97,13 +274,235 @@ def get_info(connection):
             value = cursor.fetchone()
             if not value or len(value) != 3:
                 raise DbError()
-            return value[0], value[1], value[2]
+            return value[0], value[1], decode_timestamp(value[2])
     except psycopg2.Error as e:
         logger = logging.getLogger()
         logger.error("Could not get node info: {}".format(e.pgerror))
         raise DbError()
 
 
+def wal_lsn_statement(server_version):
+    """Return the statement fetching the WAL positions of a node
+
+    The configured `wal_lsn_statement` is used if there is one. Otherwise the
+    functions are chosen by server version, as PostgreSQL 10 renamed them.
+
+    Args:
+        server_version (int): The node's version, as given by psycopg2 (eg.
+            90605 or 100001)
+
+    Returns:
+        str: Statement returning a single row of (current, received,
+            replayed) WAL positions, as text
+    """
+    if config.get('wal_lsn_statement'):
+        return config['wal_lsn_statement']
+    if server_version >= 100000:
+        functions = ('pg_current_wal_lsn', 'pg_last_wal_receive_lsn',
+                     'pg_last_wal_replay_lsn')
+    else:
+        functions = ('pg_current_xlog_location',
+                     'pg_last_xlog_receive_location',
+                     'pg_last_xlog_replay_location')
+    return (
+        'SELECT CASE WHEN pg_is_in_recovery() THEN NULL'
+        ' ELSE {}()::text END, {}()::text, {}()::text'
+    ).format(*functions)
+
+
+def probe_statement(server_version):
+    """Return the statement used to probe a node
+
+    Args:
+        server_version (int): The node's version, as given by psycopg2
+
+    Returns:
+        str: Statement returning a single row of (is slave, cluster id,
+            master name, timestamp), followed by the node's WAL positions
+            (current, received, replayed) when `wal_lag` is enabled, and by
+            the addresses and application names of its replicas (as two
+            arrays) when `discovery` is enabled.
+    """
+    columns = ['s.is_slave', 'h.cluster_id', 'h.master', 'h.tstamp']
+    joins = []
+    if config.get('wal_lag'):
+        columns += ['w.current', 'w.received', 'w.replayed']
+        joins.append(
+            'CROSS JOIN ({}) AS w(current, received, replayed)'.format(
+                wal_lsn_statement(server_version)
+            )
+        )
+    if config.get('discovery'):
+        columns += ['r.addresses', 'r.names']
+        joins.append(
+            'CROSS JOIN (SELECT array_agg(d.address), array_agg(d.name)'
+            ' FROM ({}) AS d(address, name)) AS r(addresses, names)'.format(
+                config['discovery_statement']
+            )
+        )
+    return """
+        SELECT {}
+          FROM ({}) AS s(is_slave)
+          {}
+          LEFT JOIN heartbeat AS h ON TRUE
+    """.format(', '.join(columns), config['is_slave_statement'],
+               ' '.join(joins))
+
+
+def probe_values(row):
+    """Return the probe values from a row returned by the probe statement
+
+    Args:
+        row (tuple): The row
+
+    Returns:
+        Tuple containing (is slave, cluster id, master name, timestamp).
+        When `wal_lag` or `discovery` is enabled, a fifth entry holds the
+        node's WAL positions as a tuple of (current, received, replayed) in
+        bytes, each of which may be None (or None if `wal_lag` is disabled).
+        When `discovery` is enabled, a sixth entry holds the addresses of
+        the node's replicas, as returned by replica_addresses.
+
+    Raises:
+        DbError: If the row is not valid
+    """
+    wal_lag = config.get('wal_lag')
+    discovery = config.get('discovery')
+    columns = 4 + (3 if wal_lag else 0) + (2 if discovery else 0)
+    if row is None or len(row) != columns:
+        raise DbError()
+    values = tuple(row[:3]) + (decode_timestamp(row[3]),)
+    wal = None
+    if wal_lag:
+        try:
+            wal = tuple(parse_lsn(lsn) for lsn in row[4:7])
+        except (ValueError, AttributeError):
+            raise DbError()
+    if discovery:
+        values += (wal, replica_addresses(row[-2], row[-1]))
+    elif wal_lag:
+        values += (wal,)
+    return values
+
+
+def replica_addresses(addresses, names):
+    """Return the addresses of a node's replicas
+
+    A replica whose application name is of the form '<host>:<port>' is
+    found at that address. Others are found at their client address, on
+    `discovery_port`; replicas with neither (as when the client address is
+    not visible to plusmoin's user) are left out.
+
+    Args:
+        addresses (list of str): The client addresses of the replicas, or
+            None if there are none
+        names (list of str): The application names of the replicas, or None
+
+    Returns:
+        list of tuple: The (host, port) of each replica
+    """
+    replicas = []
+    for (address, name) in zip(addresses or [], names or []):
+        match = REPLICA_NAME.match(name or '')
+        if match:
+            replicas.append((match.group(1), int(match.group(2))))
+        elif address:
+            replicas.append((address, config['discovery_port']))
+    return replicas
+
+
+def heartbeat_timestamp():
+    """Return the current time, as a heartbeat timestamp
+
+    Returns:
+        The number of seconds since the epoch: an int by default, or a float
+        with millisecond precision if `heartbeat_precision` is
+        'milliseconds'.
+    """
+    if config.get('heartbeat_precision') == 'milliseconds':
+        return round(time.time(), 3)
+    return int(time.time())
+
+
+def encode_timestamp(timestamp):
+    """Convert a heartbeat timestamp to the value stored in the database
+
+    Args:
+        timestamp: The timestamp, in seconds
+
+    Returns:
+        int: The timestamp in seconds, or in milliseconds if
+            `heartbeat_precision` is 'milliseconds'
+    """
+    if config.get('heartbeat_precision') == 'milliseconds':
+        return int(round(timestamp * 1000))
+    return int(timestamp)
+
+
+def decode_timestamp(value):
+    """Convert a value stored in the database to a heartbeat timestamp
+
+    Values written in seconds and in milliseconds are told apart by their
+    magnitude, so a heartbeat table can be switched from one precision to the
+    other without migrating it.
+
+    Args:
+        value (int): The stored value, or None
+
+    Returns:
+        The timestamp in seconds (a float if it was stored in milliseconds),
+            or None
+    """
+    if value is None or value < MILLISECONDS_THRESHOLD:
+        return value
+    return value / 1000.0
+
+
+def parse_lsn(lsn):
+    """Convert a WAL position (LSN) to a number of bytes
+
+    Args:
+        lsn (str): The LSN, as displayed by PostgreSQL (eg. '16/B374D848'),
+            or None
+
+    Returns:
+        int: The position in bytes, or None if the LSN is None
+    """
+    if lsn is None:
+        return None
+    (high, low) = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def probe(connection):
+    """Return the role, cluster id, master and timestamp of a node in one query
+
+    The heartbeat table may not exist on masters that have never been
+    managed by plusmoin. In that case only the role is returned.
+
+    Args:
+        connection (psycopg2.connection): The database connection
+
+    Returns:
+        Tuple containing (is slave, cluster id, master name, timestamp), as
+        returned by probe_values. The last three entries are None if the
+        heartbeat table is missing or empty.
+
+    Raises:
+        DbError: On all database errors
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(probe_statement(connection.server_version))
+            return probe_values(cursor.fetchone())
+    except psycopg2.Error as e:
+        if e.pgcode == psycopg2.errorcodes.UNDEFINED_TABLE:
+            return is_slave(connection), None, None, None
+        logger = logging.getLogger()
+        logger.error("Could not probe node: {}".format(e.pgerror))
+        raise DbError()
+
+
 def create_heartbeat_table(connection):
     """Create heartbeat table if it doesn't exist, and populate a default entry
 
@@ -137,14 +536,17 @@ def create_heartbeat_table(connection):
 def update_heartbeat_table(cluster_id, name, timestamp, connection):
     """Update the heartbeat table
 
+    This expects the table to have been created by create_heartbeat_table.
+
     Args:
         cluster_id (int): The new cluster id
         name (str): The new master name
-        timestamp (int): The new timestamp
+        timestamp: The new timestamp, in seconds, as returned by
+            heartbeat_timestamp
         connection (psycopg2.connection): The database connection object
 
     Raises:
-        DbError: On all database errors
+        DbError: On all database errors, or if the table has no row to update
     """
     try:
         with connection.cursor() as cursor:
@@ -153,9 +555,13 @@ def update_heartbeat_table(cluster_id, name, timestamp, connection):
                 cluster_id = %s,
                 master = %s,
                 tstamp = %s
-            """, (cluster_id, name, timestamp))
+            """, (cluster_id, name, encode_timestamp(timestamp)))
             connection.commit()
+            if cursor.rowcount == 0:
+                logger = logging.getLogger()
+                logger.error("Heartbeat table is empty")
+                raise DbError()
     except psycopg2.Error as e:
         logger = logging.getLogger()
-        logger.error("Could not create heartbeat table: {}".format(e.pgerror))
+        logger.error("Could not update heartbeat table: {}".format(e.pgerror))
         raise DbError()
@@ -0,0 +1,164 @@
+import json
+import os
+import time
+
+from plusmoin.lib.snapshot import encode
+
+
+class EventLog(object):
+    """Append-only log of events, as newline delimited JSON
+
+    Each record is a JSON object on its own line, with a sequence number
+    ('seq') and the time at which it was recorded ('time') added to the
+    event's own fields. The sequence number carries on from the existing log
+    file, if any, so it keeps increasing across restarts.
+
+    Records are buffered until the log is flushed. Each flush is a single
+    write, followed by an fsync unless the file was synced less than
+    `fsync_interval` seconds before.
+
+    The log file is rotated before a flush when it grew larger than
+    `max_size` bytes, or when it was started more than `max_age` seconds
+    before. Rotated files are named after the log file, followed by '.1',
+    '.2', etc. ('.1' being the most recent), and only `backups` of them are
+    kept.
+
+    Args:
+        path (str): Path of the log file
+        max_size (int, optional): Maximum size of a log file in bytes, or 0
+            for no limit. Defaults to 0
+        max_age (float, optional): Maximum age of a log file in seconds, or 0
+            for no limit. The age of a log file that already exists when
+            the log is opened is counted from that time. Defaults to 0
+        backups (int, optional): Number of rotated files to keep. Defaults to
+            5
+        fsync_interval (float, optional): Minimum time between two fsyncs,
+            in seconds. Defaults to 0 (fsync on every flush)
+        clock (callable, optional): Function returning the current time.
+            Defaults to time.time
+
+    Attributes:
+        path (str): Path of the log file
+        sequence (int): Sequence number of the last record
+    """
+    def __init__(self, path, max_size=0, max_age=0, backups=5,
+                 fsync_interval=0, clock=time.time):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.backups = backups
+        self.fsync_interval = fsync_interval
+        self._clock = clock
+        self._buffer = []
+        self._file = None
+        self._started = None
+        self._synced = None
+        self.sequence = self._last_sequence()
+
+    def append(self, event, **fields):
+        """Add a record to the log
+
+        The record is only written when the log is flushed.
+
+        Args:
+            event (str): Name of the event
+            **fields: Additional fields of the record
+
+        Returns:
+            int: The record's sequence number
+        """
+        self.sequence += 1
+        record = dict(fields)
+        record['seq'] = self.sequence
+        record['time'] = self._clock()
+        record['event'] = event
+        self._buffer.append(encode(record) + "\n")
+        return self.sequence
+
+    def flush(self):
+        """Write the buffered records to the log file"""
+        if not self._buffer:
+            return
+        now = self._clock()
+        if self._file is None:
+            self._open(now)
+        elif self._should_rotate(now):
+            self._rotate(now)
+        self._file.write(''.join(self._buffer))
+        self._file.flush()
+        self._buffer = []
+        if (self._synced is None or not self.fsync_interval
+                or now - self._synced >= self.fsync_interval):
+            os.fsync(self._file.fileno())
+            self._synced = now
+
+    def close(self):
+        """Flush the buffered records and close the log file"""
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open(self, now):
+        """Open the log file for appending
+
+        Args:
+            now (float): The current time
+        """
+        self._file = open(self.path, 'a')
+        self._started = now
+
+    def _should_rotate(self, now):
+        """Check whether the log file should be rotated
+
+        Args:
+            now (float): The current time
+
+        Returns:
+            bool: True if the file is too large or too old
+        """
+        if self.max_age and now - self._started >= self.max_age:
+            return True
+        if self.max_size:
+            size = os.fstat(self._file.fileno()).st_size
+            return size >= self.max_size
+        return False
+
+    def _rotate(self, now):
+        """Rotate the log files, and start a new one
+
+        Args:
+            now (float): The current time
+        """
+        self._file.close()
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                source = '{}.{}'.format(self.path, index)
+                if os.path.exists(source):
+                    os.rename(source, '{}.{}'.format(self.path, index + 1))
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.unlink(self.path)
+        self._open(now)
+
+    def _last_sequence(self):
+        """Return the sequence number of the last record already logged
+
+        Returns:
+            int: The last sequence number found in the log file (or the most
+                recent rotated file if the log file is empty), or 0
+        """
+        for path in (self.path, self.path + '.1'):
+            try:
+                with open(path) as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(f.tell() - 4096, 0))
+                    lines = f.read().splitlines()
+            except IOError:
+                continue
+            for line in reversed(lines):
+                try:
+                    return int(json.loads(line)['seq'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return 0
@@ -0,0 +1,93 @@
+import logging
+import threading
+
+from plusmoin.lib import db
+from plusmoin.lib.probe import write_heartbeats
+from plusmoin.lib.scheduler import Scheduler
+
+
+class HeartbeatWriter(object):
+    """Write the masters' heartbeats on their own interval
+
+    Heartbeats are written from a background thread, over connections kept
+    open in a pool of their own, so they never wait for (or hold up) the
+    probes. This makes the timestamps seen on slaves, and so the measured
+    replication lag, as fine as the writer's interval rather than the
+    probing heartbeat.
+
+    Each master is written from its own thread, and a write that takes
+    longer than the timeout is abandoned, so a master that stops answering
+    does not hold up the others. Errors are logged, and the master is tried
+    again on the next round; it is up to the master's cluster to notice that
+    its heartbeat stopped moving.
+
+    Args:
+        interval (float): Time between two rounds of writes, in seconds
+        timeout (float, optional): Maximum time, in seconds, a single write
+            may take. Defaults to None (the interval)
+
+    Attributes:
+        interval (float): Time between two rounds of writes
+        timeout (float): Maximum time a single write may take, or None for
+            the interval
+    """
+    def __init__(self, interval, timeout=None):
+        self.interval = interval
+        self.timeout = timeout
+        self._masters = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._pool = db.ConnectionPool()
+        self._thread = None
+
+    def set_masters(self, masters):
+        """Set the nodes to write heartbeats to
+
+        Connections to nodes that are no longer masters are closed.
+
+        Args:
+            masters (list of Node): The master nodes. Each heartbeat is
+                written with the node's cluster id at the time.
+        """
+        with self._lock:
+            previous = self._masters
+            self._masters = list(masters)
+        for node in previous:
+            if node not in masters:
+                self._pool.close(node.host, node.port)
+
+    def write(self):
+        """Write the current time to the heartbeat table of every master"""
+        with self._lock:
+            masters = list(self._masters)
+        timestamp = db.heartbeat_timestamp()
+        errors = write_heartbeats(masters, timestamp,
+                                  self.timeout or self.interval, self._pool)
+        for node in masters:
+            if errors[node] is not None:
+                logger = logging.getLogger()
+                logger.warning("Could not write heartbeat to {}".format(
+                    node.name
+                ))
+
+    def start(self):
+        """Start writing heartbeats in a background thread"""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop writing heartbeats, and close the connections"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._pool.close_all()
+
+    def _run(self):
+        """Write heartbeats until stopped"""
+        scheduler = Scheduler(self.interval, 'skip',
+                              sleep=self._stopped.wait)
+        while not self._stopped.is_set():
+            self.write()
+            scheduler.wait()
@@ -0,0 +1,385 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Metric(object):
+    """Base class for metrics
+
+    Metrics hold one value per combination of label values. Label values are
+    given as keyword arguments, and missing labels are left empty.
+
+    Args:
+        name (str): Name of the metric
+        help (str): Description of the metric
+        labels (tuple of str, optional): Names of the metric's labels.
+            Defaults to ()
+
+    Attributes:
+        name (str): Name of the metric
+        help (str): Description of the metric
+        labels (tuple of str): Names of the metric's labels
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Remove the values for all label combinations"""
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        """Return the metric in the Prometheus text format
+
+        Returns:
+            list of str: The lines describing the metric
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type)
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for (key, value) in values:
+            lines += self._render_value(key, value)
+        return lines
+
+    def _key(self, labels):
+        """Return the key of the given label values
+
+        Args:
+            labels (dict): The label values
+
+        Returns:
+            tuple: The label values, in the order of the label names
+        """
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def _render_value(self, key, value):
+        """Return the lines describing the value of a label combination
+
+        Args:
+            key (tuple): The label values
+            value: The value
+
+        Returns:
+            list of str: The lines
+        """
+        return ['{}{} {}'.format(self.name, _labels(self.labels, key),
+                                 _number(value))]
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter
+
+        Args:
+            amount (float, optional): Amount to add. Defaults to 1
+            **labels: The label values
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down"""
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge's value
+
+        Args:
+            value (float): The value
+            **labels: The label values
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def replace(self, values):
+        """Replace the values for all label combinations at once
+
+        Args:
+            values (list of tuple): List of (value, labels) tuples, where
+                labels is a dictionary of label values
+        """
+        new_values = dict((self._key(labels), value)
+                          for (value, labels) in values)
+        with self._lock:
+            self._values = new_values
+
+
+class Histogram(Metric):
+    """Distribution of observed values, counted in buckets
+
+    Args:
+        name (str): Name of the metric
+        help (str): Description of the metric
+        labels (tuple of str, optional): Names of the metric's labels.
+            Defaults to ()
+        buckets (tuple of float, optional): Upper bounds of the buckets.
+            Defaults to DEFAULT_BUCKETS
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record an observed value
+
+        Args:
+            value (float): The value
+            **labels: The label values
+        """
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            entry = self._values[key]
+            for (index, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager observing the time spent in its block
+
+        Args:
+            **labels: The label values
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def _render_value(self, key, value):
+        """Return the lines describing the value of a label combination
+
+        Args:
+            key (tuple): The label values
+            value (list): The bucket counts, count and sum
+
+        Returns:
+            list of str: The lines
+        """
+        (buckets, count, total) = value
+        labels = self.labels + ('le',)
+        lines = []
+        for (bound, bucket_count) in zip(self.buckets, buckets):
+            lines.append('{}_bucket{} {}'.format(
+                self.name, _labels(labels, key + (_number(bound),)),
+                bucket_count
+            ))
+        lines.append('{}_bucket{} {}'.format(
+            self.name, _labels(labels, key + ('+Inf',)), count
+        ))
+        lines.append('{}_sum{} {}'.format(
+            self.name, _labels(self.labels, key), _number(total)
+        ))
+        lines.append('{}_count{} {}'.format(
+            self.name, _labels(self.labels, key), count
+        ))
+        return lines
+
+
+class Registry(object):
+    """Collection of metrics, rendered together"""
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        """Create and register a counter
+
+        Args:
+            name (str): Name of the metric
+            help (str): Description of the metric
+            labels (tuple of str, optional): Names of the labels
+
+        Returns:
+            Counter: The counter
+        """
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        """Create and register a gauge
+
+        Args:
+            name (str): Name of the metric
+            help (str): Description of the metric
+            labels (tuple of str, optional): Names of the labels
+
+        Returns:
+            Gauge: The gauge
+        """
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """Create and register a histogram
+
+        Args:
+            name (str): Name of the metric
+            help (str): Description of the metric
+            labels (tuple of str, optional): Names of the labels
+            buckets (tuple of float, optional): Upper bounds of the buckets
+
+        Returns:
+            Histogram: The histogram
+        """
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Return all the metrics in the Prometheus text format
+
+        Returns:
+            str: The metrics
+        """
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        """Add a metric to the registry
+
+        Args:
+            metric (Metric): The metric
+
+        Returns:
+            Metric: The metric
+        """
+        self._metrics.append(metric)
+        return metric
+
+
+def _labels(names, values):
+    """Format label values
+
+    Args:
+        names (tuple of str): The label names
+        values (tuple of str): The label values
+
+    Returns:
+        str: The labels, as '{name="value",...}', or an empty string if there
+            are no labels
+    """
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for (name, value) in zip(names, values)
+    ) + '}'
+
+
+def _number(value):
+    """Format a number
+
+    Args:
+        value (float): The number
+
+    Returns:
+        str: The formatted number
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+registry = Registry()
+
+connect_seconds = registry.histogram(
+    'plusmoin_connect_seconds',
+    'Time taken to connect to a node',
+    ('node',)
+)
+query_seconds = registry.histogram(
+    'plusmoin_query_seconds',
+    'Time taken to run a query on a node',
+    ('node', 'query')
+)
+iteration_seconds = registry.histogram(
+    'plusmoin_iteration_seconds',
+    'Time taken by an iteration'
+)
+trigger_seconds = registry.histogram(
+    'plusmoin_trigger_seconds',
+    'Time taken to run a trigger',
+    ('trigger',)
+)
+trigger_queue_seconds = registry.histogram(
+    'plusmoin_trigger_queue_seconds',
+    'Time a trigger waited in the queue before running',
+    ('trigger',)
+)
+trigger_failures = registry.counter(
+    'plusmoin_trigger_failures_total',
+    'Triggers that failed',
+    ('trigger',)
+)
+triggers_dropped = registry.counter(
+    'plusmoin_triggers_dropped_total',
+    'Triggers dropped from the queue in favour of a more recent one',
+    ('trigger',)
+)
+triggers = registry.gauge(
+    'plusmoin_triggers',
+    'Number of triggers waiting to run, and running',
+    ('state',)
+)
+db_errors = registry.counter(
+    'plusmoin_db_errors_total',
+    'Database errors, by node and operation',
+    ('node', 'operation')
+)
+clusters = registry.gauge(
+    'plusmoin_clusters',
+    'Number of clusters'
+)
+slaves = registry.gauge(
+    'plusmoin_slaves',
+    'Number of in-sync slaves',
+    ('cluster_id',)
+)
+lost = registry.gauge(
+    'plusmoin_lost',
+    'Number of lost slaves',
+    ('cluster_id',)
+)
+clusterless = registry.gauge(
+    'plusmoin_clusterless',
+    'Number of cluster-less nodes'
+)
+replication_lag = registry.gauge(
+    'plusmoin_replication_lag_seconds',
+    'Age of the heartbeat seen on a slave, relative to its master',
+    ('cluster_id', 'node')
+)
+replication_lag_bytes = registry.gauge(
+    'plusmoin_replication_lag_bytes',
+    'How far the replayed WAL position of a slave is behind its master',
+    ('cluster_id', 'node')
+)
+startup_sync_seconds = registry.gauge(
+    'plusmoin_startup_sync_seconds',
+    'Time a slave took to replicate its master\'s first heartbeat at startup',
+    ('node',)
+)
@@ -1,4 +1,5 @@
 from plusmoin.lib import db
+from plusmoin.lib import metrics
 
 
 class Node(object):
@@ -17,6 +18,19 @@ class Node(object):
         master_name (str): Name of the server, as fetched from the database
         timestamp (int): Timestamp of the last seen beat, as fetched from the
             database
+        wal_position (int): With `wal_lag`, the current WAL position of a
+            master, or the replayed WAL position of a slave, in bytes. None
+            if not known.
+        wal_received (int): With `wal_lag`, the WAL position received by a
+            slave, in bytes. None if not known.
+        receive_lag_bytes (int): With `wal_lag`, how far the received WAL
+            position of a slave is behind its master's, in bytes. Set by the
+            node's cluster; None if not known.
+        replay_lag_bytes (int): With `wal_lag`, how far the replayed WAL
+            position of a slave is behind its master's, in bytes. Set by the
+            node's cluster; None if not known.
+        replicas (list of tuple): With `discovery`, the (host, port) of the
+            replicas streaming from a master. None if not known.
     """
     def __init__(self, host, port):
         self.host = host
@@ -26,7 +40,13 @@ class Node(object):
         self.cluster_id = -1
         self.master_name = ''
         self.timestamp = 0
+        self.wal_position = None
+        self.wal_received = None
+        self.receive_lag_bytes = None
+        self.replay_lag_bytes = None
+        self.replicas = None
         self._dict = None
+        self._heartbeat_table_ready = False
 
     def refresh_role(self):
         """Call the database to refresh the role of this node
@@ -49,21 +69,130 @@ class Node(object):
             self.master_name = master_name
             self.timestamp = timestamp
 
-    def update_heartbeat(self, timestamp):
+    def probe(self):
+        """Refresh the node's role and information in a single database query
+
+        The information (cluster id, master name and timestamp) is only
+        refreshed on slave nodes; on masters it is managed by plusmoin.
+
+        Raises:
+            plusmoin.lib.db.DbError: On any database error, or if the node is
+                a slave without heartbeat information.
+        """
+        self.apply_probe(*self.fetch_probe())
+
+    def fetch_probe(self):
+        """Run the probe query, without updating the node
+
+        Returns:
+            Tuple containing (is slave, cluster id, master name, timestamp),
+                as returned by plusmoin.lib.db.probe
+
+        Raises:
+            plusmoin.lib.db.DbError: On any database error
+        """
+        with db.get_connection(self.host, self.port) as connection:
+            with metrics.query_seconds.time(node=self.name, query='probe'):
+                return db.probe(connection)
+
+    def apply_probe(self, is_slave, cluster_id, master_name, timestamp,
+                    wal=None, replicas=None):
+        """Update the node from the values returned by a probe query
+
+        Args:
+            is_slave (bool): True if the node is a slave
+            cluster_id (int): Cluster id from the heartbeat table, or None
+            master_name (str): Master name from the heartbeat table, or None
+            timestamp (int): Timestamp from the heartbeat table, or None
+            wal (tuple, optional): The node's WAL positions (current,
+                received, replayed) in bytes, if they were fetched. Defaults
+                to None
+            replicas (list of tuple, optional): The (host, port) of the
+                node's replicas, if they were fetched. Only kept on masters.
+                Defaults to None
+
+        Raises:
+            plusmoin.lib.db.NoHeartbeatError: If the node is a slave without
+                heartbeat information. The node's role is still updated.
+        """
+        self.is_slave = is_slave
+        if wal is not None:
+            (current, received, replayed) = wal
+            if is_slave:
+                (self.wal_position, self.wal_received) = (replayed, received)
+            else:
+                (self.wal_position, self.wal_received) = (current, None)
+        self.replicas = None if is_slave else replicas
+        if not is_slave:
+            return
+        if cluster_id is None:
+            raise db.NoHeartbeatError()
+        self.cluster_id = cluster_id
+        self.master_name = master_name
+        self.timestamp = timestamp
+
+    def update_heartbeat(self, timestamp, pool=None):
         """Update the node's heartbeat (only on master nodes)
 
         Args:
             timestamp (int): The timestamp to set for heartbeat
+            pool (ConnectionPool, optional): The pool to take the connection
+                from. Defaults to None (the shared pool)
 
         Raises:
             plusmoin.lib.db.DbError: On any database error
         """
-        with db.get_connection(self.host, self.port) as connection:
-            db.create_heartbeat_table(connection)
-            db.update_heartbeat_table(
-                self.cluster_id, self.name, timestamp, connection
-            )
-            self.timestamp = timestamp
+        try:
+            self.write_heartbeat(timestamp, pool)
+        except db.DbError as e:
+            self.apply_heartbeat(timestamp, e)
+            raise
+        self.apply_heartbeat(timestamp)
+
+    def write_heartbeat(self, timestamp, pool=None):
+        """Write the heartbeat to the database, without updating the node
+
+        The heartbeat table is only created the first time, or after an error
+        (which may mean the connection was lost or the table was dropped).
+
+        Args:
+            timestamp (int): The timestamp to set for heartbeat
+            pool (ConnectionPool, optional): The pool to take the connection
+                from. Defaults to None (the shared pool)
+
+        Raises:
+            plusmoin.lib.db.DbError: On any database error
+        """
+        if pool is None:
+            context = db.get_connection(self.host, self.port)
+        else:
+            context = pool.connection(self.host, self.port)
+        try:
+            with context as connection:
+                if not self._heartbeat_table_ready:
+                    db.create_heartbeat_table(connection)
+                with metrics.query_seconds.time(node=self.name,
+                                                query='heartbeat'):
+                    db.update_heartbeat_table(
+                        self.cluster_id, self.name, timestamp, connection
+                    )
+        except db.DbError:
+            metrics.db_errors.inc(node=self.name, operation='heartbeat')
+            raise
+
+    def apply_heartbeat(self, timestamp, error=None):
+        """Update the node from the outcome of a heartbeat write
+
+        Args:
+            timestamp (int): The timestamp that was written
+            error (DbError, optional): The error raised by the write, if
+                any. Defaults to None
+        """
+        if error is not None:
+            self._heartbeat_table_ready = False
+            return
+        self._heartbeat_table_ready = True
+        self.timestamp = timestamp
 
     def to_dict(self, reset=False):
         """ Return a dictionary describing this object for json dumps
@@ -79,4 +208,8 @@ class Node(object):
                 'is_slave': self.is_slave,
                 'master_name': self.master_name
             }
+            if self.wal_position is not None:
+                self._dict['wal_position'] = self.wal_position
+                self._dict['receive_lag_bytes'] = self.receive_lag_bytes
+                self._dict['replay_lag_bytes'] = self.replay_lag_bytes
         return dict(self._dict)
\ No newline at end of file
@@ -0,0 +1,272 @@
+import errno
+import logging
+import select
+import time
+
+import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
+
+from plusmoin.config import config
+from plusmoin.lib import db
+from plusmoin.lib import metrics
+from plusmoin.lib.probe import ProbeResult
+
+POLL_OK = psycopg2.extensions.POLL_OK
+POLL_READ = psycopg2.extensions.POLL_READ
+POLL_WRITE = psycopg2.extensions.POLL_WRITE
+
+
+class _NodeProbe(object):
+    """State of a single probe running over a non-blocking connection
+
+    Args:
+        node (Node): The node to probe
+        connection (psycopg2.connection): An asynchronous connection to the
+            node. It may still be connecting.
+        connecting (bool, optional): True if the connection was just opened.
+            Defaults to False
+
+    Attributes:
+        node (Node): The node being probed
+        connection (psycopg2.connection): The connection used by the probe
+        result (ProbeResult): The outcome of the probe
+        values (tuple): The probe values, once the probe is done
+    """
+    def __init__(self, node, connection, connecting=False):
+        self.node = node
+        self.connection = connection
+        self.result = ProbeResult(node, node.timestamp)
+        self.values = None
+        self._cursor = None
+        self._fallback = False
+        self._connecting = connecting
+        self._started = time.time()
+
+    def step(self):
+        """Advance the probe as far as possible without blocking
+
+        Returns:
+            int: POLL_READ or POLL_WRITE if the probe is waiting on the
+                connection's socket, POLL_OK if the probe is done.
+
+        Raises:
+            psycopg2.Error: On any database error
+        """
+        while True:
+            try:
+                state = self.connection.poll()
+            except psycopg2.Error as e:
+                if (self._fallback
+                        or e.pgcode != psycopg2.errorcodes.UNDEFINED_TABLE):
+                    raise
+                # No heartbeat table, as on a fresh master. Only fetch
+                # the role.
+                self._fallback = True
+                self._execute(config['is_slave_statement'])
+                continue
+            if state != POLL_OK:
+                return state
+            if self._cursor is None:
+                now = time.time()
+                if self._connecting:
+                    metrics.connect_seconds.observe(
+                        now - self._started, node=self.node.name
+                    )
+                self._started = now
+                self._execute(
+                    db.probe_statement(self.connection.server_version)
+                )
+                continue
+            metrics.query_seconds.observe(
+                time.time() - self._started, node=self.node.name, query='probe'
+            )
+            value = self._cursor.fetchone()
+            if self._fallback:
+                if value is None or len(value) != 1:
+                    raise psycopg2.DataError()
+                self.values = (value[0], None, None, None)
+            else:
+                try:
+                    self.values = db.probe_values(value)
+                except db.DbError:
+                    raise psycopg2.DataError()
+            return POLL_OK
+
+    def _execute(self, statement):
+        """Send a statement on the probe's connection
+
+        Args:
+            statement (str): The statement to send
+        """
+        self._cursor = self.connection.cursor()
+        self._cursor.execute(statement)
+
+
+class NonBlockingProber(object):
+    """Probe many nodes from a single thread using non-blocking connections
+
+    One asynchronous connection is kept open per node, and all probes are
+    multiplexed with select.poll. As all the probes start together, the
+    probe round as a whole is bound by the configured probe_timeout (or
+    connect_timeout if there is none), which libpq does not enforce on
+    asynchronous connections.
+    """
+    def __init__(self):
+        self._connections = {}
+
+    def probe_nodes(self, nodes):
+        """Probe the given nodes
+
+        Args:
+            nodes (list of Node): The nodes to probe
+
+        Returns:
+            dict: Dictionary of Node to ProbeResult
+        """
+        deadline = time.time() + (
+            config.get('probe_timeout') or config['connect_timeout']
+        )
+        poller = select.poll()
+        pending = {}
+        results = {}
+        for node in nodes:
+            probe = None
+            try:
+                (connection, connecting) = self._connection(node)
+                probe = _NodeProbe(node, connection, connecting)
+                state = probe.step()
+            except psycopg2.Error as e:
+                self._fail(node, probe, e, results)
+                continue
+            self._advance(probe, state, poller, pending, results)
+        while pending:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                events = poller.poll(remaining * 1000)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                # Interrupted by a signal (eg. SIGHUP); poll again for the
+                # time left
+                continue
+            for fd, event in events:
+                probe = pending.pop(fd)
+                poller.unregister(fd)
+                try:
+                    state = probe.step()
+                except psycopg2.Error as e:
+                    self._fail(probe.node, probe, e, results)
+                    continue
+                self._advance(probe, state, poller, pending, results)
+        for probe in pending.values():
+            self._fail(probe.node, probe, 'timed out', results)
+        return results
+
+    def close(self, node):
+        """Close the connection to the given node, if any
+
+        Args:
+            node (Node): The node
+        """
+        connection = self._connections.pop((node.host, node.port), None)
+        if connection is not None:
+            self._close(connection)
+
+    def close_all(self):
+        """Close all the connections"""
+        connections = self._connections.values()
+        self._connections = {}
+        for connection in connections:
+            self._close(connection)
+
+    def _advance(self, probe, state, poller, pending, results):
+        """Record a finished probe, or wait on its socket
+
+        Args:
+            probe (_NodeProbe): The probe
+            state (int): The state returned by the probe's last step
+            poller (select.poll): The poll object
+            pending (dict): Dictionary of file descriptor to pending probe
+            results (dict): Dictionary of Node to ProbeResult
+        """
+        if state == POLL_OK:
+            self._connections[(probe.node.host, probe.node.port)] = (
+                probe.connection
+            )
+            try:
+                probe.node.apply_probe(*probe.values)
+            except db.DbError as e:
+                probe.result.error = e
+            results[probe.node] = probe.result
+            return
+        # The file descriptor may change while connecting, so fetch it anew
+        fd = probe.connection.fileno()
+        if state == POLL_READ:
+            poller.register(fd, select.POLLIN)
+        else:
+            poller.register(fd, select.POLLOUT)
+        pending[fd] = probe
+
+    def _fail(self, node, probe, error, results):
+        """Record a failed probe and drop its connection
+
+        Args:
+            node (Node): The probed node
+            probe (_NodeProbe): The probe, or None if it could not be started
+            error: The psycopg2 error, or a message describing the failure
+            results (dict): Dictionary of Node to ProbeResult
+        """
+        logger = logging.getLogger()
+        logger.error("Could not probe {}:{}: {}".format(
+            node.host, node.port, getattr(error, 'pgerror', None) or error
+        ))
+        if probe is None:
+            result = ProbeResult(node, node.timestamp)
+        else:
+            result = probe.result
+            self._close(probe.connection)
+        result.error = db.DbError()
+        results[node] = result
+
+    def _connection(self, node):
+        """Return an asynchronous connection to the given node
+
+        The existing connection is re-used if it is still healthy, otherwise
+        a new connection is started.
+
+        Args:
+            node (Node): The node to connect to
+
+        Returns:
+            tuple: (connection, connecting) where connection is an
+                asynchronous connection and connecting is True if it was just
+                opened (and may still be connecting).
+
+        Raises:
+            psycopg2.Error: If the connection could not be started
+        """
+        connection = self._connections.pop((node.host, node.port), None)
+        if connection is not None:
+            try:
+                if not connection.closed and connection.poll() == POLL_OK:
+                    return (connection, False)
+            except psycopg2.Error:
+                pass
+            self._close(connection)
+        details = db.connection_details(node.host, node.port)
+        details['async'] = 1
+        return (psycopg2.connect(**details), True)
+
+    def _close(self, connection):
+        """Close a connection, ignoring errors
+
+        Args:
+            connection (psycopg2.connection): The connection to close
+        """
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
@@ -0,0 +1,275 @@
+import functools
+import logging
+import threading
+import time
+
+from plusmoin.lib.db import DbError, NoHeartbeatError
+
+
+class ProbeResult(object):
+    """The outcome of probing a node
+
+    Args:
+        node (Node): The probed node
+        previous_timestamp (int): The node's timestamp before it was probed
+
+    Attributes:
+        node (Node): The probed node
+        previous_timestamp (int): The node's timestamp before it was probed
+        error (DbError): The error raised while probing the node, or None if
+            the probe succeeded
+    """
+    def __init__(self, node, previous_timestamp):
+        self.node = node
+        self.previous_timestamp = previous_timestamp
+        self.error = None
+
+    @property
+    def no_heartbeat(self):
+        """bool: True if the node answered, but is a slave without heartbeat
+        information. Its role is then known, though the probe failed."""
+        return isinstance(self.error, NoHeartbeatError)
+
+
+class _Task(object):
+    """A database call running in its own thread
+
+    The thread only runs the call; its result is used by the calling thread,
+    so a call that outlives its deadline cannot change the node afterwards.
+    Any exception raised by the call is reported as a DbError.
+
+    Args:
+        node (Node): The node the call is made to
+        operation (str): The name of the operation, eg. 'probe'
+        call (callable): The call to make. It takes no arguments
+        finished (threading.Condition): Condition notified when the call
+            finishes
+
+    Attributes:
+        node (Node): The node the call is made to
+        operation (str): The name of the operation
+        started (float): Time at which the call was started
+        done (bool): True once the call has finished
+        values: The value returned by the call, if it succeeded
+        error (DbError): The error raised by the call, if any
+    """
+    def __init__(self, node, operation, call, finished):
+        self.node = node
+        self.operation = operation
+        self.started = None
+        self.done = False
+        self.values = None
+        self.error = None
+        self._call = call
+        self._finished = finished
+
+    def start(self):
+        """Start the call in a new thread"""
+        self.started = time.time()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def abandon(self):
+        """Give up on the call, which is still running
+
+        Until it finishes, no other call of the same operation is made to the
+        node.
+        """
+        with _abandoned_lock:
+            if not self.done:
+                _abandoned[(self.operation, self.node)] = self
+
+    def _run(self):
+        """Make the call"""
+        try:
+            self.values = self._call()
+        except DbError as e:
+            self.error = e
+        except Exception:
+            logging.getLogger().exception(
+                "Unexpected error in {} of {}:{}".format(
+                    self.operation, self.node.host, self.node.port
+                )
+            )
+            self.error = DbError()
+        finally:
+            with self._finished:
+                self.done = True
+                self._finished.notify()
+            with _abandoned_lock:
+                if _abandoned.get((self.operation, self.node)) is self:
+                    del _abandoned[(self.operation, self.node)]
+
+
+# Calls that timed out and are still running, by (operation, node)
+_abandoned = {}
+_abandoned_lock = threading.Lock()
+
+
+def _run_tasks(operation, calls, concurrency, timeout=None):
+    """Make calls to nodes in threads, with at most `concurrency` at a time
+
+    When a timeout is given, a call which takes longer than that fails,
+    whatever the reason. It is abandoned: it no longer counts towards the
+    concurrency, and its result is ignored. As long as it runs, no new call
+    of the same operation is made to that node; those fail straight away.
+    This caps the threads (and connections) left behind by a node that
+    stopped answering to one per operation.
+
+    Args:
+        operation (str): The name of the operation, eg. 'probe'
+        calls (list of tuple): The (node, callable) pairs to run
+        concurrency (int): Maximum number of calls running at the same time
+        timeout (float, optional): Maximum time, in seconds, a single call
+            may take. Defaults to None (no limit)
+
+    Returns:
+        dict: Dictionary of Node to (values, error) tuple, where error is the
+            DbError raised by the call, or None if it succeeded
+    """
+    finished = threading.Condition()
+    waiting = []
+    outcomes = {}
+    logger = logging.getLogger()
+    for (node, call) in reversed(calls):
+        with _abandoned_lock:
+            busy = (operation, node) in _abandoned
+        if busy:
+            logger.error("Previous {} of {}:{} is still running".format(
+                operation, node.host, node.port
+            ))
+            outcomes[node] = (None, DbError())
+        else:
+            waiting.append(_Task(node, operation, call, finished))
+    running = []
+    while waiting or running:
+        while waiting and len(running) < max(1, concurrency):
+            task = waiting.pop()
+            running.append(task)
+            task.start()
+        with finished:
+            if not any(task.done for task in running):
+                if timeout is None:
+                    finished.wait()
+                else:
+                    first = min(task.started for task in running)
+                    finished.wait(max(first + timeout - time.time(), 0))
+            now = time.time()
+            for task in list(running):
+                if task.done:
+                    running.remove(task)
+                    outcomes[task.node] = (task.values, task.error)
+                elif timeout is not None and now - task.started >= timeout:
+                    running.remove(task)
+                    task.abandon()
+                    logger.error("{} of {}:{} timed out".format(
+                        operation.capitalize(), task.node.host,
+                        task.node.port
+                    ))
+                    outcomes[task.node] = (None, DbError())
+    return outcomes
+
+
+def probe_node(node):
+    """Probe a single node, capturing any database error
+
+    Args:
+        node (Node): The node to probe
+
+    Returns:
+        ProbeResult: The outcome of the probe
+    """
+    result = ProbeResult(node, node.timestamp)
+    try:
+        node.probe()
+    except DbError as e:
+        result.error = e
+    return result
+
+
+def probe_nodes(nodes, concurrency, timeout=None):
+    """Probe the given nodes concurrently
+
+    Each node is probed exactly once, with at most `concurrency` probes
+    running at the same time. Only the nodes' own attributes are updated
+    while probing, so the results can then be used to move nodes around in a
+    deterministic order.
+
+    When a timeout is given, a node which takes longer than that to answer
+    is reported as failed, whatever the reason. Its probe is abandoned (it
+    no longer counts towards the concurrency) and its result is ignored.
+    Until that probe finishes, the node is not probed again: it fails
+    straight away instead. Probes always run in their own thread in that
+    case, even with a concurrency of 1.
+
+    Args:
+        nodes (list of Node): The nodes to probe
+        concurrency (int): Maximum number of nodes to probe at the same time
+        timeout (float, optional): Maximum time, in seconds, a single probe
+            may take. Defaults to None (no limit)
+
+    Returns:
+        dict: Dictionary of Node to ProbeResult
+    """
+    if timeout is None and (concurrency <= 1 or len(nodes) <= 1):
+        return dict((node, probe_node(node)) for node in nodes)
+    results = dict((node, ProbeResult(node, node.timestamp)) for node in nodes)
+    outcomes = _run_tasks(
+        'probe', [(node, node.fetch_probe) for node in nodes], concurrency,
+        timeout
+    )
+    for node in nodes:
+        (values, error) = outcomes[node]
+        result = results[node]
+        if error is not None:
+            result.error = error
+        else:
+            try:
+                node.apply_probe(*values)
+            except DbError as e:
+                result.error = e
+    return results
+
+
+def write_heartbeats(nodes, timestamp, timeout=None, pool=None):
+    """Write a heartbeat to the given nodes concurrently
+
+    Each node is written to in its own thread, so a node that does not
+    answer does not hold up the others. When a timeout is given, a write
+    which takes longer than that fails, and is abandoned like a probe. A
+    single node is written to from the calling thread when there is no
+    timeout. The nodes themselves are only updated from the calling thread.
+
+    Args:
+        nodes (list of Node): The nodes to write to
+        timestamp: The heartbeat timestamp
+        timeout (float, optional): Maximum time, in seconds, a single write
+            may take. Defaults to None (no limit)
+        pool (ConnectionPool, optional): The pool to get connections from.
+            Defaults to None (the shared pool)
+
+    Returns:
+        dict: Dictionary of Node to the DbError raised while writing to it,
+            or None if the write succeeded
+    """
+    args = (timestamp,) if pool is None else (timestamp, pool)
+    if timeout is None and len(nodes) <= 1:
+        outcomes = {}
+        for node in nodes:
+            try:
+                outcomes[node] = (node.write_heartbeat(*args), None)
+            except DbError as e:
+                outcomes[node] = (None, e)
+    else:
+        outcomes = _run_tasks(
+            'heartbeat',
+            [(node, functools.partial(node.write_heartbeat, *args))
+             for node in nodes],
+            len(nodes), timeout
+        )
+    errors = {}
+    for node in nodes:
+        errors[node] = outcomes[node][1]
+        node.apply_heartbeat(timestamp, errors[node])
+    return errors
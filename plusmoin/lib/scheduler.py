@@ -0,0 +1,69 @@
+import time
+
+
+class Scheduler(object):
+    """Start iterations on a fixed cadence
+
+    Deadlines are computed from the time the scheduler was created, rather
+    than from the end of the previous iteration, so the time spent running
+    an iteration does not delay the following ones.
+
+    When an iteration runs past one or more deadlines, the overrun policy
+    decides what happens next:
+        - 'skip': the missed deadlines are dropped, and the next iteration
+          starts at the next deadline on the original cadence;
+        - 'run': the next iteration starts straight away, and the cadence
+          restarts from there.
+
+    Args:
+        interval (float): Time between the start of two iterations, in seconds
+        overrun (str, optional): Overrun policy, 'skip' or 'run'. Defaults to
+            'skip'
+        clock (callable, optional): Function returning the current time.
+            Defaults to time.time
+        sleep (callable, optional): Function used to sleep. A sleep cut
+            short (eg. by a signal) is resumed until the deadline, unless the
+            function returns a true value, which ends the wait (as
+            threading.Event.wait does once the event is set). Defaults to
+            time.sleep
+
+    Attributes:
+        interval (float): Time between the start of two iterations
+        overrun (str): Overrun policy
+        missed (int): Number of deadlines missed so far
+
+    Raises:
+        ValueError: If the overrun policy is unknown
+    """
+    def __init__(self, interval, overrun='skip', clock=time.time,
+                 sleep=time.sleep):
+        if overrun not in ('skip', 'run'):
+            raise ValueError("Unknown overrun policy {}".format(overrun))
+        self.interval = interval
+        self.overrun = overrun
+        self.missed = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._deadline = self._clock() + interval
+
+    def wait(self):
+        """Wait until the next iteration should start"""
+        now = self._clock()
+        if now < self._deadline - self.interval:
+            # The clock went backwards; restart the cadence from now.
+            self._deadline = now + self.interval
+        if now > self._deadline:
+            late = int((now - self._deadline) // self.interval) + 1
+            self.missed += late
+            if self.overrun == 'run':
+                self._deadline = now + self.interval
+                return
+            self._deadline += late * self.interval
+        while now < self._deadline:
+            if self._sleep(self._deadline - now):
+                break
+            now = self._clock()
+            if now < self._deadline - self.interval:
+                # The clock went backwards while sleeping
+                break
+        self._deadline += self.interval
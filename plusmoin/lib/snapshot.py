@@ -0,0 +1,168 @@
+import json
+
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = None
+
+
+def encode(value):
+    """Encode a value as JSON
+
+    A faster encoder (ujson or simplejson) is used when one is installed.
+    Keys are sorted, so equal values are always encoded the same way.
+
+    Args:
+        value: The value to encode
+
+    Returns:
+        str: The JSON encoded value
+    """
+    if fast_json is not None:
+        return fast_json.dumps(value, sort_keys=True)
+    return json.dumps(value, sort_keys=True)
+
+
+class Payload(object):
+    """Data sent to a trigger, along with its JSON encoding
+
+    Args:
+        data (dict): The data
+        encoded (str): The JSON encoding of the data
+
+    Attributes:
+        data (dict): The data
+        encoded (str): The JSON encoding of the data
+    """
+    def __init__(self, data, encoded):
+        self.data = data
+        self.encoded = encoded
+
+
+class Snapshot(object):
+    """The state of all clusters at the end of an iteration
+
+    Each cluster and the list of cluster-less nodes are encoded once, when
+    the snapshot is taken. Trigger payloads and the status are then assembled
+    from the encoded fragments, rather than encoding the same data again for
+    each of them.
+
+    Args:
+        clusters (list of Cluster): The clusters
+        clusterless (list of Node): The cluster-less nodes
+
+    Attributes:
+        clusterless (list of dict): The cluster-less nodes' meta-data
+    """
+    def __init__(self, clusters, clusterless):
+        self.clusterless = [n.to_dict(reset=True) for n in clusterless]
+        self._clusterless_json = encode(self.clusterless)
+        self._clusters = []
+        self._dicts = {}
+        self._fragments = {}
+        self._roles = {}
+        for cluster in clusters:
+            self._clusters.append(cluster.cluster_id)
+            self._dicts[cluster.cluster_id] = cluster.to_dict(reset=True)
+            self._fragments[cluster.cluster_id] = encode(
+                self._dicts[cluster.cluster_id]
+            )
+            self._set_roles(self._dicts[cluster.cluster_id])
+        for node in self.clusterless:
+            self._roles[(node['host'], node['port'])] = 'clusterless'
+
+    def payload(self, cluster_id, **extra):
+        """Return the payload of a trigger for the given cluster
+
+        Args:
+            cluster_id (int): The cluster's id
+            **extra: Additional values to include in the payload, such as
+                'trigger' or 'events'
+
+        Returns:
+            Payload: The cluster's meta-data, the cluster-less nodes and the
+                additional values
+        """
+        data = self._dicts[cluster_id].copy()
+        data['clusterless'] = self.clusterless
+        data.update(extra)
+        parts = ['"clusterless": ' + self._clusterless_json]
+        for key in sorted(extra):
+            parts.append('{}: {}'.format(encode(key), encode(extra[key])))
+        # Splice the extra values into the cluster's encoded object
+        encoded = '{' + ', '.join(parts) + ', ' + (
+            self._fragments[cluster_id][1:]
+        )
+        return Payload(data, encoded)
+
+    def encoded_cluster(self, cluster_id):
+        """Return the encoded meta-data of a cluster
+
+        Args:
+            cluster_id (int): The cluster's id
+
+        Returns:
+            str: The cluster's JSON encoded meta-data, or None if there is no
+                such cluster
+        """
+        return self._fragments.get(cluster_id)
+
+    def encoded_clusterless(self):
+        """Return the encoded list of cluster-less nodes
+
+        Returns:
+            str: The JSON encoded list of cluster-less nodes
+        """
+        return self._clusterless_json
+
+    def role(self, host, port):
+        """Return the role of a node
+
+        Args:
+            host (str): The node's host
+            port (int): The node's port
+
+        Returns:
+            str: 'master' for a cluster's master, 'replica' for an in-sync
+                slave, 'lost' for a slave that is down or out of sync,
+                'clusterless' for a cluster-less node, or None if the node is
+                not known.
+        """
+        return self._roles.get((host, port))
+
+    def status(self, **extra):
+        """Return the encoded status of all clusters
+
+        Args:
+            **extra: Additional values to include in the status
+
+        Returns:
+            str: JSON object with the clusters, the cluster-less nodes and the
+                additional values
+        """
+        parts = [
+            '"clusters": [' + ', '.join(
+                self._fragments[c] for c in self._clusters
+            ) + ']',
+            '"clusterless": ' + self._clusterless_json
+        ]
+        for key in sorted(extra):
+            parts.append('{}: {}'.format(encode(key), encode(extra[key])))
+        return '{' + ', '.join(parts) + '}'
+
+    def _set_roles(self, cluster):
+        """Record the role of a cluster's nodes
+
+        Args:
+            cluster (dict): The cluster's meta-data
+        """
+        if cluster.get('master'):
+            master = cluster['master']
+            self._roles[(master['host'], master['port'])] = 'master'
+        for node in cluster.get('slaves', []):
+            self._roles[(node['host'], node['port'])] = 'replica'
+        for node in cluster.get('lost', []):
+            self._roles[(node['host'], node['port'])] = 'lost'
@@ -0,0 +1,102 @@
+import json
+
+from plusmoin.lib.snapshot import encode
+from plusmoin.lib.status import ChangeTracker, replace_file
+
+# Version of the state file format
+STATE_VERSION = 1
+
+
+class StateFile(object):
+    """Persist the clusters' state to a local file, so it survives restarts
+
+    The state lists, for each cluster, the name of its master, the last
+    heartbeat written to it and the names of its slaves and lost nodes,
+    followed by the names of the cluster-less nodes. It is only written when
+    it changed, and the file is replaced atomically.
+
+    Args:
+        path (str): Path of the state file
+
+    Attributes:
+        path (str): Path of the state file
+    """
+    def __init__(self, path):
+        self.path = path
+        self._changes = ChangeTracker()
+
+    def load(self):
+        """Read the saved state
+
+        Returns:
+            dict: The state, as written by save, or None if there is no state
+                file or it is not valid
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not _valid(state):
+            return None
+        return state
+
+    def save(self, clusters, clusterless):
+        """Save the state, if it changed
+
+        Args:
+            clusters (list of Cluster): The clusters
+            clusterless (list of Node): The cluster-less nodes
+
+        Returns:
+            bool: True if the state changed and was saved
+        """
+        state = {
+            'version': STATE_VERSION,
+            'clusters': [],
+            'clusterless': [node.name for node in clusterless]
+        }
+        for cluster in clusters:
+            entry = {
+                'cluster_id': cluster.cluster_id,
+                'master': None,
+                'timestamp': None,
+                'slaves': [node.name for node in cluster.slaves],
+                'lost': [node.name for node in cluster.lost]
+            }
+            if cluster.has_master:
+                entry['master'] = cluster.master.name
+                entry['timestamp'] = cluster.master.timestamp
+            state['clusters'].append(entry)
+        encoded = encode(state)
+        if not self._changes.changed('state', encoded):
+            return False
+        replace_file(self.path, encoded + "\n")
+        return True
+
+
+def _valid(state):
+    """Check that a state has the expected structure
+
+    Args:
+        state: The state, as read from the state file
+
+    Returns:
+        bool: True if the state can be restored
+    """
+    try:
+        if state['version'] != STATE_VERSION:
+            return False
+        for (index, cluster) in enumerate(state['clusters']):
+            # Cluster ids are positions in the list of clusters
+            if cluster['cluster_id'] != index:
+                return False
+            if not isinstance(cluster['slaves'], list):
+                return False
+            if not isinstance(cluster['lost'], list):
+                return False
+            if cluster['master'] is not None:
+                float(cluster['timestamp'])
+        return isinstance(state['clusterless'], list)
+    except (KeyError, IndexError, TypeError, ValueError):
+        return False
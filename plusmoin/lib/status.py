@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+class ChangeTracker(object):
+    """Tell whether some content changed since it was last reported
+
+    Content is tracked by key (eg. a cluster id), using a digest of its
+    serialized form.
+
+    Args:
+        keepalive (float, optional): If set, content is reported as changed
+            when it was last reported more than this many seconds ago, even
+            if it is identical. Defaults to None.
+        clock (callable, optional): Function returning the current time.
+            Defaults to time.time
+
+    Attributes:
+        keepalive (float): The keep-alive interval, or None
+    """
+    def __init__(self, keepalive=None, clock=time.time):
+        self.keepalive = keepalive
+        self._clock = clock
+        self._seen = {}
+
+    def changed(self, key, content):
+        """Check whether the content for a key changed, and record it
+
+        Args:
+            key: The key the content is tracked under
+            content (str): The serialized content
+
+        Returns:
+            bool: True if the content differs from the last reported content
+                for that key (or the keep-alive interval expired), in which
+                case it is recorded as reported.
+        """
+        digest = hashlib.sha1(content).hexdigest()
+        now = self._clock()
+        if key in self._seen:
+            (previous, reported) = self._seen[key]
+            if previous == digest and (not self.keepalive
+                                       or now - reported < self.keepalive):
+                return False
+        self._seen[key] = (digest, now)
+        return True
+
+
+class StatusPublisher(object):
+    """Publish the running status, when it changes
+
+    Each published status gets a new version number and a generation time,
+    which are added to the document. The last published status is also kept
+    in memory, along with the snapshot it was built from, and threads can
+    wait for the next one. The status file is replaced atomically
+    (by writing a temporary file and renaming it), so readers never see a
+    partially written file.
+
+    The version carries on from the status file left by a previous run, if
+    any, so it keeps increasing across restarts.
+
+    Args:
+        path (str): Path of the status file
+        etag_file (bool, optional): If True, the ETag of the current status is
+            also written to a sidecar file, `path` + '.etag', so readers can
+            tell whether the status changed without parsing it. Defaults to
+            False
+        clock (callable, optional): Function returning the current time.
+            Defaults to time.time
+
+    Attributes:
+        path (str): Path of the status file
+        version (int): Version of the last published status
+        generated_at (float): Time at which the last status was published
+        document (str): The last published status document, or None
+        etag (str): ETag of the last published status, or None
+        snapshot (Snapshot): The snapshot the last status was built from, or
+            None
+    """
+    def __init__(self, path, etag_file=False, clock=time.time):
+        self.path = path
+        self.etag_file = etag_file
+        self.version = 0
+        self.generated_at = None
+        self.document = None
+        self.etag = None
+        self.snapshot = None
+        self._clock = clock
+        self._published = threading.Condition()
+        self._changes = ChangeTracker()
+        try:
+            with open(path) as f:
+                self.version = int(json.load(f).get('version', 0))
+        except (IOError, ValueError, TypeError, AttributeError):
+            pass
+
+    def publish(self, status, snapshot=None):
+        """Publish the given status, if it changed
+
+        Args:
+            status (str): The status, as an encoded JSON object, without
+                version or generation time
+            snapshot (Snapshot, optional): The snapshot the status was built
+                from. Defaults to None
+
+        Returns:
+            bool: True if the status changed and was published
+        """
+        if not self._changes.changed('status', status):
+            return False
+        version = self.version + 1
+        generated_at = self._clock()
+        document = '{{"version": {}, "generated_at": {!r}, {}'.format(
+            version, generated_at, status[1:]
+        )
+        etag = '"{}-{}"'.format(version, hashlib.sha1(status).hexdigest()[:16])
+        with self._published:
+            self.version = version
+            self.generated_at = generated_at
+            self.document = document
+            self.etag = etag
+            self.snapshot = snapshot
+            self._published.notify_all()
+        replace_file(self.path, document)
+        if self.etag_file:
+            replace_file(self.path + '.etag', etag + "\n")
+        return True
+
+    def current(self):
+        """Return the last published status
+
+        Returns:
+            tuple: (version, document, etag, snapshot) of the last published
+                status. The document is None if nothing was published yet.
+        """
+        with self._published:
+            return (self.version, self.document, self.etag, self.snapshot)
+
+    def wait(self, version, timeout):
+        """Wait until a status more recent than the given version is published
+
+        Args:
+            version (int): The version to wait past
+            timeout (float): Maximum time to wait, in seconds
+
+        Returns:
+            int: The version of the last published status
+        """
+        with self._published:
+            if self.version == version:
+                self._published.wait(timeout)
+            return self.version
+
+
+def replace_file(path, content):
+    """Atomically replace the content of a file
+
+    Args:
+        path (str): Path of the file
+        content (str): The new content
+    """
+    temp_path = path + '.tmp'
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.rename(temp_path, path)
@@ -0,0 +1,277 @@
+import hashlib
+import logging
+import re
+import socket
+import threading
+import time
+import urlparse
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
+
+from plusmoin.lib import metrics
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 512
+
+NODE_CHECK = re.compile(r'^/?node/(.+):(\d+)/(master|replica)$')
+
+
+def node_check(snapshot, check):
+    """Check whether a node currently has the given role
+
+    Args:
+        snapshot (Snapshot): The snapshot to check against
+        check (str): The check, of the form 'node/<host>:<port>/<role>' where
+            role is 'master' or 'replica'. The leading '/' is optional.
+
+    Returns:
+        bool: True if the node has the role, False if it does not, and None
+            if the check is invalid or the node is not known
+    """
+    match = NODE_CHECK.match(check)
+    if not match or snapshot is None:
+        return None
+    role = snapshot.role(match.group(1), int(match.group(2)))
+    if role is None:
+        return None
+    return role == match.group(3)
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """Answer requests for the running status
+
+    Responses carry an ETag, and requests with a matching If-None-Match
+    header get an empty 304 response. When a `wait` query parameter is given
+    with such a request, the response is held until the resource changes or
+    that many seconds have passed.
+    """
+    server_version = 'plusmoin'
+
+    def do_GET(self):
+        """Answer a GET request"""
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        try:
+            wait = float(query.get('wait', [0])[0])
+        except ValueError:
+            self._respond(400, 'Invalid wait parameter\n')
+            return
+        deadline = time.time() + min(max(wait, 0), self.server.max_wait)
+        etags = [e.strip() for e in
+                 self.headers.get('If-None-Match', '').split(',')]
+        while True:
+            (version, code, body, etag) = self.server.resource(url.path)
+            remaining = deadline - time.time()
+            if code != 200 or etag not in etags or remaining <= 0:
+                break
+            self.server.publisher.wait(version, remaining)
+        if code != 200:
+            self._respond(code, body)
+        elif etag in etags:
+            self._respond(304, None, etag)
+        elif url.path.startswith('/node/'):
+            self._respond(200, body, etag)
+        elif url.path == '/metrics':
+            self._respond(200, body, etag, 'text/plain; version=0.0.4')
+        else:
+            self._respond(200, body, etag, 'application/json')
+
+    def _respond(self, code, body, etag=None, content_type='text/plain'):
+        """Send a response
+
+        Args:
+            code (int): The HTTP status code
+            body (str): The response body, or None
+            etag (str, optional): The ETag of the body. Defaults to None
+            content_type (str, optional): The body's content type. Defaults
+                to 'text/plain'
+        """
+        self.send_response(code)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if body is None:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        accept = self.headers.get('Accept-Encoding', '')
+        if (etag is not None and len(body) >= GZIP_MIN_SIZE
+                and 'gzip' in accept):
+            body = self.server.compressed(etag, body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level, rather than on stderr"""
+        logger = logging.getLogger()
+        logger.debug("Status request from {}: {}".format(
+            self.client_address[0], format % args
+        ))
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    """HTTP server for the running status, served from memory
+
+    The following resources are available:
+        - `/` or `/status`: the whole status, as in the status file;
+        - `/clusters/<cluster_id>`: a single cluster;
+        - `/clusterless`: the list of cluster-less nodes;
+        - `/node/<host>:<port>/master` and `/node/<host>:<port>/replica`:
+          health checks for load balancers, answering 200 if the node
+          currently is a master (respectively an in-sync slave) and 503 if it
+          is not;
+        - `/metrics`: internal metrics, in the Prometheus text format.
+
+    Args:
+        address (tuple): The (host, port) to listen on
+        publisher (StatusPublisher): The publisher of the status to serve
+        max_wait (float, optional): Maximum time a request may wait for the
+            status to change, in seconds. Defaults to 60
+
+    Attributes:
+        publisher (StatusPublisher): The publisher of the status to serve
+        max_wait (float): Maximum time a request may wait for a change
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, publisher, max_wait=60):
+        HTTPServer.__init__(self, address, StatusRequestHandler)
+        self.publisher = publisher
+        self.max_wait = max_wait
+        self._compressed = {}
+        self._compressed_version = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start serving requests in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def resource(self, path):
+        """Return the resource at the given path
+
+        Args:
+            path (str): The path of the resource
+
+        Returns:
+            tuple: (version, code, body, etag) where version is the status
+                version the resource was taken from, code the HTTP status
+                code, body the response body and etag its ETag (or None if
+                the code is not 200)
+        """
+        (version, document, etag, snapshot) = self.publisher.current()
+        if path == '/metrics':
+            return (version, 200, metrics.registry.render(), None)
+        if document is None:
+            return (version, 503, 'Status not available yet\n', None)
+        if path in ('/', '/status'):
+            return (version, 200, document, etag)
+        if path.startswith('/node/'):
+            check = node_check(snapshot, path)
+            if check is None:
+                return (version, 404, 'Not found\n', None)
+            elif not check:
+                return (version, 503, 'down\n', None)
+            body = 'up\n'
+        elif snapshot is not None:
+            body = self._snapshot_resource(snapshot, path)
+        else:
+            body = None
+        if body is None:
+            return (version, 404, 'Not found\n', None)
+        return (version, 200, body,
+                '"{}"'.format(hashlib.sha1(body).hexdigest()[:16]))
+
+    def compressed(self, etag, body):
+        """Return the gzip compressed body, compressing it once per version
+
+        Args:
+            etag (str): The ETag of the body
+            body (str): The body
+
+        Returns:
+            str: The compressed body
+        """
+        with self._lock:
+            if self._compressed_version != self.publisher.version:
+                self._compressed = {}
+                self._compressed_version = self.publisher.version
+            if etag not in self._compressed:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+                self._compressed[etag] = (
+                    compressor.compress(body) + compressor.flush()
+                )
+            return self._compressed[etag]
+
+    def _snapshot_resource(self, snapshot, path):
+        """Return a resource built from the snapshot
+
+        Args:
+            snapshot (Snapshot): The snapshot
+            path (str): The path of the resource
+
+        Returns:
+            str: The resource body, or None if there is no such resource
+        """
+        if path == '/clusterless':
+            return snapshot.encoded_clusterless()
+        match = re.match(r'^/clusters/(\d+)$', path)
+        if match:
+            return snapshot.encoded_cluster(int(match.group(1)))
+        return None
+
+
+class AgentCheckHandler(StreamRequestHandler):
+    """Answer a HAProxy agent check
+
+    The check to run is read from the first line sent by HAProxy (set with
+    its `agent-send` option), of the form `node/<host>:<port>/<role>`. The
+    answer is 'up' if the node currently has that role, and 'down' if it does
+    not (or the check is invalid).
+    """
+    timeout = 5
+
+    def handle(self):
+        """Answer the check"""
+        try:
+            check = self.rfile.readline(1024).strip()
+        except socket.timeout:
+            check = ''
+        (version, document, etag, snapshot) = self.server.publisher.current()
+        if node_check(snapshot, check):
+            self.wfile.write("up\n")
+        else:
+            self.wfile.write("down\n")
+
+
+class AgentCheckServer(ThreadingMixIn, TCPServer):
+    """TCP server answering HAProxy agent checks from memory
+
+    Args:
+        address (tuple): The (host, port) to listen on
+        publisher (StatusPublisher): The publisher of the status to check
+            against
+
+    Attributes:
+        publisher (StatusPublisher): The publisher of the status to check
+            against
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, publisher):
+        TCPServer.__init__(self, address, AgentCheckHandler)
+        self.publisher = publisher
+
+    def start(self):
+        """Start serving checks in a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
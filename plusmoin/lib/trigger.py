@@ -1,21 +1,176 @@
+import errno
+import importlib
+import json
 import logging
+import os
+import select
 import shlex
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from subprocess32 import Popen, PIPE, STDOUT, TimeoutExpired
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
 
 from plusmoin.config import config
+from plusmoin.lib import metrics
+from plusmoin.lib.snapshot import Payload
+
+
+class TriggerPluginError(Exception):
+    """Exception raised when a trigger plugin cannot be loaded"""
+    pass
+
+
+_plugins = {}
+_plugin_pool = None
+
+
+def load_plugins():
+    """Load the trigger plugins
+
+    Plugins are Python callables invoked as plugin(name, data), where data is
+    the trigger's dictionary. They are loaded from the 'plusmoin.triggers'
+    entry points (the entry point name being the trigger name) when
+    setuptools is available, and from the 'module:function' specs in
+    config['trigger_plugins'].
+
+    Raises:
+        TriggerPluginError: If a plugin cannot be loaded
+    """
+    global _plugin_pool
+    plugins = {}
+    if pkg_resources is not None:
+        for entry_point in pkg_resources.iter_entry_points('plusmoin.triggers'):
+            try:
+                plugin = entry_point.load()
+            except ImportError as e:
+                raise TriggerPluginError(
+                    "Could not load plugin {}: {}".format(entry_point, str(e))
+                )
+            plugins.setdefault(entry_point.name, []).append(plugin)
+    for name, specs in config.get('trigger_plugins', {}).items():
+        if not isinstance(specs, list):
+            specs = [specs]
+        for spec in specs:
+            plugins.setdefault(name, []).append(_load_plugin(spec))
+    _plugins.clear()
+    _plugins.update(plugins)
+    if plugins and _plugin_pool is None:
+        _plugin_pool = ThreadPool(config.get('plugin_concurrency', 4))
+
+
+def _load_plugin(spec):
+    """Load a plugin from a 'module:function' spec
+
+    Args:
+        spec (str): The plugin spec
+
+    Returns:
+        callable: The plugin
+
+    Raises:
+        TriggerPluginError: If the plugin cannot be loaded
+    """
+    try:
+        (module_name, function_name) = spec.split(':')
+        module = importlib.import_module(module_name)
+        return getattr(module, function_name)
+    except (ValueError, ImportError, AttributeError) as e:
+        raise TriggerPluginError("Could not load plugin {}: {}".format(
+            spec, str(e)
+        ))
+
+
+def has_trigger(name):
+    """Return whether a plugin or a script is configured for a trigger
+
+    Args:
+        name (str): Name of the trigger
+
+    Returns:
+        bool: True if running the trigger would run a plugin or a script
+    """
+    return bool(_plugins.get(name) or config['triggers'].get(name))
 
 
 def trigger(name, data):
     """Runs the named trigger with given active node and cluster
 
+    The trigger's plugins are run first, followed by its script.
+
     Args:
         name (str): Name of the trigger
-        data (str): Data to send to the trigger
+        data (dict or Payload): Data to send to the trigger. Plugins receive
+            it as a dictionary, and must not modify it. Scripts receive it
+            encoded as JSON; a Payload's existing encoding is used as is.
+
+    Returns:
+        bool: False if the trigger failed, True otherwise (including when no
+            plugin or script is configured for the trigger)
     """
-    logger = logging.getLogger()
+    if isinstance(data, Payload):
+        (data, encoded) = (data.data, data.encoded)
+    else:
+        encoded = None
+    success = True
+    for plugin in _plugins.get(name, []):
+        success = _run_plugin(name, plugin, data) and success
     if name not in config['triggers'] or config['triggers'][name] is None:
-        return
+        return success
+    if encoded is None:
+        encoded = json.dumps(data)
+    if name in config.get('persistent_triggers', []):
+        return _get_worker(name).send(encoded) and success
+    return _run_script(name, encoded) and success
+
+
+def _run_plugin(name, plugin, data):
+    """Run a trigger plugin in the plugin thread pool
+
+    Args:
+        name (str): Name of the trigger
+        plugin (callable): The plugin
+        data (dict): Data to send to the plugin
+
+    Returns:
+        bool: True if the plugin ran without raising an exception, within
+            the trigger timeout
+    """
+    logger = logging.getLogger()
+    result = _plugin_pool.apply_async(plugin, (name, data))
+    try:
+        result.get(config['trigger_timeout'])
+    except TimeoutError:
+        logger.error("Trigger {} with plugin {} timed out".format(
+            name, getattr(plugin, '__name__', plugin)
+        ))
+        return False
+    except Exception:
+        logger.error("Trigger {} with plugin {} failed: {}".format(
+            name, getattr(plugin, '__name__', plugin), traceback.format_exc()
+        ))
+        return False
+    return True
+
+
+def _run_script(name, data):
+    """Run the named trigger's script
+
+    Args:
+        name (str): Name of the trigger
+        data (str): Data to send to the script
+
+    Returns:
+        bool: False if the script failed, True otherwise
+    """
+    logger = logging.getLogger()
     command = shlex.split(config['triggers'][name])
     try:
         proc = Popen(command, stdout=PIPE, stdin=PIPE, stderr=STDOUT)
@@ -24,7 +179,7 @@ def trigger(name, data):
             "Could not execute trigger {} with script {}: {}".format(
                 name, config['triggers'][name], str(e)
             ))
-        return
+        return False
     try:
         (output, _) = proc.communicate(data, timeout=config['trigger_timeout'])
     except TimeoutExpired:
@@ -33,10 +188,358 @@ def trigger(name, data):
         logger.error("Trigger {} with script {} timed out".format(
             name, config['triggers'][name]
         ))
-        return
+        return False
     if proc.returncode != 0:
         logger.error(
             ("Trigger {} with script {} exited with status code {}." +
              "Output: {}").format(name, config['triggers'][name],
                                   proc.returncode, output)
         )
+        return False
+    return True
+
+
+class TriggerWorker(object):
+    """A long running trigger script, fed one event per line
+
+    The script is started on the first event, and kept running. Each event
+    is written to its stdin as a single line of JSON, and the script must
+    answer each event with a single line of JSON on its stdout: {"ok": true}
+    on success, or {"ok": false, "error": <message>} on failure.
+
+    Only one event is sent at a time, so callers wait (and triggers queue up)
+    while the script is busy. If the script exits, fails to answer in time or
+    sends an invalid answer, it is stopped and started again on the next
+    event.
+
+    Args:
+        name (str): Name of the trigger
+        command (str): Shell command to run
+        timeout (float): Time allowed for the script to answer an event
+
+    Attributes:
+        name (str): Name of the trigger
+        command (str): Shell command to run
+        timeout (float): Time allowed for the script to answer an event
+        restarts (int): Number of times the script was (re)started
+    """
+    def __init__(self, name, command, timeout):
+        self.name = name
+        self.command = command
+        self.timeout = timeout
+        self.restarts = 0
+        self._proc = None
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        """Send an event to the script and wait for the answer
+
+        Args:
+            data (str): The event, as a JSON string without newlines
+
+        Returns:
+            bool: True if the script acknowledged the event
+        """
+        logger = logging.getLogger()
+        with self._lock:
+            try:
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                self._proc.stdin.write(data + '\n')
+                self._proc.stdin.flush()
+                line = self._readline(time.time() + self.timeout)
+            except (OSError, IOError) as e:
+                logger.error("Trigger worker {} with script {} failed: {}".format(
+                    self.name, self.command, str(e)
+                ))
+                self.stop()
+                return False
+            try:
+                answer = json.loads(line)
+                ok = answer['ok']
+            except (ValueError, TypeError, KeyError):
+                logger.error(
+                    "Trigger worker {} with script {} sent an invalid "
+                    "answer: {}".format(self.name, self.command, line)
+                )
+                self.stop()
+                return False
+            if not ok:
+                logger.error("Trigger {} with script {} failed: {}".format(
+                    self.name, self.command, answer.get('error')
+                ))
+            return bool(ok)
+
+    def retire(self):
+        """Stop the script once the event being sent, if any, was answered"""
+        with self._lock:
+            self.stop()
+
+    def stop(self):
+        """Stop the script, if it is running"""
+        proc = self._proc
+        self._proc = None
+        self._buffer = ''
+        if proc is None:
+            return
+        for stream in (proc.stdin, proc.stdout):
+            try:
+                stream.close()
+            except (OSError, IOError):
+                pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+    def _start(self):
+        """Start the script"""
+        self.stop()
+        self._proc = Popen(
+            shlex.split(self.command), stdin=PIPE, stdout=PIPE, bufsize=0
+        )
+        self.restarts += 1
+
+    def _readline(self, deadline):
+        """Read a line from the script's stdout
+
+        Args:
+            deadline (float): Time by which the line must have been read
+
+        Returns:
+            str: The line, without the trailing newline
+
+        Raises:
+            IOError: If the script closes stdout, or the deadline passes
+        """
+        fd = self._proc.stdout.fileno()
+        while '\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise IOError(errno.ETIMEDOUT, 'Timed out')
+            (readable, _, _) = select.select([fd], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise IOError(errno.EPIPE, 'Script closed its output')
+            self._buffer += chunk
+        (line, self._buffer) = self._buffer.split('\n', 1)
+        return line
+
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def _get_worker(name):
+    """Return the worker for the named trigger, creating it if needed
+
+    A worker whose command or timeout no longer match the configuration (as
+    after a reload) is replaced by a new one.
+
+    Args:
+        name (str): Name of the trigger
+
+    Returns:
+        TriggerWorker: The worker
+    """
+    retired = None
+    with _workers_lock:
+        worker = _workers.get(name)
+        if worker is not None and (
+                worker.command != config['triggers'][name]
+                or worker.timeout != config['trigger_timeout']):
+            (retired, worker) = (worker, None)
+        if worker is None:
+            worker = TriggerWorker(
+                name, config['triggers'][name], config['trigger_timeout']
+            )
+            _workers[name] = worker
+    if retired is not None:
+        retired.retire()
+    return worker
+
+
+class TriggerExecutor(object):
+    """Run triggers from a pool of worker threads
+
+    Triggers are queued under a key (the cluster id). Triggers queued under
+    different keys run in parallel, while triggers queued under the same key
+    run one after the other, in the order they were submitted.
+
+    Triggers that only describe the current state (such as
+    plusmoin_heartbeat) are coalesced: when one is submitted while another
+    of the same name is still waiting under the same key, the waiting one is
+    dropped. This keeps the queue from growing without bounds behind a slow
+    script, as only transitions are then left to queue up.
+
+    Args:
+        concurrency (int): Number of worker threads
+        run (callable, optional): Function invoked as run(name, data) to
+            run a trigger. Defaults to plusmoin.lib.trigger.trigger
+        coalesce (tuple of str, optional): Names of the triggers to
+            coalesce. Defaults to ('plusmoin_heartbeat',)
+
+    Attributes:
+        concurrency (int): Number of worker threads
+    """
+    def __init__(self, concurrency, run=trigger,
+                 coalesce=('plusmoin_heartbeat',)):
+        self.concurrency = concurrency
+        self._run = run
+        self._coalesce = frozenset(coalesce)
+        self._queues = {}
+        self._ready = deque()
+        self._lock = threading.Condition()
+        self._stats = {
+            'queued': 0,
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'dropped': 0,
+            'total_queue_time': 0.0,
+            'max_queue_time': 0.0,
+            'total_run_time': 0.0,
+            'max_run_time': 0.0
+        }
+        for i in range(max(1, concurrency)):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, key, name, data):
+        """Queue a trigger
+
+        Args:
+            key: Triggers with the same key run in submission order
+            name (str): Name of the trigger
+            data (str): Data to send to the trigger
+        """
+        with self._lock:
+            self._stats['queued'] += 1
+            if key in self._queues:
+                # Already queued, or running; the worker will pick this up.
+                queue = self._queues[key]
+                if name in self._coalesce:
+                    self._drop_waiting(queue, name)
+                queue.append((name, data, time.time()))
+                self._set_gauges()
+                return
+            self._set_gauges()
+            self._queues[key] = deque([(name, data, time.time())])
+            self._ready.append(key)
+            self._lock.notify()
+
+    def stats(self):
+        """Return queue depth and latency metrics
+
+        Returns:
+            dict: A dictionary defining: {
+                    'queued': Number of triggers waiting to run,
+                    'running': Number of triggers currently running,
+                    'completed': Number of triggers that ran,
+                    'failed': Number of triggers that failed,
+                    'dropped': Number of triggers dropped in favour of a
+                        more recent one,
+                    'total_queue_time': Total time triggers spent queued,
+                    'max_queue_time': Longest time a trigger was queued,
+                    'total_run_time': Total time spent running triggers,
+                    'max_run_time': Longest time a trigger ran for
+                }
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def join(self, timeout=None):
+        """Wait until all queued triggers have run
+
+        Args:
+            timeout (float, optional): Maximum time to wait, in seconds.
+                Defaults to None (no limit)
+
+        Returns:
+            bool: True if all triggers have run
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._queues:
+                if deadline is None:
+                    self._lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._lock.wait(remaining)
+            return True
+
+    def _worker(self):
+        """Worker thread: run triggers for one key at a time"""
+        while True:
+            with self._lock:
+                while not self._ready:
+                    self._lock.wait()
+                key = self._ready.popleft()
+                (name, data, submitted) = self._queues[key][0]
+                started = time.time()
+                self._stats['queued'] -= 1
+                self._stats['running'] += 1
+                self._add_time('queue_time', started - submitted)
+                metrics.trigger_queue_seconds.observe(started - submitted,
+                                                      trigger=name)
+                self._set_gauges()
+            success = False
+            try:
+                success = self._run(name, data)
+            except Exception:
+                logger = logging.getLogger()
+                logger.exception("Trigger {} raised an exception".format(name))
+            with self._lock:
+                self._stats['running'] -= 1
+                self._stats['completed'] += 1
+                if not success:
+                    self._stats['failed'] += 1
+                    metrics.trigger_failures.inc(trigger=name)
+                run_time = time.time() - started
+                self._add_time('run_time', run_time)
+                metrics.trigger_seconds.observe(run_time, trigger=name)
+                self._set_gauges()
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._lock.notify_all()
+
+    def _drop_waiting(self, queue, name):
+        """Drop the last waiting trigger of the given name from a queue. Must
+        be called with the lock held.
+
+        Args:
+            queue (deque): The queue of a key. Its first trigger may be
+                running, and is never dropped
+            name (str): Name of the trigger
+        """
+        for i in range(len(queue) - 1, 0, -1):
+            if queue[i][0] == name:
+                del queue[i]
+                self._stats['queued'] -= 1
+                self._stats['dropped'] += 1
+                metrics.triggers_dropped.inc(trigger=name)
+                return
+
+    def _add_time(self, name, value):
+        """Record a time metric. Must be called with the lock held.
+
+        Args:
+            name (str): Name of the metric, 'queue_time' or 'run_time'
+            value (float): The time to record, in seconds
+        """
+        self._stats['total_' + name] += value
+        self._stats['max_' + name] = max(self._stats['max_' + name], value)
+
+    def _set_gauges(self):
+        """Set the queue depth gauges. Must be called with the lock held."""
+        metrics.triggers.set(self._stats['queued'], state='queued')
+        metrics.triggers.set(self._stats['running'], state='running')
@@ -1,28 +1,136 @@
+import logging
+import signal
+import threading
 import time
-import json
 
-from plusmoin.config import config
+from plusmoin.config import config, reload_config, ConfigRequired
 from plusmoin.lib.node import Node
 from plusmoin.lib.cluster import Cluster
-from plusmoin.lib.db import DbError
-from plusmoin.lib.trigger import trigger
+from plusmoin.lib import db
+from plusmoin.lib.db import DbError, heartbeat_timestamp
+from plusmoin.lib.events import EventLog
+from plusmoin.lib.heartbeat import HeartbeatWriter
+from plusmoin.lib import metrics
+from plusmoin.lib.probe import probe_nodes, write_heartbeats
+from plusmoin.lib.nonblocking import NonBlockingProber
+from plusmoin.lib.scheduler import Scheduler
+from plusmoin.lib.snapshot import Snapshot
+from plusmoin.lib.state import StateFile
+from plusmoin.lib.status import ChangeTracker, StatusPublisher
+from plusmoin.lib.status_server import AgentCheckServer, StatusServer
+from plusmoin.lib.trigger import TriggerExecutor, TriggerPluginError
+from plusmoin.lib.trigger import has_trigger, load_plugins
+
+
+# Triggers run on node transitions, in the order they are listed in
+# cluster_events batches.
+EVENT_TRIGGERS = ['master_down', 'master_up', 'slave_down', 'slave_up']
 
 
 class Plusmoin(object):
-    """Represents the running service"""
-    def __init__(self, nodes, max_sync_delay, recover_sync_delay):
+    """Represents the running service
+
+    Args:
+        nodes (list of Node): The nodes to manage
+        max_sync_delay (int): Maximum sync delay between master and slave
+        recover_sync_delay (int): Maximum sync delay between master and slave
+            for a node to come back up.
+        probe_concurrency (int, optional): Maximum number of nodes to probe
+            at the same time when using the 'threads' engine. Defaults to 1.
+        engine (str, optional): How nodes are probed. One of 'threads'
+            (blocking connections probed from a pool of threads) or 'poll'
+            (non-blocking connections all probed from the main thread).
+            Defaults to 'threads'.
+        probe_timeout (float, optional): Maximum time, in seconds, a single
+            probe (or a master's heartbeat write) may take before the node is
+            considered lost. Defaults to None (no limit).
+        max_sync_bytes (int, optional): Maximum replay lag between master
+            and slave, in bytes. Defaults to None (no limit).
+        recover_sync_bytes (int, optional): Maximum replay lag between master
+            and slave, in bytes, for a node to come back up. Defaults to None
+            (no limit).
+        external_heartbeat (bool, optional): If True, the masters'
+            heartbeats are written by a HeartbeatWriter rather than on each
+            update. Defaults to False.
+        state (dict, optional): A saved state, as loaded by
+            StateFile.load, to restore the clusters from instead of
+            discovering them. Defaults to None.
+        sync_poll_interval (float, optional): When discovering the clusters,
+            how often the slaves are probed while waiting for them to
+            replicate their master's first heartbeat, in seconds. Defaults
+            to 1.
+        discovery (bool, optional): If True, replicas listed by the masters'
+            probes (see `discovery` in the configuration) that are not
+            managed yet are added on each update. Defaults to False.
+        forget_after (int, optional): With discovery, number of updates in a
+            row after which a discovered node that no master lists is
+            removed. Defaults to None (never).
+
+    Attributes:
+        clusters (list of Cluster): The clusters
+        clusterless (list of Node): The nodes that do not belong to a cluster
+        transitions (list of tuple): The transitions of the last update (or
+            of the startup), in the order they happened, as tuples of
+            (event name, Node, Cluster). Besides the node triggers, events
+            are 'node_out' (a node left its cluster and became cluster-less),
+            'cluster_created', 'node_assigned' (a cluster-less node was
+            added to a cluster), 'node_added' and 'node_removed' (the node
+            was added to or removed from the configuration, or forgotten
+            after it was discovered) and 'node_discovered' (the node was
+            listed as a replica by the cluster's master).
+        startup_triggers (dict): The triggers to run for the transitions
+            found while restoring a saved state, as returned by update_nodes.
+            Empty lists when starting without a saved state.
+        sync_times (dict): When discovering the clusters, the time each
+            slave took to replicate its master's first heartbeat, in
+            seconds, by node name. None for slaves that did not within
+            max_sync_delay.
+
+    Raises:
+        ValueError: If the engine is unknown
+    """
+    def __init__(self, nodes, max_sync_delay, recover_sync_delay,
+                 probe_concurrency=1, engine='threads', probe_timeout=None,
+                 max_sync_bytes=None, recover_sync_bytes=None,
+                 external_heartbeat=False, state=None,
+                 sync_poll_interval=1, discovery=False, forget_after=None):
         self.max_sync_delay = max_sync_delay
         self.recover_sync_delay = recover_sync_delay
+        self.max_sync_bytes = max_sync_bytes
+        self.recover_sync_bytes = recover_sync_bytes
+        self.external_heartbeat = external_heartbeat
+        self.probe_concurrency = probe_concurrency
+        self.probe_timeout = probe_timeout
+        self.sync_poll_interval = sync_poll_interval
+        self.discovery = discovery
+        self.forget_after = forget_after
+        self._discovered = {}
+        if engine == 'poll':
+            self._prober = NonBlockingProber()
+        elif engine == 'threads':
+            self._prober = None
+        else:
+            raise ValueError("Unknown engine {}".format(engine))
         self.clusters = []
         self.clusterless = []
+        self.transitions = []
+        self.startup_triggers = dict((trg, []) for trg in EVENT_TRIGGERS)
+        self.sync_times = {}
+        if state is not None:
+            self._restore(nodes, state)
+            return
         (masters, slaves, self.clusterless) = self._partition_nodes(nodes)
         self._create_clusters(masters)
-        time.sleep(self.max_sync_delay)
+        self._wait_for_sync(slaves)
         self._assign_slaves(slaves, by_name=True)
 
     def update_nodes(self):
         """ Refresh all nodes and move them around accordingly
 
+        All the nodes are probed concurrently first, and the heartbeat of
+        the current masters is written to all of them at once. The clusters
+        are then updated one after the other from those results.
+
         Returns:
             dict: A dict defining the triggers to invoke for given clusters, eg.
                 {
@@ -33,43 +141,337 @@ class Plusmoin(object):
                     ...
                 }
         """
-        triggers = {
-            'master_down': [],
-            'master_up': [],
-            'slave_down': [],
-            'slave_up': []
-        }
+        triggers = dict((trg, []) for trg in EVENT_TRIGGERS)
+
+        self.transitions = []
+
+        # Probe all the nodes
+        probes = self._probe_nodes(self.nodes)
+        heartbeats = self._write_master_heartbeats(probes)
 
         # Update all the clusters
         for cluster in self.clusters:
-            status = cluster.update_cluster()
+            status = cluster.update_cluster(probes, self.probe_timeout,
+                                            heartbeats)
             self.clusterless += status['out']
+            for node in status['out']:
+                self.transitions.append(('node_out', node, cluster))
+            events = []
             if status['master_down']:
-                triggers['master_down'].append(
-                    (status['master_down'], cluster)
-                )
+                events.append(('master_down', status['master_down']))
             if status['master_up']:
-                triggers['master_up'].append((status['master_up'], cluster))
-            for node in status['slaves_down']:
-                triggers['slave_down'].append((node, cluster))
-            for node in status['slaves_up']:
-                triggers['slave_up'].append((node, cluster))
+                events.append(('master_up', status['master_up']))
+            events += [('slave_down', node) for node in status['slaves_down']]
+            events += [('slave_up', node) for node in status['slaves_up']]
+            for (trg, node) in events:
+                triggers[trg].append((node, cluster))
+                self.transitions.append((trg, node, cluster))
+
+        if self.discovery:
+            self._discover_replicas()
 
         # Create new clusters for each working master in clusterless
         (masters, slaves, self.clusterless) = self._partition_nodes(
-            self.clusterless
+            self.clusterless, probes
         )
         self._create_clusters(masters)
         self._assign_slaves(slaves)
         return triggers
 
-    def _partition_nodes(self, nodes):
+    def set_nodes(self, addresses):
+        """Change the nodes managed by this service
+
+        Nodes that are not managed yet start as cluster-less, and are moved
+        to a cluster by the next update like any other cluster-less node.
+        Nodes that are no longer listed (and were not discovered) are removed
+        from their cluster (or from the cluster-less nodes), and their
+        connections are closed. Clusters whose nodes did not change keep
+        their state.
+
+        The changes are recorded in transitions.
+
+        Args:
+            addresses (list of tuple): The (host, port) of the nodes to
+                manage
+
+        Returns:
+            tuple: The lists of (added, removed) nodes
+        """
+        self.transitions = []
+        wanted = set(addresses) | set(self._discovered)
+        removed = [n for n in self.nodes if (n.host, n.port) not in wanted]
+        self._remove_nodes(removed)
+
+        managed = set((node.host, node.port) for node in self.nodes)
+        added = []
+        for (host, port) in addresses:
+            # Discovered nodes that are now configured are never forgotten
+            self._discovered.pop((host, port), None)
+            if (host, port) not in managed:
+                managed.add((host, port))
+                added.append(Node(host, port))
+                self.transitions.append(('node_added', added[-1], None))
+        self.clusterless += added
+        return (added, removed)
+
+    def _remove_nodes(self, nodes):
+        """Stop managing the given nodes, and close their connections
+
+        The removals are recorded in transitions.
+
+        Args:
+            nodes (list of Node): The nodes to remove
+        """
+        if not nodes:
+            return
+        removed = set(nodes)
+
+        def keep(members, cluster):
+            kept = []
+            for node in members:
+                if node in removed:
+                    self.transitions.append(('node_removed', node, cluster))
+                else:
+                    kept.append(node)
+            return kept
+
+        for cluster in self.clusters:
+            if cluster.has_master and not keep([cluster.master], cluster):
+                cluster.master = None
+            cluster.slaves = keep(cluster.slaves, cluster)
+            cluster.lost = keep(cluster.lost, cluster)
+        self.clusterless = keep(self.clusterless, None)
+        for node in nodes:
+            self._discovered.pop((node.host, node.port), None)
+            db.pool.close(node.host, node.port)
+            if self._prober is not None:
+                self._prober.close(node)
+
+    def _discover_replicas(self):
+        """Add the replicas listed by the masters that are not managed yet
+
+        New replicas start as cluster-less, and are moved to their cluster by
+        the end of the update. With forget_after, discovered nodes that no
+        master listed for that many updates in a row are removed again.
+        Nodes from the configuration, masters and the members of a cluster
+        that has no master are never removed.
+
+        The changes are recorded in transitions.
+        """
+        managed = dict(((n.host, n.port), n) for n in self.nodes)
+        listed = set()
+        for cluster in self.clusters:
+            if not cluster.has_master or cluster.master.replicas is None:
+                continue
+            for address in cluster.master.replicas:
+                listed.add(address)
+                if address in managed:
+                    continue
+                node = Node(*address)
+                managed[address] = node
+                self._discovered[address] = 0
+                self.clusterless.append(node)
+                self.transitions.append(('node_discovered', node, cluster))
+        if not self.forget_after:
+            return
+        for cluster in self.clusters:
+            # A promoted replica is no longer listed by anyone, and a cluster
+            # without a master has nobody to list its replicas
+            if cluster.has_master:
+                members = [cluster.master]
+            else:
+                members = cluster.slaves + cluster.lost
+            listed.update((n.host, n.port) for n in members)
+        gone = []
+        for address in self._discovered:
+            if address in listed:
+                self._discovered[address] = 0
+            else:
+                self._discovered[address] += 1
+                if self._discovered[address] >= self.forget_after:
+                    gone.append(managed[address])
+        self._remove_nodes(gone)
+
+    def set_thresholds(self, max_sync_delay, recover_sync_delay,
+                       max_sync_bytes=None, recover_sync_bytes=None):
+        """Change the sync thresholds, for all clusters
+
+        Args:
+            max_sync_delay (int): Maximum sync delay between master and slave
+            recover_sync_delay (int): Maximum sync delay between master and
+                slave for a node to come back up.
+            max_sync_bytes (int, optional): Maximum replay lag between master
+                and slave, in bytes. Defaults to None (no limit).
+            recover_sync_bytes (int, optional): Maximum replay lag between
+                master and slave, in bytes, for a node to come back up.
+                Defaults to None (no limit).
+        """
+        self.max_sync_delay = max_sync_delay
+        self.recover_sync_delay = recover_sync_delay
+        self.max_sync_bytes = max_sync_bytes
+        self.recover_sync_bytes = recover_sync_bytes
+        for cluster in self.clusters:
+            cluster.max_sync_delay = max_sync_delay
+            cluster.recover_sync_delay = recover_sync_delay
+            cluster.max_sync_bytes = max_sync_bytes
+            cluster.recover_sync_bytes = recover_sync_bytes
+
+    @property
+    def masters(self):
+        """The masters of all clusters
+
+        Returns:
+            list of Node: The master of each cluster that has one
+        """
+        return [c.master for c in self.clusters if c.has_master]
+
+    @property
+    def nodes(self):
+        """All the nodes managed by this service
+
+        Returns:
+            list of Node: Masters, slaves and lost nodes of every cluster,
+                followed by the clusterless nodes
+        """
+        nodes = []
+        for cluster in self.clusters:
+            if cluster.has_master:
+                nodes.append(cluster.master)
+            nodes += cluster.slaves
+            nodes += cluster.lost
+        return nodes + self.clusterless
+
+    def _probe_nodes(self, nodes):
+        """Probe the given nodes using the configured engine
+
+        Args:
+            nodes (list of Node): The nodes to probe
+
+        Returns:
+            dict: Dictionary of Node to ProbeResult
+        """
+        if self._prober is not None:
+            results = self._prober.probe_nodes(nodes)
+        else:
+            results = probe_nodes(nodes, self.probe_concurrency,
+                                  self.probe_timeout)
+        for (node, result) in results.items():
+            if result.error is not None:
+                metrics.db_errors.inc(node=node.name, operation='probe')
+        return results
+
+    def _restore(self, nodes, state):
+        """Restore the clusters from a saved state, and check them
+
+        The clusters are set up as they were saved, with each master's last
+        heartbeat, so slaves are measured against what their master last
+        wrote before the restart. A normal update then checks the restored
+        clusters against a single probe round of all the nodes, and its
+        triggers are kept in startup_triggers. Nodes that are not in the
+        saved state start as cluster-less; nodes that are no longer
+        configured are dropped.
+
+        Args:
+            nodes (list of Node): The nodes to manage
+            state (dict): The saved state
+        """
+        by_name = dict((node.name, node) for node in nodes)
+        placed = set()
+
+        def take(names):
+            found = []
+            for name in names:
+                if name in by_name and name not in placed:
+                    placed.add(name)
+                    found.append(by_name[name])
+            return found
+
+        for entry in state['clusters']:
+            cluster = Cluster(
+                cluster_id=len(self.clusters),
+                max_sync_delay=self.max_sync_delay,
+                recover_sync_delay=self.recover_sync_delay,
+                max_sync_bytes=self.max_sync_bytes,
+                recover_sync_bytes=self.recover_sync_bytes,
+                external_heartbeat=self.external_heartbeat
+            )
+            for master in take([entry['master']] if entry['master'] else []):
+                master.cluster_id = cluster.cluster_id
+                master.timestamp = entry['timestamp']
+                cluster.master = master
+            cluster.slaves = take(entry['slaves'])
+            cluster.lost = take(entry['lost'])
+            self.clusters.append(cluster)
+        self.clusterless = [n for n in nodes if n.name not in placed]
+        # The heartbeat writer has not run while we were down, so the masters
+        # get their heartbeat written by this first update.
+        for cluster in self.clusters:
+            cluster.external_heartbeat = False
+        self.startup_triggers = self.update_nodes()
+        for cluster in self.clusters:
+            cluster.external_heartbeat = self.external_heartbeat
+
+    def _wait_for_sync(self, slaves):
+        """Wait for the slaves to replicate their master's first heartbeat
+
+        The slaves are probed concurrently, every sync_poll_interval seconds,
+        until each of them names one of the new masters and has replicated
+        the heartbeat written by _create_clusters, or stopped waiting for it
+        (because it could not be probed or was promoted), or until
+        max_sync_delay has passed. Slaves that have no heartbeat information
+        yet, or still name a previous master, are polled as well: their
+        information changes once they replicate the first heartbeat. The time
+        each slave took is recorded in sync_times.
+
+        Args:
+            slaves (list of Node): The slaves, as partitioned at startup
+        """
+        started = time.time()
+        deadline = started + self.max_sync_delay
+        masters = dict((c.master.name, c.master) for c in self.clusters)
+        pending = list(slaves)
+        for node in pending:
+            self.sync_times[node.name] = None
+        while pending:
+            probes = self._probe_nodes(pending)
+            now = time.time()
+            waiting = []
+            for node in pending:
+                probe = probes[node]
+                if probe.error is not None and not probe.no_heartbeat:
+                    continue
+                if not node.is_slave:
+                    continue
+                master = masters.get(node.master_name)
+                if (probe.no_heartbeat or master is None
+                        or node.timestamp < master.timestamp):
+                    waiting.append(node)
+                else:
+                    self.sync_times[node.name] = now - started
+                    metrics.startup_sync_seconds.set(now - started,
+                                                     node=node.name)
+            pending = waiting
+            if not pending or now >= deadline:
+                break
+            time.sleep(min(self.sync_poll_interval, deadline - now))
+        logger = logging.getLogger()
+        for node in pending:
+            logger.warning("Slave {} did not sync within {}s".format(
+                node.name, self.max_sync_delay
+            ))
+        logger.info("Slaves synced in {:.3f}s".format(time.time() - started))
+
+    def _partition_nodes(self, nodes, probes=None):
         """Partition nodes into masters, slaves and clusterless nodes.
 
-        This will invoke refresh_role on all nodes.
+        This will probe all the nodes that do not have a probe result. Slaves
+        that answered but have no heartbeat information yet are partitioned
+        as slaves.
 
         Args:
             nodes (list of Node): The nodes to partition
+            probes (dict, optional): Dictionary of Node to ProbeResult for
+                nodes that have already been probed. Defaults to None.
 
         Returns:
             Tuple of lists (masters, slaves, clusterless)
@@ -77,41 +479,78 @@ class Plusmoin(object):
         slaves = []
         masters = []
         lost = []
+        probes = dict(probes or {})
+        probes.update(self._probe_nodes(
+            [node for node in nodes if node not in probes]
+        ))
         for node in nodes:
-            try:
-                node.refresh_role()
-                if node.is_slave:
-                    slaves.append(node)
-                else:
-                    masters.append(node)
-            except DbError:
+            probe = probes[node]
+            if probe.error is not None and not probe.no_heartbeat:
                 lost.append(node)
+            elif node.is_slave:
+                slaves.append(node)
+            else:
+                masters.append(node)
         return masters, slaves, lost
 
+    def _write_master_heartbeats(self, probes):
+        """Write the heartbeat of the clusters' current masters concurrently
+
+        Only masters which answered their probe and are still masters are
+        written to, unless their heartbeat is written by the heartbeat
+        writer.
+
+        Args:
+            probes (dict): Dictionary of Node to ProbeResult
+
+        Returns:
+            dict: Dictionary of Node to the DbError raised while writing to
+                it, or None if the write succeeded
+        """
+        masters = []
+        for cluster in self.clusters:
+            if not cluster.has_master or cluster.external_heartbeat:
+                continue
+            probe = probes.get(cluster.master)
+            if (probe is not None and probe.error is None
+                    and not cluster.master.is_slave):
+                masters.append(cluster.master)
+        return write_heartbeats(masters, heartbeat_timestamp(),
+                                self.probe_timeout)
+
     def _create_clusters(self, nodes):
         """ Create new clusters from the given list of masters
 
         Notes:
-            - This will invoke update_heartbeat on all the masters, so the
+            - This will write a heartbeat to all the masters, so the
               cluster will only be created if the right cluster_id is entered
               in the database;
-            - Nodes that fail to run update_heartbeat are added to the
-              clusterless nodes.
+            - Nodes that fail to write the heartbeat, or take longer than
+              probe_timeout to do so, are added to the clusterless nodes.
 
         Args:
             nodes (list of Node): Master nodes to create the clusters from
         """
-        timestamp = int(time.time())
+        timestamp = heartbeat_timestamp()
         for node in nodes:
             node.cluster_id = len(self.clusters)
             try:
-                node.update_heartbeat(timestamp)
+                error = write_heartbeats([node], timestamp,
+                                         self.probe_timeout)[node]
+                if error is not None:
+                    raise error
                 self.clusters.append(Cluster(
                     cluster_id=len(self.clusters),
                     max_sync_delay=self.max_sync_delay,
                     recover_sync_delay=self.recover_sync_delay,
-                    master=node
+                    master=node,
+                    max_sync_bytes=self.max_sync_bytes,
+                    recover_sync_bytes=self.recover_sync_bytes,
+                    external_heartbeat=self.external_heartbeat
                 ))
+                self.transitions.append(
+                    ('cluster_created', node, self.clusters[-1])
+                )
             except DbError:
                 self.clusterless.append(node)
 
@@ -130,6 +569,9 @@ class Plusmoin(object):
                 won't be meaningful. But in all other cases, the cluster id
                 should be used to ensure clusters remain grouped. Defaults to
                 False.
+
+        When starting up, the slaves' information must be fresh (see
+        _wait_for_sync) rather than that fetched while partitioning them.
         """
         # Prepare a name index if needed
         if by_name:
@@ -138,62 +580,331 @@ class Plusmoin(object):
                 clusters_by_name[cluster.master.name] = cluster
         # Assign slaves to clusters
         for node in slaves:
-            try:
-                node.refresh_info()
-            except DbError:
-                # We'll accept a stale entry at this point.
-                pass
-            if by_name and node.master_name in clusters_by_name:
+            if not node.is_slave:
+                # Promoted since it was partitioned; it will be picked up as
+                # a master on the next iteration.
+                self.clusterless.append(node)
+            elif by_name and node.master_name in clusters_by_name:
                 clusters_by_name[node.master_name].add_node(node)
+                self.transitions.append(
+                    ('node_assigned', node, clusters_by_name[node.master_name])
+                )
             elif not by_name and 0 <= node.cluster_id < len(self.clusters):
                 self.clusters[node.cluster_id].add_node(node)
+                self.transitions.append(
+                    ('node_assigned', node, self.clusters[node.cluster_id])
+                )
             else:
                 self.clusterless.append(node)
 
 
+def submit_triggers(executor, snapshot, clusters, triggers):
+    """Submit the triggers for the transitions of an update
+
+    Args:
+        executor (TriggerExecutor): The executor to submit the triggers to
+        snapshot (Snapshot): The snapshot taken after the update
+        clusters (list of Cluster): The clusters
+        triggers (dict): The triggers, as returned by Plusmoin.update_nodes
+    """
+    for trg in triggers:
+        for node, cluster in triggers[trg]:
+            if node:
+                trigger_node = node.to_dict()
+            else:
+                trigger_node = None
+            executor.submit(cluster.cluster_id, trg, snapshot.payload(
+                cluster.cluster_id, trigger=trigger_node
+            ))
+    if has_trigger('cluster_events'):
+        for cluster in clusters:
+            events = cluster_events(triggers, cluster)
+            if events:
+                executor.submit(
+                    cluster.cluster_id, 'cluster_events',
+                    snapshot.payload(cluster.cluster_id, events=events)
+                )
+
+
+def submit_heartbeats(executor, snapshot, clusters, changes):
+    """Submit the plusmoin_heartbeat trigger of each cluster
+
+    Nothing is submitted when no plugin or script is configured for the
+    trigger. With heartbeat_trigger_on_change, it is only submitted for the
+    clusters whose payload changed (or whose keep-alive expired).
+
+    Args:
+        executor (TriggerExecutor): The executor to submit the triggers to
+        snapshot (Snapshot): The snapshot taken after the update
+        clusters (list of Cluster): The clusters
+        changes (ChangeTracker): The tracker of the heartbeat payloads
+    """
+    if not has_trigger('plusmoin_heartbeat'):
+        return
+    for cluster in clusters:
+        payload = snapshot.payload(cluster.cluster_id)
+        if (config['heartbeat_trigger_on_change']
+                and not changes.changed(cluster.cluster_id, payload.encoded)):
+            continue
+        executor.submit(cluster.cluster_id, 'plusmoin_heartbeat', payload)
+
+
+def cluster_events(triggers, cluster):
+    """Return the transitions of an iteration that concern a cluster
+
+    Args:
+        triggers (dict): The triggers, as returned by Plusmoin.update_nodes
+        cluster (Cluster): The cluster
+
+    Returns:
+        list: List of dictionaries of the form
+            {'trigger': <trigger name>, 'node': <node entry> or None}
+    """
+    events = []
+    for trg in EVENT_TRIGGERS:
+        for node, trigger_cluster in triggers[trg]:
+            if trigger_cluster is cluster:
+                events.append({
+                    'trigger': trg,
+                    'node': node.to_dict() if node else None
+                })
+    return events
+
+
+def log_transitions(event_log, transitions, detected_at):
+    """Record transitions in the event log, and flush it
+
+    Args:
+        event_log (EventLog): The event log
+        transitions (list of tuple): The transitions, as in
+            Plusmoin.transitions
+        detected_at (float): Start time of the iteration in which the
+            transitions were detected
+    """
+    for (event, node, cluster) in transitions:
+        event_log.append(
+            event,
+            detected_at=detected_at,
+            cluster_id=cluster.cluster_id if cluster else None,
+            node=node.to_dict() if node else None
+        )
+    event_log.flush()
+
+
+def record_metrics(pm):
+    """Update the gauges describing the clusters
+
+    Args:
+        pm (Plusmoin): The running service
+    """
+    metrics.clusters.set(len(pm.clusters))
+    metrics.clusterless.set(len(pm.clusterless))
+    slaves = []
+    lost = []
+    lag = []
+    lag_bytes = []
+    for cluster in pm.clusters:
+        labels = {'cluster_id': cluster.cluster_id}
+        slaves.append((len(cluster.slaves), labels))
+        lost.append((len(cluster.lost), labels))
+        if not cluster.has_master:
+            continue
+        for node in cluster.slaves + cluster.lost:
+            node_labels = {'cluster_id': cluster.cluster_id, 'node': node.name}
+            lag.append((cluster.master.timestamp - node.timestamp,
+                        node_labels))
+            if node.replay_lag_bytes is not None:
+                lag_bytes.append((node.replay_lag_bytes, node_labels))
+    metrics.slaves.replace(slaves)
+    metrics.lost.replace(lost)
+    metrics.replication_lag.replace(lag)
+    metrics.replication_lag_bytes.replace(lag_bytes)
+
+
+def publish_status(publisher, snapshot, scheduler):
+    """Publish the status of the clusters, if it changed
+
+    Only values that change with the clusters go in the status, so that it
+    is not published anew on every iteration. The state of the trigger queue
+    is exposed through the metrics instead.
+
+    Args:
+        publisher (StatusPublisher): The status publisher
+        snapshot (Snapshot): The snapshot taken after the update
+        scheduler (Scheduler): The running scheduler
+
+    Returns:
+        bool: True if the status changed and was published
+    """
+    return publisher.publish(
+        snapshot.status(missed_heartbeats=scheduler.missed), snapshot
+    )
+
+
+def reload_settings(pm, scheduler, heartbeat_changes):
+    """Read the configuration file again, and apply it to the running service
+
+    The managed nodes, the heartbeat and overrun policy, the sync thresholds,
+    the probe settings and the triggers are applied; other settings only
+    apply after a restart. If the configuration cannot be read, the running
+    one is kept. Afterwards, the transitions of pm only hold the changes made
+    by the reload.
+
+    Args:
+        pm (Plusmoin): The running service
+        scheduler (Scheduler): The running scheduler
+        heartbeat_changes (ChangeTracker): The tracker of heartbeat trigger
+            payloads
+
+    Returns:
+        Scheduler: The scheduler to use from now on
+    """
+    logger = logging.getLogger()
+    pm.transitions = []
+    try:
+        reload_config()
+    except (IOError, ValueError, ConfigRequired) as e:
+        logger.error("Could not reload the configuration: {}".format(e))
+        return scheduler
+    (added, removed) = pm.set_nodes(
+        [(node['host'], node['port']) for node in config['nodes']]
+    )
+    logger.info("Configuration reloaded: {} node(s) added, {} removed".format(
+        len(added), len(removed)
+    ))
+    pm.set_thresholds(
+        config['max_sync_delay'],
+        config['recover_sync_delay'],
+        config['max_sync_bytes'],
+        config['recover_sync_bytes']
+    )
+    pm.probe_concurrency = config['probe_concurrency']
+    pm.probe_timeout = config['probe_timeout']
+    pm.discovery = config['discovery']
+    pm.forget_after = config['discovery_forget_after']
+    heartbeat_changes.keepalive = config['heartbeat_trigger_keepalive']
+    try:
+        load_plugins()
+    except TriggerPluginError as e:
+        logger.error("Could not reload the trigger plugins: {}".format(e))
+    if (config['heartbeat'] != scheduler.interval
+            or config['heartbeat_overrun'] != scheduler.overrun):
+        try:
+            new_scheduler = Scheduler(config['heartbeat'],
+                                      config['heartbeat_overrun'])
+        except ValueError as e:
+            logger.error("Could not change the heartbeat: {}".format(e))
+            return scheduler
+        new_scheduler.missed = scheduler.missed
+        return new_scheduler
+    return scheduler
+
+
 def run():
     """ The main application entry point """
+    # Reload the configuration on SIGHUP, before the next iteration. The
+    # handler is installed first, so a reload requested while starting up
+    # does not stop the service; it is applied once startup is done.
+    reload_requested = threading.Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    # Serve the status, if configured. It is only available once the nodes
+    # have been set up.
+    status = StatusPublisher(config['status_file'], config['status_etag_file'])
+    if config['http_port'] is not None:
+        server = StatusServer(
+            (config['http_address'], config['http_port']),
+            status,
+            config['http_max_wait']
+        )
+        server.start()
+    if config['agent_check_port'] is not None:
+        agent_server = AgentCheckServer(
+            (config['agent_check_address'], config['agent_check_port']),
+            status
+        )
+        agent_server.start()
     # Prepare nodes and create Plusmoin object
     nodes = []
     for node_def in config['nodes']:
         nodes.append(Node(node_def['host'], node_def['port']))
+    state_file = None
+    state = None
+    if config['state_file'] is not None:
+        state_file = StateFile(config['state_file'])
+        state = state_file.load()
+    started = time.time()
     pm = Plusmoin(
         nodes,
         config['max_sync_delay'],
-        config['recover_sync_delay']
+        config['recover_sync_delay'],
+        config['probe_concurrency'],
+        config['engine'],
+        config['probe_timeout'],
+        config['max_sync_bytes'],
+        config['recover_sync_bytes'],
+        config['heartbeat_writer_interval'] is not None,
+        state,
+        config['startup_poll_interval'],
+        config['discovery'],
+        config['discovery_forget_after']
     )
-    # Run initial trigger
+    if state_file is not None:
+        state_file.save(pm.clusters, pm.clusterless)
+    # Write the masters' heartbeats in the background, if configured
+    writer = None
+    if config['heartbeat_writer_interval'] is not None:
+        writer = HeartbeatWriter(config['heartbeat_writer_interval'],
+                                 config['probe_timeout'])
+        writer.set_masters(pm.masters)
+        writer.start()
+    event_log = None
+    if config['event_log'] is not None:
+        event_log = EventLog(
+            config['event_log'],
+            config['event_log_max_size'],
+            config['event_log_max_age'],
+            config['event_log_backups'],
+            config['event_log_fsync_interval']
+        )
+        log_transitions(event_log, pm.transitions, started)
+    record_metrics(pm)
+    # Run initial trigger. Triggers run in the background, one cluster's
+    # triggers in order.
+    load_plugins()
+    executor = TriggerExecutor(config['trigger_concurrency'])
+    snapshot = Snapshot(pm.clusters, pm.clusterless)
     for cluster in pm.clusters:
-        info = cluster.to_dict(reset=True)
-        info['trigger'] = None
-        info['clusterless'] = [n.to_dict(reset=True) for n in pm.clusterless]
-        trigger('plusmoin_up', json.dumps(info))
+        executor.submit(cluster.cluster_id, 'plusmoin_up',
+                        snapshot.payload(cluster.cluster_id, trigger=None))
+    submit_triggers(executor, snapshot, pm.clusters, pm.startup_triggers)
     # Enter the loop
+    scheduler = Scheduler(config['heartbeat'], config['heartbeat_overrun'])
+    heartbeat_changes = ChangeTracker(config['heartbeat_trigger_keepalive'])
+    publish_status(status, snapshot, scheduler)
     while True:
         # Wait and run update
-        time.sleep(config['heartbeat'])
+        scheduler.wait()
+        started = time.time()
+        if reload_requested.is_set():
+            reload_requested.clear()
+            scheduler = reload_settings(pm, scheduler, heartbeat_changes)
+            if writer is not None:
+                writer.timeout = config['probe_timeout']
+            if event_log is not None:
+                log_transitions(event_log, pm.transitions, started)
         triggers = pm.update_nodes()
+        if writer is not None:
+            writer.set_masters(pm.masters)
+        if state_file is not None:
+            state_file.save(pm.clusters, pm.clusterless)
+        if event_log is not None:
+            log_transitions(event_log, pm.transitions, started)
+        record_metrics(pm)
         # Refresh json representation of nodes and clusters
-        clusterless_dict = [n.to_dict(reset=True) for n in pm.clusterless]
-        for cluster in pm.clusters:
-            cluster.to_dict(reset=True)
+        snapshot = Snapshot(pm.clusters, pm.clusterless)
         # Run triggers
-        for trg in triggers:
-            for node, cluster in triggers[trg]:
-                info = cluster.to_dict()
-                if node:
-                    info['trigger'] = node.to_dict()
-                else:
-                    info['trigger'] = None
-                info['clusterless'] = clusterless_dict
-                trigger(trg, json.dumps(info))
-        for cluster in pm.clusters:
-            info = cluster.to_dict()
-            info['clusterless'] = clusterless_dict
-            trigger('plusmoin_heartbeat', json.dumps(info))
-        # Output status
-        with open(config['status_file'], 'w') as f:
-            f.write(json.dumps({
-                'clusters': [c.to_dict() for c in pm.clusters],
-                'clusterless': [n.to_dict() for n in pm.clusterless]
-            }))
+        submit_triggers(executor, snapshot, pm.clusters, triggers)
+        submit_heartbeats(executor, snapshot, pm.clusters, heartbeat_changes)
+        # Output status, if it changed
+        publish_status(status, snapshot, scheduler)
+        metrics.iteration_seconds.observe(time.time() - started)
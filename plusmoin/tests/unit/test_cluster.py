@@ -1,9 +1,12 @@
+import time
+
 from nose.tools import assert_equals, assert_raises, assert_true, assert_false
 from nose.tools import assert_items_equal
-from mock import Mock
+from mock import Mock, patch
 from plusmoin.config import config
 from plusmoin.lib.cluster import Cluster
 from plusmoin.lib.db import DbError
+from plusmoin.lib.probe import ProbeResult
 
 # Test case:
 # master gone
@@ -17,6 +20,7 @@ class TestCluster(object):
         mock_master.name = 'a:1'
         mock_master.cluster_id = 0
         mock_master.timestamp = 1000
+        mock_master.wal_position = None
         self._cluster = Cluster(
             cluster_id=0,
             max_sync_delay=10,
@@ -130,14 +134,18 @@ class TestUpdateCluster(object):
             cluster_id=0,
             timestamp=1000
         )
-        self._lost_1.refresh_role.side_effect = DbError
+        self._lost_1.probe.side_effect = DbError
         self._lost_2 = Mock(
             is_slave=True,
             master_name='a:1',
             cluster_id=0,
             timestamp=1000
         )
-        self._lost_2.refresh_role.side_effect = DbError
+        self._lost_2.probe.side_effect = DbError
+        for node in (self._master, self._slave_1, self._slave_2,
+                     self._lost_1, self._lost_2):
+            node.wal_position = None
+            node.wal_received = None
         self._cluster = Cluster(
             cluster_id=0,
             max_sync_delay=10,
@@ -163,7 +171,7 @@ class TestUpdateCluster(object):
 
     def test_master_down(self):
         """Test a cluster update with a master going down"""
-        self._master.refresh_role.side_effect = DbError
+        self._master.probe.side_effect = DbError
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': self._master,
@@ -222,7 +230,7 @@ class TestUpdateCluster(object):
         """Test a cluster update with a master going up from the lost nodes"""
         self._cluster.master = None
         self._lost_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -240,7 +248,7 @@ class TestUpdateCluster(object):
            to that of the cluster"""
         self._cluster.master = None
         self._lost_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         self._lost_1.cluster_id = 1
         self._cluster.update_cluster()
         assert_equals(self._lost_1.cluster_id, 0)
@@ -250,7 +258,7 @@ class TestUpdateCluster(object):
            to update the heartbeat"""
         self._cluster.master = None
         self._slave_1.is_slave = False
-        self._slave_1.update_heartbeat.side_effect = DbError
+        self._slave_1.write_heartbeat.side_effect = DbError
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -269,8 +277,8 @@ class TestUpdateCluster(object):
            update the heartbeat"""
         self._cluster.master = None
         self._lost_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
-        self._lost_1.update_heartbeat.side_effect = DbError
+        self._lost_1.probe = Mock()
+        self._lost_1.write_heartbeat.side_effect = DbError
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -286,7 +294,7 @@ class TestUpdateCluster(object):
     def test_master_down_slave_master_up(self):
         """Test a cluster update with a master going down and master going up
            from the slaves"""
-        self._master.refresh_role.side_effect = DbError
+        self._master.probe.side_effect = DbError
         self._slave_1.is_slave = False
         status = self._cluster.update_cluster()
         assert_equals(status, {
@@ -305,9 +313,9 @@ class TestUpdateCluster(object):
     def test_master_down_lost_master_up(self):
         """Test a cluster update with a master going down and master going up
            from the lost"""
-        self._master.refresh_role.side_effect = DbError
+        self._master.probe.side_effect = DbError
         self._lost_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -323,7 +331,7 @@ class TestUpdateCluster(object):
 
     def test_slave_down(self):
         """Test a cluster with a slave going down"""
-        self._slave_1.refresh_role.side_effect = DbError
+        self._slave_1.probe.side_effect = DbError
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -353,10 +361,102 @@ class TestUpdateCluster(object):
                       self._cluster.lost)
         assert_equals(self._master, self._cluster.master)
 
+    def test_slave_behind_in_bytes(self):
+        """Test a cluster with a slave whose replay lag exceeds the byte
+           threshold"""
+        self._cluster.max_sync_bytes = 1000
+        self._master.wal_position = 5000
+        self._slave_1.wal_position = 3000
+        self._slave_1.wal_received = 4500
+        self._slave_2.wal_position = 4500
+        self._slave_2.wal_received = 5000
+        status = self._cluster.update_cluster()
+        assert_equals([self._slave_1], status['slaves_down'])
+        assert_items_equal([self._slave_2], self._cluster.slaves)
+        assert_equals(2000, self._slave_1.replay_lag_bytes)
+        assert_equals(500, self._slave_1.receive_lag_bytes)
+        assert_equals(500, self._slave_2.replay_lag_bytes)
+        assert_equals(0, self._slave_2.receive_lag_bytes)
+
+    @patch('plusmoin.lib.cluster.db.heartbeat_timestamp')
+    def test_external_heartbeat(self, mock_timestamp):
+        """Test that with an external heartbeat, the master's heartbeat is not
+           written but only checked"""
+        mock_timestamp.return_value = 1005
+        self._cluster.external_heartbeat = True
+        status = self._cluster.update_cluster()
+        assert_false(status['master_down'])
+        assert_false(self._master.write_heartbeat.called)
+        assert_equals(self._master, self._cluster.master)
+
+    @patch('plusmoin.lib.cluster.db.heartbeat_timestamp')
+    def test_external_heartbeat_stalled(self, mock_timestamp):
+        """Test that with an external heartbeat, the master goes down when its
+           heartbeat stopped moving"""
+        mock_timestamp.return_value = 1020
+        self._cluster.external_heartbeat = True
+        status = self._cluster.update_cluster()
+        assert_equals(self._master, status['master_down'])
+        assert_false(self._master.write_heartbeat.called)
+
+    @patch('plusmoin.lib.cluster.db.heartbeat_timestamp')
+    def test_external_heartbeat_new_master(self, mock_timestamp):
+        """Test that with an external heartbeat, a new master still gets its
+           heartbeat written straight away"""
+        mock_timestamp.return_value = 1020
+        self._cluster.external_heartbeat = True
+        self._cluster.master = None
+        self._slave_1.is_slave = False
+        status = self._cluster.update_cluster()
+        assert_equals(self._slave_1, status['master_up'])
+        self._slave_1.write_heartbeat.assert_called_once_with(1020)
+
+    @patch('plusmoin.lib.cluster.db.heartbeat_timestamp')
+    def test_external_heartbeat_moved_after_probe(self, mock_timestamp):
+        """Test that with an external heartbeat, slaves are compared with the
+           master's timestamp at probe time"""
+        mock_timestamp.return_value = 1016
+        self._cluster.external_heartbeat = True
+        probes = {}
+        for node in (self._master, self._slave_1, self._slave_2):
+            probes[node] = ProbeResult(node, node.timestamp)
+        for node in (self._lost_1, self._lost_2):
+            probes[node] = ProbeResult(node, node.timestamp)
+            probes[node].error = DbError()
+        # The heartbeat writer moves on while the slaves are being probed
+        self._master.timestamp = 1015
+        status = self._cluster.update_cluster(probes)
+        assert_false(status['master_down'])
+        assert_equals([], status['slaves_down'])
+        assert_items_equal([self._slave_1, self._slave_2], self._cluster.slaves)
+
+    def test_master_heartbeat_already_written(self):
+        """Test that a master whose heartbeat was already written is not
+           written to again, and goes down if that write failed"""
+        status = self._cluster.update_cluster(heartbeats={self._master: None})
+        assert_false(status['master_down'])
+        assert_false(self._master.write_heartbeat.called)
+        status = self._cluster.update_cluster(
+            heartbeats={self._master: DbError()}
+        )
+        assert_equals(self._master, status['master_down'])
+        assert_false(self._master.write_heartbeat.called)
+
+    def test_master_heartbeat_timeout(self):
+        """Test that a master whose heartbeat write hangs goes down once the
+           timeout passed"""
+        self._master.write_heartbeat.side_effect = (
+            lambda timestamp: time.sleep(0.5)
+        )
+        start = time.time()
+        status = self._cluster.update_cluster(timeout=0.1)
+        assert_true(time.time() - start < 0.4)
+        assert_equals(self._master, status['master_down'])
+
     def test_lost_node_back_but_out_of_sync(self):
         """Test a cluster update where a lost node comes back but is out
            of sync"""
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         self._lost_1.timestamp = 900
         status = self._cluster.update_cluster()
         assert_equals(status, {
@@ -390,7 +490,7 @@ class TestUpdateCluster(object):
         """ Check that if a lost comes back as a master when we already have
             one, it is sent out."""
         self._lost_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         status = self._cluster.update_cluster()
         assert_equals(status, {
             'master_down': False,
@@ -406,7 +506,7 @@ class TestUpdateCluster(object):
     def test_master_down_two_slaves_master_up(self):
         """Test a cluster update with a master going down two slaves coming
            back as master at the same time"""
-        self._master.refresh_role.side_effect = DbError
+        self._master.probe.side_effect = DbError
         self._slave_1.is_slave = False
         self._slave_2.is_slave = False
         status = self._cluster.update_cluster()
@@ -426,9 +526,9 @@ class TestUpdateCluster(object):
     def test_master_down_slave_and_lost_master_up(self):
         """Test a cluster update with a master going down and a slave and lost
            coming back as master at the same time"""
-        self._master.refresh_role.side_effect = DbError
+        self._master.probe.side_effect = DbError
         self._slave_1.is_slave = False
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         self._lost_1.is_slave = False
         status = self._cluster.update_cluster()
         assert_equals(status, {
@@ -497,7 +597,7 @@ class TestUpdateCluster(object):
     def test_lost_back_with_different_cluster_id(self):
         """Check that a lost node that comes back in sync but with a wrong
            cluster id is moved out, and nothing is triggered"""
-        self._lost_1.refresh_role = Mock()
+        self._lost_1.probe = Mock()
         self._lost_1.cluster_id = 1
         status = self._cluster.update_cluster()
         assert_equals(status, {
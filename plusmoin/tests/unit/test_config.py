@@ -4,7 +4,8 @@ import shutil
 import tempfile
 
 from nose.tools import assert_raises, assert_true, assert_in, assert_equals
-from plusmoin.config import read_config, config, ConfigRequired
+from plusmoin.config import read_config, reload_config, config
+from plusmoin.config import ConfigRequired
 
 
 class TestConfig(object):
@@ -53,3 +54,39 @@ class TestConfig(object):
             }))
         read_config(conf)
         assert_true(len(config) > 3)
+
+    def test_reload_config(self):
+        """Tests the configuration file is read again on reload, and kept
+           if it became invalid"""
+        conf = os.path.join(self._temp, "test_reload_config.conf")
+        tcfg = {'user': '1', 'dbname': '2', 'password': '3', 'heartbeat': 5}
+        with open(conf, 'w') as f:
+            f.write(json.dumps(tcfg))
+        read_config(conf)
+        tcfg['heartbeat'] = 10
+        with open(conf, 'w') as f:
+            f.write(json.dumps(tcfg))
+        reload_config()
+        assert_equals(10, config['heartbeat'])
+        with open(conf, 'w') as f:
+            f.write(json.dumps({'heartbeat': 20}))
+        assert_raises(ConfigRequired, reload_config)
+        assert_equals(10, config['heartbeat'])
+
+    def test_reload_config_relative_path(self):
+        """Ensure the configuration file is found again on reload after the
+           working directory changed"""
+        tcfg = {'user': '1', 'dbname': '2', 'password': '3', 'heartbeat': 5}
+        with open(os.path.join(self._temp, 'relative.conf'), 'w') as f:
+            f.write(json.dumps(tcfg))
+        cwd = os.getcwd()
+        os.chdir(self._temp)
+        try:
+            read_config('relative.conf')
+        finally:
+            os.chdir(cwd)
+        tcfg['heartbeat'] = 10
+        with open(os.path.join(self._temp, 'relative.conf'), 'w') as f:
+            f.write(json.dumps(tcfg))
+        reload_config()
+        assert_equals(10, config['heartbeat'])
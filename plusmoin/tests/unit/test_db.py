@@ -7,8 +7,9 @@ linking the test suite very closely to the implementation.
 import psycopg2
 from contextlib import contextmanager
 
-from nose.tools import assert_equals, assert_true, assert_false
+from nose.tools import assert_equals, assert_true, assert_false, assert_in
 from nose.tools import assert_raises
+from mock import patch
 
 from plusmoin.lib import db
 from plusmoin.config import config
@@ -20,6 +21,8 @@ class MockConnection(object):
         self.queries = []
         self.results = results
         self.raise_error = raise_error
+        self.rowcount = 1
+        self.server_version = 90605
 
     @contextmanager
     def cursor(self):
@@ -69,6 +72,135 @@ class TestDb(object):
         connection = MockConnection([(True, )], raise_error=True)
         assert_raises(db.DbError, db.is_slave, connection)
 
+    def test_probe_sends_configured_statement(self):
+        """Check that db.probe embeds the configured slave statement"""
+        connection = MockConnection([(True, 1, 'a:1', 1000)])
+        db.probe(connection)
+        assert_equals(1, len(connection.queries))
+        assert_in('(crafty sql)', connection.queries[0][0])
+
+    def test_probe_returns_query_value(self):
+        """Check that db.probe returns the role and heartbeat information"""
+        connection = MockConnection([(True, 1, 'a:1', 1000)])
+        assert_equals((True, 1, 'a:1', 1000), db.probe(connection))
+
+    def test_probe_raises_on_empty(self):
+        """Check that db.probe raises DbError if the result is empty"""
+        connection = MockConnection([None])
+        assert_raises(db.DbError, db.probe, connection)
+
+    def test_probe_raises_on_error(self):
+        """Check that db.probe raises DbError if psycopg raises"""
+        connection = MockConnection([(True, )], raise_error=True)
+        assert_raises(db.DbError, db.probe, connection)
+
+    def test_probe_without_heartbeat_table(self):
+        """Check that db.probe falls back to the role only when the heartbeat
+           table does not exist"""
+        connection = MockConnection([(False, )])
+        error = psycopg2.ProgrammingError()
+        with patch.object(psycopg2.ProgrammingError, 'pgcode',
+                          psycopg2.errorcodes.UNDEFINED_TABLE):
+            with patch.object(connection, 'execute') as mock_execute:
+                mock_execute.side_effect = [error, None]
+                assert_equals((False, None, None, None), db.probe(connection))
+
+    def test_probe_wal_positions(self):
+        """Check that db.probe fetches the WAL positions when wal_lag is
+           enabled"""
+        config['wal_lag'] = True
+        config['wal_lsn_statement'] = 'wal sql'
+        try:
+            connection = MockConnection([
+                (True, 1, 'a:1', 1000, None, '1/10', '0/FF')
+            ])
+            assert_equals((True, 1, 'a:1', 1000, (None, 0x100000010, 0xFF)),
+                          db.probe(connection))
+            assert_in('(wal sql)', connection.queries[0][0])
+            connection = MockConnection([(True, 1, 'a:1', 1000)])
+            assert_raises(db.DbError, db.probe, connection)
+        finally:
+            config['wal_lag'] = False
+            config['wal_lsn_statement'] = None
+
+    def test_wal_lsn_statement_by_version(self):
+        """Check that the WAL functions are chosen by server version, unless
+           a statement is configured"""
+        config['wal_lsn_statement'] = None
+        assert_in('pg_last_xlog_replay_location()', db.wal_lsn_statement(90605))
+        assert_in('pg_last_wal_replay_lsn()', db.wal_lsn_statement(100001))
+        config['wal_lsn_statement'] = 'wal sql'
+        try:
+            assert_equals('wal sql', db.wal_lsn_statement(100001))
+        finally:
+            config['wal_lsn_statement'] = None
+
+    def test_probe_decodes_millisecond_heartbeat(self):
+        """Check that db.probe converts heartbeats stored in milliseconds to
+           seconds"""
+        connection = MockConnection([(True, 1, 'a:1', 1400000000250)])
+        assert_equals((True, 1, 'a:1', 1400000000.25), db.probe(connection))
+
+    def test_heartbeat_timestamp_precision(self):
+        """Check that heartbeat timestamps have the configured precision"""
+        with patch('time.time', return_value=1400000000.2504):
+            assert_equals(1400000000, db.heartbeat_timestamp())
+            assert_equals(1400000000, db.encode_timestamp(1400000000.25))
+            config['heartbeat_precision'] = 'milliseconds'
+            try:
+                assert_equals(1400000000.25, db.heartbeat_timestamp())
+                assert_equals(1400000000250,
+                              db.encode_timestamp(1400000000.25))
+            finally:
+                config['heartbeat_precision'] = 'seconds'
+
+    def test_decode_timestamp(self):
+        """Check that stored timestamps are decoded according to their
+           magnitude"""
+        assert_equals(1400000000, db.decode_timestamp(1400000000))
+        assert_equals(1400000000.25, db.decode_timestamp(1400000000250))
+        assert_equals(0, db.decode_timestamp(0))
+        assert_equals(None, db.decode_timestamp(None))
+
+    def test_probe_replicas(self):
+        """Check that db.probe fetches the replicas when discovery is
+           enabled"""
+        config['discovery'] = True
+        config['discovery_statement'] = 'replicas sql'
+        try:
+            connection = MockConnection([
+                (False, 1, 'a:1', 1000, ['10.0.0.2'], ['walreceiver'])
+            ])
+            assert_equals(
+                (False, 1, 'a:1', 1000, None, [('10.0.0.2', 5432)]),
+                db.probe(connection)
+            )
+            assert_in('(replicas sql)', connection.queries[0][0])
+        finally:
+            config['discovery'] = False
+
+    def test_replica_addresses(self):
+        """Check that replicas are found at the address given by their
+           application name, or else at their client address"""
+        config['discovery_port'] = 5433
+        try:
+            assert_equals(
+                [('b.example.com', 5434), ('10.0.0.3', 5433)],
+                db.replica_addresses(
+                    ['10.0.0.2', '10.0.0.3', None],
+                    ['b.example.com:5434', 'walreceiver', 'walreceiver']
+                )
+            )
+            assert_equals([], db.replica_addresses(None, None))
+        finally:
+            config['discovery_port'] = 5432
+
+    def test_parse_lsn(self):
+        """Check that LSNs are converted to byte positions"""
+        assert_equals(0, db.parse_lsn('0/0'))
+        assert_equals((0x16 << 32) + 0xB374D848, db.parse_lsn('16/B374D848'))
+        assert_equals(None, db.parse_lsn(None))
+
     def test_create_heartbeat_sends_query(self):
         """Check that db.create_heartbeat_table sends a create table statement"""
         connection = MockConnection([(1,)])
@@ -112,8 +244,167 @@ class TestDb(object):
             """.split()), ''.join(connection.queries[0][0].split()))
         assert_equals((12, 'example.com:9988', 12345), connection.queries[0][1])
 
+    def test_update_heartbeat_table_milliseconds(self):
+        """Check that db.update_heartbeat_table stores milliseconds when
+           heartbeat_precision is 'milliseconds'"""
+        config['heartbeat_precision'] = 'milliseconds'
+        try:
+            connection = MockConnection()
+            db.update_heartbeat_table(12, 'a:1', 1400000000.25, connection)
+            assert_equals((12, 'a:1', 1400000000250),
+                          connection.queries[0][1])
+        finally:
+            config['heartbeat_precision'] = 'seconds'
+
+    def test_update_heartbeat_raises_on_empty_table(self):
+        """Check that db.update_heartbeat_table raises if no row was updated"""
+        connection = MockConnection()
+        connection.rowcount = 0
+        assert_raises(db.DbError, db.update_heartbeat_table,
+                      12, 'host:99', 1234, connection)
+
     def test_update_heatbeat_raises_on_error(self):
         """Check that db.update_heartbeat_table raises on psycopg errors"""
         connection = MockConnection(raise_error=True)
         assert_raises(db.DbError, db.update_heartbeat_table,
                       12, 'host:99', 1234, connection)
+
+
+class MockPooledConnection(object):
+    """Class used to mock a psycopg2 connection held in the pool"""
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.broken = False
+
+    def poll(self):
+        if self.broken:
+            raise psycopg2.OperationalError()
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(object):
+    def setUp(self):
+        config['user'] = 'user'
+        config['password'] = 'password'
+        config['dbname'] = 'dbname'
+        config['connect_timeout'] = 1
+        self._pool = db.ConnectionPool()
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_connection_is_reused(self, mock_connect):
+        """Check that the pool only connects once for a given host/port"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        with self._pool.connection('a', 1) as c1:
+            pass
+        with self._pool.connection('a', 1) as c2:
+            pass
+        assert_equals(1, mock_connect.call_count)
+        assert_true(c1 is c2)
+        assert_true(c1.autocommit)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_connections_are_per_node(self, mock_connect):
+        """Check that the pool holds one connection per host/port"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        with self._pool.connection('a', 1) as c1:
+            pass
+        with self._pool.connection('a', 2) as c2:
+            pass
+        assert_equals(2, mock_connect.call_count)
+        assert_false(c1 is c2)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_broken_connection_is_replaced(self, mock_connect):
+        """Check that a connection which fails the health check is closed and
+           replaced"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        with self._pool.connection('a', 1) as c1:
+            pass
+        c1.broken = True
+        with self._pool.connection('a', 1) as c2:
+            pass
+        assert_equals(2, mock_connect.call_count)
+        assert_false(c1 is c2)
+        assert_true(c1.closed)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_connection_dropped_after_failure(self, mock_connect):
+        """Check that a connection that breaks while in use is discarded"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        try:
+            with self._pool.connection('a', 1) as c1:
+                c1.closed = 2
+                raise db.DbError()
+        except db.DbError:
+            pass
+        with self._pool.connection('a', 1) as c2:
+            pass
+        assert_equals(2, mock_connect.call_count)
+        assert_false(c1 is c2)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_connect_error_raises_db_error(self, mock_connect):
+        """Check that connection errors are raised as DbError"""
+        mock_connect.side_effect = psycopg2.OperationalError()
+
+        def use():
+            with self._pool.connection('a', 1):
+                pass
+        assert_raises(db.DbError, use)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_close(self, mock_connect):
+        """Check that closing a node's connection forces a reconnect"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        with self._pool.connection('a', 1) as c1:
+            pass
+        self._pool.close('a', 1)
+        assert_true(c1.closed)
+        with self._pool.connection('a', 1):
+            pass
+        assert_equals(2, mock_connect.call_count)
+
+    @patch('plusmoin.lib.db.psycopg2.connect')
+    def test_late_connection_is_closed(self, mock_connect):
+        """Check that a connection handed back after a replacement was created
+           is closed rather than leaked"""
+        mock_connect.side_effect = lambda **kw: MockPooledConnection()
+        with self._pool.connection('a', 1) as c1:
+            with self._pool.connection('a', 1) as c2:
+                pass
+        assert_false(c1 is c2)
+        assert_true(c2.closed)
+        assert_false(c1.closed)
+
+
+class TestConnectionDetails(object):
+    def setUp(self):
+        config['user'] = 'user'
+        config['password'] = 'password'
+        config['dbname'] = 'dbname'
+        config['connect_timeout'] = 60
+
+    def test_no_probe_timeout(self):
+        """Check that no extra settings are used without a probe timeout"""
+        config['probe_timeout'] = None
+        details = db.connection_details('a', 1)
+        assert_equals(60, details['connect_timeout'])
+        assert_false('options' in details)
+
+    def test_probe_timeout(self):
+        """Check that the probe timeout bounds connection, statements and
+           dead peer detection"""
+        config['probe_timeout'] = 9
+        details = db.connection_details('a', 1)
+        assert_equals(9, details['connect_timeout'])
+        assert_equals('-c statement_timeout=9000', details['options'])
+        assert_equals(1, details['keepalives'])
+        assert_true(details['keepalives_idle'] +
+                    details['keepalives_interval'] *
+                    details['keepalives_count'] < 9)
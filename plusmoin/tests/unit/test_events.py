@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+
+from mock import patch
+from nose.tools import assert_equals
+from plusmoin.lib.events import EventLog
+
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestEventLog(object):
+    def setUp(self):
+        self._clock = MockClock()
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'events.log')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _records(self, path=None):
+        with open(path or self._path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_records(self):
+        """Ensure records are written with a sequence number and a time"""
+        log = EventLog(self._path, clock=self._clock)
+        log.append('slave_down', cluster_id=1)
+        log.append('slave_up', cluster_id=2)
+        log.flush()
+        assert_equals([
+            {'seq': 1, 'time': 1000.0, 'event': 'slave_down',
+             'cluster_id': 1},
+            {'seq': 2, 'time': 1000.0, 'event': 'slave_up', 'cluster_id': 2}
+        ], self._records())
+
+    def test_buffered(self):
+        """Ensure records are only written when flushing"""
+        log = EventLog(self._path, clock=self._clock)
+        log.append('slave_down')
+        assert_equals(False, os.path.exists(self._path))
+        log.flush()
+        assert_equals(1, len(self._records()))
+
+    def test_sequence_carries_on(self):
+        """Ensure the sequence carries on from an existing log"""
+        log = EventLog(self._path, clock=self._clock)
+        log.append('slave_down')
+        log.append('slave_up')
+        log.close()
+        log = EventLog(self._path, clock=self._clock)
+        log.append('master_down')
+        log.flush()
+        assert_equals([1, 2, 3], [r['seq'] for r in self._records()])
+
+    def test_fsync_batching(self):
+        """Ensure fsync is not called more often than the interval"""
+        log = EventLog(self._path, fsync_interval=10, clock=self._clock)
+        with patch('plusmoin.lib.events.os.fsync') as fsync:
+            for i in range(4):
+                log.append('slave_down')
+                log.flush()
+                self._clock.now += 4
+            assert_equals(2, fsync.call_count)
+
+    def test_rotate_by_size(self):
+        """Ensure the log is rotated once it is too large"""
+        log = EventLog(self._path, max_size=1, backups=2, clock=self._clock)
+        for i in range(4):
+            log.append('slave_down')
+            log.flush()
+        assert_equals([4], [r['seq'] for r in self._records()])
+        assert_equals([3], [r['seq'] for r in self._records(
+            self._path + '.1'
+        )])
+        assert_equals([2], [r['seq'] for r in self._records(
+            self._path + '.2'
+        )])
+        assert_equals(False, os.path.exists(self._path + '.3'))
+        log.close()
+        assert_equals(4, EventLog(self._path).sequence)
+
+    def test_rotate_by_age(self):
+        """Ensure the log is rotated once it is too old"""
+        log = EventLog(self._path, max_age=60, clock=self._clock)
+        log.append('slave_down')
+        log.flush()
+        self._clock.now += 30
+        log.append('slave_down')
+        log.flush()
+        self._clock.now += 30
+        log.append('slave_down')
+        log.flush()
+        assert_equals([3], [r['seq'] for r in self._records()])
+        assert_equals([1, 2], [r['seq'] for r in self._records(
+            self._path + '.1'
+        )])
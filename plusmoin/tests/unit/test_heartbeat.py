@@ -0,0 +1,75 @@
+import threading
+import time
+
+from nose.tools import assert_equals, assert_true
+from mock import Mock, call, patch
+from plusmoin.lib.db import DbError
+from plusmoin.lib.heartbeat import HeartbeatWriter
+
+
+class TestHeartbeatWriter(object):
+    def setUp(self):
+        self._writer = HeartbeatWriter(0.01)
+        self._writer._pool = Mock()
+        self._master_1 = Mock(host='a', port=1)
+        self._master_1.name = 'a:1'
+        self._master_2 = Mock(host='b', port=2)
+        self._master_2.name = 'b:2'
+
+    @patch('plusmoin.lib.heartbeat.db.heartbeat_timestamp')
+    def test_write(self, mock_timestamp):
+        """Ensure a heartbeat is written to every master, using the writer's
+           own connection pool"""
+        mock_timestamp.return_value = 1234
+        self._writer.set_masters([self._master_1, self._master_2])
+        self._writer.write()
+        for master in (self._master_1, self._master_2):
+            assert_equals(call(1234, self._writer._pool),
+                          master.write_heartbeat.call_args)
+
+    def test_write_carries_on_after_error(self):
+        """Ensure an error on one master does not prevent writing to the
+           others"""
+        self._master_1.write_heartbeat.side_effect = DbError
+        self._writer.set_masters([self._master_1, self._master_2])
+        self._writer.write()
+        assert_true(self._master_2.write_heartbeat.called)
+
+    def test_write_hung_master(self):
+        """Ensure a master that does not answer does not hold up the
+           others"""
+        release = threading.Event()
+        self._master_1.write_heartbeat.side_effect = (
+            lambda *args: release.wait(5)
+        )
+        self._writer.timeout = 0.1
+        self._writer.set_masters([self._master_1, self._master_2])
+        try:
+            start = time.time()
+            self._writer.write()
+            self._writer.write()
+            assert_true(time.time() - start < 1)
+            assert_equals(2, self._master_2.write_heartbeat.call_count)
+            assert_equals(1, self._master_1.write_heartbeat.call_count)
+        finally:
+            release.set()
+
+    def test_set_masters_closes_connections(self):
+        """Ensure connections to nodes that are no longer masters are
+           closed"""
+        self._writer.set_masters([self._master_1, self._master_2])
+        self._writer.set_masters([self._master_2])
+        assert_equals([call('a', 1)], self._writer._pool.close.call_args_list)
+
+    def test_start_stop(self):
+        """Ensure the writer writes heartbeats in the background until it is
+           stopped"""
+        written = threading.Event()
+        self._master_1.write_heartbeat.side_effect = (
+            lambda *args: written.set()
+        )
+        self._writer.set_masters([self._master_1])
+        self._writer.start()
+        assert_true(written.wait(5))
+        self._writer.stop()
+        assert_true(self._writer._pool.close_all.called)
@@ -0,0 +1,70 @@
+from nose.tools import assert_equals, assert_in
+from plusmoin.lib.metrics import Registry
+
+
+class TestRegistry(object):
+    def setUp(self):
+        self._registry = Registry()
+
+    def test_counter(self):
+        """Ensure counters are incremented per label combination"""
+        counter = self._registry.counter('errors_total', 'Errors', ('node',))
+        counter.inc(node='a:1')
+        counter.inc(node='a:1')
+        counter.inc(3, node='b:1')
+        assert_equals(
+            "# HELP errors_total Errors\n"
+            "# TYPE errors_total counter\n"
+            "errors_total{node=\"a:1\"} 2\n"
+            "errors_total{node=\"b:1\"} 3\n",
+            self._registry.render()
+        )
+
+    def test_gauge(self):
+        """Ensure gauges can be set, and replaced all at once"""
+        gauge = self._registry.gauge('lag', 'Lag', ('node',))
+        gauge.set(1.5, node='a')
+        gauge.set(2, node='b')
+        assert_in('lag{node="a"} 1.5\n', self._registry.render())
+        gauge.replace([(4, {'node': 'c'})])
+        assert_equals(
+            "# HELP lag Lag\n"
+            "# TYPE lag gauge\n"
+            "lag{node=\"c\"} 4\n",
+            self._registry.render()
+        )
+
+    def test_histogram(self):
+        """Ensure histograms count observations in cumulative buckets"""
+        histogram = self._registry.histogram('duration', 'Duration',
+                                             buckets=(1, 5))
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        histogram.observe(10.0)
+        assert_equals(
+            "# HELP duration Duration\n"
+            "# TYPE duration histogram\n"
+            "duration_bucket{le=\"1\"} 1\n"
+            "duration_bucket{le=\"5\"} 2\n"
+            "duration_bucket{le=\"+Inf\"} 3\n"
+            "duration_sum 12.5\n"
+            "duration_count 3\n",
+            self._registry.render()
+        )
+
+    def test_histogram_labels(self):
+        """Ensure histogram buckets are labelled after the metric's labels"""
+        histogram = self._registry.histogram('duration', 'Duration',
+                                             ('trigger',), buckets=(1,))
+        with histogram.time(trigger='slave_up'):
+            pass
+        assert_in('duration_bucket{trigger="slave_up",le="1"} 1\n',
+                  self._registry.render())
+        assert_in('duration_count{trigger="slave_up"} 1\n',
+                  self._registry.render())
+
+    def test_label_escaping(self):
+        """Ensure label values are escaped"""
+        counter = self._registry.counter('c', 'C', ('node',))
+        counter.inc(node='a"b\\c')
+        assert_in('c{node="a\\"b\\\\c"} 1\n', self._registry.render())
@@ -1,7 +1,8 @@
 from nose.tools import assert_equals, assert_not_equals, assert_true
-from nose.tools import assert_false
-from mock import patch, call
+from nose.tools import assert_false, assert_raises
+from mock import Mock, patch, call
 from plusmoin.lib.node import Node
+from plusmoin.lib.db import DbError, NoHeartbeatError
 
 
 class MockConnection(object):
@@ -46,6 +47,56 @@ class TestNode(object):
         assert_equals('hello:99', node.master_name)
         assert_equals(12345, node.timestamp)
 
+    @patch('plusmoin.lib.node.db')
+    def test_probe_slave(self, mock_db):
+        """Ensure probe updates the role and information of a slave"""
+        mock_db.get_connection.return_value = MockConnection()
+        mock_db.probe.return_value = (True, 12, 'hello:99', 12345)
+        node = Node('a', 1)
+        node.probe()
+        assert_true(node.is_slave)
+        assert_equals(12, node.cluster_id)
+        assert_equals('hello:99', node.master_name)
+        assert_equals(12345, node.timestamp)
+
+    @patch('plusmoin.lib.node.db')
+    def test_probe_master(self, mock_db):
+        """Ensure probe does not overwrite the information of a master"""
+        mock_db.get_connection.return_value = MockConnection()
+        mock_db.probe.return_value = (False, 12, 'hello:99', 12345)
+        node = Node('a', 1)
+        node.cluster_id = 3
+        node.probe()
+        assert_false(node.is_slave)
+        assert_equals(3, node.cluster_id)
+        assert_equals(0, node.timestamp)
+
+    @patch('plusmoin.lib.node.db')
+    def test_probe_slave_without_info(self, mock_db):
+        """Ensure probe raises on a slave with no heartbeat information"""
+        mock_db.NoHeartbeatError = NoHeartbeatError
+        mock_db.get_connection.return_value = MockConnection()
+        mock_db.probe.return_value = (True, None, None, None)
+        node = Node('a', 1)
+        assert_raises(NoHeartbeatError, node.probe)
+        assert_true(node.is_slave)
+
+    def test_apply_probe_wal_positions(self):
+        """Ensure WAL positions are recorded, and reported with the lag"""
+        node = Node('a', 1)
+        node.apply_probe(True, 12, 'hello:99', 12345, (None, 300, 200))
+        assert_equals(200, node.wal_position)
+        assert_equals(300, node.wal_received)
+        node.replay_lag_bytes = 100
+        node.receive_lag_bytes = 0
+        info = node.to_dict()
+        assert_equals(200, info['wal_position'])
+        assert_equals(100, info['replay_lag_bytes'])
+        assert_equals(0, info['receive_lag_bytes'])
+        node.apply_probe(False, None, None, None, (400, None, None))
+        assert_equals(400, node.wal_position)
+        assert_equals(None, node.wal_received)
+
     @patch('plusmoin.lib.node.db')
     def test_to_dict(self, mock_db):
         """ Test to_dict """
@@ -89,3 +140,60 @@ class TestNode(object):
         node.cluster_id = 33
         node.update_heartbeat(12345)
         assert_equals(node.timestamp, 12345)
+
+    def test_apply_probe_replicas(self):
+        """Ensure replicas are only kept on masters"""
+        node = Node('a', 1)
+        node.apply_probe(False, None, None, None, None, [('b', 2)])
+        assert_equals([('b', 2)], node.replicas)
+        node.apply_probe(True, 1, 'c:1', 1000, None, [('b', 2)])
+        assert_equals(None, node.replicas)
+
+    @patch('plusmoin.lib.node.db')
+    def test_update_heartbeat_with_pool(self, mock_db):
+        """Ensure update heartbeat uses the given connection pool"""
+        pool = Mock()
+        pool.connection.return_value = MockConnection()
+        node = Node('a', 1)
+        node.update_heartbeat(12345, pool)
+        assert_equals(call('a', 1), pool.connection.call_args)
+        assert_false(mock_db.get_connection.called)
+        assert_equals(12345, node.timestamp)
+
+    @patch('plusmoin.lib.node.db')
+    def test_update_heartbeat_creates_table_once(self, mock_db):
+        """Ensure the heartbeat table is only created on the first heartbeat"""
+        mock_db.get_connection.return_value = MockConnection()
+        node = Node('a', 1)
+        node.update_heartbeat(12345)
+        node.update_heartbeat(12346)
+        assert_equals(1, mock_db.create_heartbeat_table.call_count)
+        assert_equals(2, mock_db.update_heartbeat_table.call_count)
+
+    @patch('plusmoin.lib.node.db')
+    def test_update_heartbeat_creates_table_after_error(self, mock_db):
+        """Ensure the heartbeat table is created again after an error"""
+        mock_db.DbError = DbError
+        mock_db.get_connection.return_value = MockConnection()
+        node = Node('a', 1)
+        node.update_heartbeat(12345)
+        mock_db.update_heartbeat_table.side_effect = DbError
+        assert_raises(DbError, node.update_heartbeat, 12346)
+        assert_equals(12345, node.timestamp)
+        mock_db.update_heartbeat_table.side_effect = None
+        node.update_heartbeat(12347)
+        assert_equals(2, mock_db.create_heartbeat_table.call_count)
+        assert_equals(12347, node.timestamp)
+
+    @patch('plusmoin.lib.node.db')
+    def test_write_heartbeat_leaves_node(self, mock_db):
+        """Ensure writing the heartbeat alone does not update the node"""
+        mock_db.get_connection.return_value = MockConnection()
+        node = Node('a', 1)
+        node.timestamp = 1000
+        node.write_heartbeat(12345)
+        node.write_heartbeat(12346)
+        assert_equals(1000, node.timestamp)
+        assert_equals(2, mock_db.create_heartbeat_table.call_count)
+        node.apply_heartbeat(12346)
+        assert_equals(12346, node.timestamp)
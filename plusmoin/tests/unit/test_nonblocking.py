@@ -0,0 +1,199 @@
+import errno
+import os
+import select
+
+import psycopg2
+import psycopg2.errorcodes
+from mock import patch
+from nose.tools import assert_equals, assert_true, assert_false
+
+from plusmoin.config import config
+from plusmoin.lib.db import DbError
+from plusmoin.lib.nonblocking import NonBlockingProber, POLL_OK, POLL_WRITE
+
+_poll = select.poll
+
+
+class MockAsyncConnection(object):
+    """Class used to mock an asynchronous psycopg2 connection.
+
+    Each operation needs one POLL_WRITE before it completes. The file
+    descriptor is the write end of a pipe, so it is always ready.
+    """
+    def __init__(self, results, errors=None, hang=False):
+        self.results = list(results)
+        self.errors = list(errors or [])
+        self.hang = hang
+        self.closed = 0
+        self.queries = []
+        self.server_version = 90605
+        self._waiting = True
+        (self._r, self._w) = os.pipe()
+
+    def fileno(self):
+        return self._w
+
+    def poll(self):
+        if self.hang:
+            return psycopg2.extensions.POLL_READ
+        if self._waiting:
+            self._waiting = False
+            return POLL_WRITE
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        return POLL_OK
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.queries.append(query)
+        self._waiting = True
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._r)
+            os.close(self._w)
+        self.closed = 1
+
+
+class InterruptedPoll(object):
+    """Class used to mock a poll object whose first poll is interrupted by
+    a signal"""
+    def __init__(self):
+        self._poller = _poll()
+        self.interrupted = False
+
+    def register(self, fd, eventmask):
+        self._poller.register(fd, eventmask)
+
+    def unregister(self, fd):
+        self._poller.unregister(fd)
+
+    def poll(self, timeout):
+        if not self.interrupted:
+            self.interrupted = True
+            raise select.error(errno.EINTR, 'Interrupted system call')
+        return self._poller.poll(timeout)
+
+
+class MockNode(object):
+    def __init__(self, host):
+        self.host = host
+        self.port = 1
+        self.name = '{}:1'.format(host)
+        self.timestamp = 10
+        self.values = None
+
+    def apply_probe(self, *values):
+        self.values = values
+        if values[0] and values[1] is None:
+            raise DbError()
+
+
+class UndefinedTable(psycopg2.ProgrammingError):
+    pgcode = psycopg2.errorcodes.UNDEFINED_TABLE
+
+
+class TestNonBlockingProber(object):
+    def setUp(self):
+        config['user'] = 'user'
+        config['password'] = 'password'
+        config['dbname'] = 'dbname'
+        config['connect_timeout'] = 10
+        config['probe_timeout'] = 0.2
+        config['is_slave_statement'] = 'crafty sql'
+        self._prober = NonBlockingProber()
+        self._connections = {}
+
+    def tearDown(self):
+        for connection in self._connections.values():
+            connection.close()
+
+    def _connect(self, **kwargs):
+        assert_equals(1, kwargs['async'])
+        return self._connections[kwargs['host']]
+
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_probe_nodes(self, mock_connect):
+        """Ensure all nodes are probed and updated"""
+        mock_connect.side_effect = self._connect
+        self._connections['a'] = MockAsyncConnection([(True, 1, 'b:1', 5)])
+        self._connections['b'] = MockAsyncConnection([(False, 1, 'b:1', 5)])
+        nodes = [MockNode('a'), MockNode('b')]
+        results = self._prober.probe_nodes(nodes)
+        assert_equals((True, 1, 'b:1', 5), nodes[0].values)
+        assert_equals((False, 1, 'b:1', 5), nodes[1].values)
+        assert_equals(None, results[nodes[0]].error)
+        assert_equals(None, results[nodes[1]].error)
+        assert_equals(10, results[nodes[0]].previous_timestamp)
+
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_connections_are_reused(self, mock_connect):
+        """Ensure connections are kept open between two probes"""
+        mock_connect.side_effect = self._connect
+        self._connections['a'] = MockAsyncConnection([(True, 1, 'b:1', 5),
+                                                      (True, 1, 'b:1', 6)])
+        node = MockNode('a')
+        self._prober.probe_nodes([node])
+        self._prober.probe_nodes([node])
+        assert_equals(1, mock_connect.call_count)
+        assert_equals((True, 1, 'b:1', 6), node.values)
+
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_missing_heartbeat_table(self, mock_connect):
+        """Ensure only the role is fetched when there is no heartbeat table"""
+        mock_connect.side_effect = self._connect
+        self._connections['a'] = MockAsyncConnection(
+            [(False,)], errors=[None, UndefinedTable()]
+        )
+        node = MockNode('a')
+        results = self._prober.probe_nodes([node])
+        assert_equals((False, None, None, None), node.values)
+        assert_equals(None, results[node].error)
+        assert_equals('crafty sql', self._connections['a'].queries[1])
+
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_errors(self, mock_connect):
+        """Ensure database errors are reported as DbError and the connection
+           is dropped"""
+        mock_connect.side_effect = self._connect
+        self._connections['a'] = MockAsyncConnection(
+            [], errors=[psycopg2.OperationalError()]
+        )
+        node = MockNode('a')
+        results = self._prober.probe_nodes([node])
+        assert_true(isinstance(results[node].error, DbError))
+        assert_true(self._connections['a'].closed)
+
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_timeout(self, mock_connect):
+        """Ensure a hung node fails once the timeout expires, without
+           affecting other nodes"""
+        mock_connect.side_effect = self._connect
+        self._connections['a'] = MockAsyncConnection([], hang=True)
+        self._connections['b'] = MockAsyncConnection([(True, 1, 'b:1', 5)])
+        nodes = [MockNode('a'), MockNode('b')]
+        results = self._prober.probe_nodes(nodes)
+        assert_true(isinstance(results[nodes[0]].error, DbError))
+        assert_equals(None, results[nodes[1]].error)
+        assert_false(self._connections['b'].closed)
+
+    @patch('plusmoin.lib.nonblocking.select.poll')
+    @patch('plusmoin.lib.nonblocking.psycopg2.connect')
+    def test_interrupted_poll(self, mock_connect, mock_poll):
+        """Ensure a poll interrupted by a signal is retried"""
+        mock_connect.side_effect = self._connect
+        poller = InterruptedPoll()
+        mock_poll.return_value = poller
+        self._connections['a'] = MockAsyncConnection([(True, 1, 'b:1', 5)])
+        node = MockNode('a')
+        results = self._prober.probe_nodes([node])
+        assert_true(poller.interrupted)
+        assert_equals(None, results[node].error)
+        assert_equals((True, 1, 'b:1', 5), node.values)
@@ -1,16 +1,38 @@
-from nose.tools import assert_equals, assert_items_equal
-from plusmoin.lib.db import DbError
-from plusmoin.pm import Plusmoin
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equals, assert_in, assert_items_equal
+from nose.tools import assert_false, assert_raises, assert_true
+from mock import Mock, call, patch
+from plusmoin.config import config, ConfigRequired
+from plusmoin.lib.db import DbError, NoHeartbeatError
+from plusmoin.lib import metrics
+from plusmoin.lib.scheduler import Scheduler
+from plusmoin.lib.snapshot import Snapshot
+from plusmoin.lib.status import ChangeTracker, StatusPublisher
+from plusmoin.lib.trigger import TriggerExecutor
+from plusmoin.pm import Plusmoin, cluster_events, record_metrics
+from plusmoin.pm import publish_status, reload_settings, submit_heartbeats
+from plusmoin.pm import submit_triggers
 
 
 class MockNode(object):
     def __init__(self, name, master_name, is_slave):
         self.name = name
+        (self.host, port) = name.split(':')
+        self.port = int(port)
         self.master_name = master_name
         self.is_slave = is_slave
         self.fail = False
+        self.no_heartbeat = False
         self.cluster_id = -1
         self.timestamp = 1000
+        self.wal_position = None
+        self.wal_received = None
+        self.replay_lag_bytes = None
+        self.replicas = None
 
     def refresh_role(self):
         if self.fail:
@@ -20,13 +42,32 @@ class MockNode(object):
         if self.fail:
             raise DbError()
 
-    def update_heartbeat(self, timestamp):
+    def probe(self):
         if self.fail:
             raise DbError()
+        if self.no_heartbeat:
+            raise NoHeartbeatError()
+
+    def fetch_probe(self):
+        self.probe()
+        return (self.is_slave, self.cluster_id, self.master_name,
+                self.timestamp)
+
+    def apply_probe(self, *values):
+        pass
+
+    def write_heartbeat(self, timestamp):
+        if self.fail:
+            raise DbError()
+
+    def apply_heartbeat(self, timestamp, error=None):
+        pass
 
     def to_dict(self, reset=False):
         return {
             'name': self.name,
+            'host': self.host,
+            'port': self.port,
             'master_name': self.master_name,
             'is_slave': self.is_slave,
             'cluster_id': self.cluster_id,
@@ -124,6 +165,46 @@ class TestPlusmoin(object):
             pm.clusterless
         )
 
+    def test_startup_heartbeat_failure(self):
+        """Ensure a master that fails to update its heartbeat at startup is
+           cluster-less"""
+        def fail(timestamp):
+            raise DbError()
+        self._m2.write_heartbeat = fail
+        pm = Plusmoin([self._m1, self._m2], 0, 0)
+        assert_equals(1, len(pm.clusters))
+        assert_equals([self._m2], pm.clusterless)
+
+    def test_master_heartbeats_written_together(self):
+        """Ensure the masters of all the clusters are written to at the same
+           time, so a slow master does not hold up the others"""
+        pm = Plusmoin([self._m1, self._m2], 0, 0, probe_timeout=1)
+        assert_equals(2, len(pm.clusters))
+        written = []
+
+        def slow(timestamp):
+            time.sleep(0.3)
+            written.append(timestamp)
+        self._m1.write_heartbeat = self._m2.write_heartbeat = slow
+        start = time.time()
+        pm.update_nodes()
+        assert_true(time.time() - start < 0.5)
+        assert_equals(2, len(written))
+        assert_equals([], pm.transitions)
+
+    def test_partition_slave_without_heartbeat(self):
+        """Ensure a slave without heartbeat information is partitioned as a
+           slave, not as lost"""
+        self._s1.no_heartbeat = True
+        self._s2.fail = True
+        pm = Plusmoin([], 0, 0)
+        (masters, slaves, lost) = pm._partition_nodes(
+            [self._m1, self._s1, self._s2]
+        )
+        assert_equals([self._m1], masters)
+        assert_equals([self._s1], slaves)
+        assert_equals([self._s2], lost)
+
     def test_update(self):
         """Test an update loop with no changes and the slave nodes all getting
            the updated cluster id"""
@@ -508,4 +589,427 @@ class TestPlusmoin(object):
         assert_items_equal(
             [self._s6],
             pm.clusterless
-        )
\ No newline at end of file
+        )
+
+    def test_startup_slave_promoted_while_syncing(self):
+        """Ensure a slave that becomes a master while waiting for the slaves to
+           sync at startup is sent to clusterless"""
+        probes = []
+
+        def probe():
+            # Slave when partitioned, master when assigned
+            probes.append(True)
+            self._s1.is_slave = len(probes) < 2
+        self._s1.probe = probe
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        assert_equals(len(pm.clusters), 2)
+        assert_items_equal(
+            [self._s1, self._s5, self._s6],
+            pm.clusterless
+        )
+
+    def test_update_concurrent_probes(self):
+        """Test that probing nodes concurrently gives the same results as
+           probing them serially"""
+        nodes = [self._m1, self._m2, self._s1, self._s2, self._s3,
+                 self._s4, self._s5, self._s6]
+        pm = Plusmoin(nodes, 0, 0, probe_concurrency=4)
+        if pm.clusters[0].master == self._m1:
+            l1 = [self._s1, self._s2]
+            l2 = [self._s3, self._s4]
+        else:
+            l1 = [self._s3, self._s4]
+            l2 = [self._s1, self._s2]
+        for node in l1:
+            node.cluster_id = 0
+        for node in l2:
+            node.cluster_id = 1
+        self._m1.fail = True
+        up = l1[0]
+        up.is_slave = False
+        t = pm.update_nodes()
+        assert_equals({
+            'master_down': [],
+            'master_up': [(up, pm.clusters[0])],
+            'slave_down': [],
+            'slave_up': []
+        }, t)
+        assert_items_equal([l1[1]], pm.clusters[0].slaves)
+        assert_items_equal([self._m1], pm.clusters[0].lost)
+        assert_items_equal(nodes, pm.nodes)
+
+    def test_unknown_engine(self):
+        """Ensure an unknown engine is rejected"""
+        assert_raises(ValueError, Plusmoin, [self._m1], 0, 0, 1, 'asyncio')
+
+    def test_cluster_events(self):
+        """Ensure cluster_events lists a cluster's transitions, in order"""
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        (c1, c2) = pm.clusters
+        triggers = {
+            'master_down': [],
+            'master_up': [(self._m2, c2)],
+            'slave_down': [(self._s1, c1), (self._s3, c2)],
+            'slave_up': [(self._s2, c1)]
+        }
+        assert_equals([
+            {'trigger': 'slave_down', 'node': self._s1.to_dict()},
+            {'trigger': 'slave_up', 'node': self._s2.to_dict()}
+        ], cluster_events(triggers, c1))
+        assert_equals([
+            {'trigger': 'master_up', 'node': self._m2.to_dict()},
+            {'trigger': 'slave_down', 'node': self._s3.to_dict()}
+        ], cluster_events(triggers, c2))
+
+    @patch.dict('plusmoin.lib.trigger._plugins',
+                {'cluster_events': [lambda name, data: None]})
+    @patch.dict(config, {'triggers': {}})
+    def test_submit_cluster_events_plugin(self):
+        """Ensure cluster_events is submitted when it only has a plugin"""
+        pm = Plusmoin([self._m1, self._s1], 0, 0)
+        cluster = pm.clusters[0]
+        triggers = {
+            'master_down': [],
+            'master_up': [],
+            'slave_down': [(self._s1, cluster)],
+            'slave_up': []
+        }
+        executor = Mock()
+        submit_triggers(executor, Snapshot(pm.clusters, pm.clusterless),
+                        pm.clusters, triggers)
+        assert_equals(['slave_down', 'cluster_events'],
+                      [c[0][1] for c in executor.submit.call_args_list])
+
+    def test_submit_heartbeats(self):
+        """Ensure plusmoin_heartbeat is only submitted when configured, and
+           with heartbeat_trigger_on_change, when the payload changed"""
+        pm = Plusmoin([self._m1, self._s1], 0, 0)
+        snapshot = Snapshot(pm.clusters, pm.clusterless)
+        executor = Mock()
+        changes = ChangeTracker()
+        with patch.dict(config, {'triggers': {},
+                                 'heartbeat_trigger_on_change': False}):
+            submit_heartbeats(executor, snapshot, pm.clusters, changes)
+            assert_false(executor.submit.called)
+            config['triggers'] = {'plusmoin_heartbeat': 'script'}
+            submit_heartbeats(executor, snapshot, pm.clusters, changes)
+            assert_equals(1, executor.submit.call_count)
+            config['heartbeat_trigger_on_change'] = True
+            submit_heartbeats(executor, snapshot, pm.clusters, changes)
+            submit_heartbeats(executor, snapshot, pm.clusters, changes)
+            assert_equals(2, executor.submit.call_count)
+
+    def test_transitions(self):
+        """Ensure the transitions of the startup and of each update are
+           listed in order"""
+        pm = Plusmoin([self._m1, self._s1], 0, 0)
+        cluster = pm.clusters[0]
+        assert_equals([
+            ('cluster_created', self._m1, cluster),
+            ('node_assigned', self._s1, cluster)
+        ], pm.transitions)
+        self._s1.cluster_id = 0
+        self._s1.is_slave = False
+        pm.update_nodes()
+        assert_equals([
+            ('node_out', self._s1, cluster),
+            ('cluster_created', self._s1, pm.clusters[1])
+        ], pm.transitions)
+        pm.update_nodes()
+        assert_equals([], pm.transitions)
+
+    def test_record_metrics(self):
+        """Ensure the cluster gauges reflect the clusters"""
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        self._s1.timestamp = 990
+        record_metrics(pm)
+        output = metrics.registry.render()
+        assert_in('plusmoin_clusters 2\n', output)
+        assert_in('plusmoin_clusterless 2\n', output)
+        cluster_id = [c.cluster_id for c in pm.clusters
+                      if c.master is self._m1][0]
+        assert_in('plusmoin_slaves{{cluster_id="{}"}} 2\n'.format(cluster_id),
+                  output)
+        assert_in(
+            'plusmoin_replication_lag_seconds{{cluster_id="{}",node="s:1"}} 10'
+            '\n'.format(cluster_id), output
+        )
+
+    def _state(self):
+        """Return a saved state with two clusters"""
+        return {
+            'version': 1,
+            'clusters': [
+                {'cluster_id': 0, 'master': 'a:1', 'timestamp': 1000,
+                 'slaves': ['s:1', 's:2'], 'lost': []},
+                {'cluster_id': 1, 'master': 'b:1', 'timestamp': 1000,
+                 'slaves': ['s:3'], 'lost': ['s:4']}
+            ],
+            'clusterless': ['s:5', 's:6']
+        }
+
+    @patch('plusmoin.pm.time.sleep')
+    def test_restore_state(self, mock_sleep):
+        """Ensure clusters are restored from a saved state without waiting
+           for the slaves to sync"""
+        for node in (self._s1, self._s2):
+            node.cluster_id = 0
+        for node in (self._s3, self._s4):
+            node.cluster_id = 1
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 10, 10,
+                      state=self._state())
+        assert_false(mock_sleep.called)
+        assert_equals([self._m1, self._m2], pm.masters)
+        assert_items_equal([self._s1, self._s2], pm.clusters[0].slaves)
+        assert_items_equal([self._s3, self._s4], pm.clusters[1].slaves)
+        assert_items_equal([self._s5, self._s6], pm.clusterless)
+        assert_equals([(self._s4, pm.clusters[1])],
+                      pm.startup_triggers['slave_up'])
+        assert_equals([], pm.startup_triggers['master_down'])
+
+    def test_restore_state_transitions(self):
+        """Ensure changes that happened while plusmoin was not running are
+           found when restoring a saved state"""
+        for node in (self._s1, self._s2):
+            node.cluster_id = 0
+        for node in (self._s3, self._s4):
+            node.cluster_id = 1
+        self._m2.fail = True
+        self._s2.timestamp = 900
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 10, 10,
+                      state=self._state())
+        assert_equals({
+            'master_down': [(self._m2, pm.clusters[1])],
+            'master_up': [],
+            'slave_down': [(self._s2, pm.clusters[0])],
+            'slave_up': [(self._s4, pm.clusters[1])]
+        }, pm.startup_triggers)
+        assert_equals([self._m1], pm.masters)
+
+    def test_restore_state_new_and_removed_nodes(self):
+        """Ensure nodes missing from the saved state start as cluster-less,
+           and saved nodes that are not configured are dropped"""
+        self._s1.cluster_id = 0
+        state = self._state()
+        state['clusters'][0]['slaves'].append('x:1')
+        pm = Plusmoin([self._m1, self._s1, self._s5], 10, 10, state=state)
+        assert_equals([self._m1], pm.masters)
+        assert_items_equal([self._s1], pm.clusters[0].slaves)
+        assert_items_equal([self._m1, self._s1, self._s5], pm.nodes)
+
+    @patch('plusmoin.pm.time.sleep')
+    def test_startup_waits_for_sync(self, mock_sleep):
+        """Ensure startup polls the slaves until they replicated their
+           master's heartbeat, rather than waiting max_sync_delay"""
+        probes = []
+
+        def probe():
+            # Catches up on the third probe
+            probes.append(True)
+            if len(probes) >= 3:
+                self._s1.timestamp = 1000
+        self._s1.timestamp = 900
+        self._s1.probe = probe
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4], 60, 60, sync_poll_interval=0.5)
+        assert_equals(3, len(probes))
+        assert_equals([call(0.5)], mock_sleep.call_args_list)
+        assert_in(self._s1, pm.clusters[0].slaves + pm.clusters[1].slaves)
+        assert_items_equal(['s:1', 's:2', 's:3', 's:4'], pm.sync_times.keys())
+        assert_true(pm.sync_times['s:1'] >= 0)
+
+    @patch('plusmoin.pm.time.sleep')
+    def test_startup_waits_for_stale_slaves(self, mock_sleep):
+        """Ensure startup also polls slaves that name a previous master, or
+           have no heartbeat information yet, until they name a new one"""
+        probes = {'s:1': 0, 's:2': 0}
+
+        def probe_s1():
+            # Names the new master once it replicated its first heartbeat
+            probes['s:1'] += 1
+            if probes['s:1'] >= 2:
+                self._s1.master_name = 'a:1'
+
+        def probe_s2():
+            probes['s:2'] += 1
+            if probes['s:2'] < 2:
+                raise NoHeartbeatError()
+            self._s2.master_name = 'a:1'
+        self._s1.master_name = 'x:1'
+        self._s1.probe = probe_s1
+        self._s2.master_name = None
+        self._s2.probe = probe_s2
+        pm = Plusmoin([self._m1, self._s1, self._s2], 60, 60)
+        assert_equals({'s:1': 2, 's:2': 2}, probes)
+        assert_items_equal([self._s1, self._s2], pm.clusters[0].slaves)
+        assert_true(pm.sync_times['s:1'] >= 0)
+        assert_true(pm.sync_times['s:2'] >= 0)
+
+    def test_startup_sync_timeout(self):
+        """Ensure slaves that did not replicate their master's heartbeat by
+           the end of max_sync_delay are lost"""
+        self._s1.timestamp = 900
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        assert_equals(None, pm.sync_times['s:1'])
+        assert_in(self._s1, pm.clusters[0].lost + pm.clusters[1].lost)
+
+    @patch('plusmoin.pm.db.pool')
+    def test_set_nodes(self, mock_pool):
+        """Ensure nodes are added and removed without changing the state of
+           the other nodes"""
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        (c1, c2) = pm.clusters
+        if c1.master is not self._m1:
+            (c1, c2) = (c2, c1)
+        (added, removed) = pm.set_nodes([
+            ('a', 1), ('s', 2), ('s', 3), ('s', 4), ('s', 5), ('s', 6),
+            ('n', 1)
+        ])
+        assert_equals(['n:1'], [node.name for node in added])
+        assert_items_equal([self._m2, self._s1], removed)
+        assert_equals(self._m1, c1.master)
+        assert_items_equal([self._s2], c1.slaves)
+        assert_equals(None, c2.master)
+        assert_items_equal([self._s3, self._s4], c2.slaves)
+        assert_items_equal([self._s5, self._s6, added[0]], pm.clusterless)
+        assert_items_equal([call('b', 1), call('s', 1)],
+                           mock_pool.close.call_args_list)
+        assert_items_equal([
+            ('node_removed', self._m2, c2),
+            ('node_removed', self._s1, c1),
+            ('node_added', added[0], None)
+        ], pm.transitions)
+
+    def test_set_thresholds(self):
+        """Ensure new sync thresholds apply to all clusters"""
+        pm = Plusmoin([self._m1, self._m2, self._s1, self._s2, self._s3,
+                       self._s4, self._s5, self._s6], 0, 0)
+        pm.set_thresholds(30, 20, 1000, 500)
+        for cluster in pm.clusters:
+            assert_equals((30, 20, 1000, 500), (
+                cluster.max_sync_delay, cluster.recover_sync_delay,
+                cluster.max_sync_bytes, cluster.recover_sync_bytes
+            ))
+
+    def test_publish_status_across_triggers(self):
+        """Ensure triggers running between two iterations do not make the
+           status change"""
+        pm = Plusmoin([self._m1, self._s1], 0, 0)
+        temp = tempfile.mkdtemp()
+        try:
+            publisher = StatusPublisher(os.path.join(temp, 'status.json'))
+            executor = TriggerExecutor(1, run=lambda name, data: True)
+            scheduler = Scheduler(60)
+            snapshot = Snapshot(pm.clusters, pm.clusterless)
+            assert_true(publish_status(publisher, snapshot, scheduler))
+            executor.submit(0, 'plusmoin_heartbeat',
+                            snapshot.payload(0).encoded)
+            assert_true(executor.join(5))
+            snapshot = Snapshot(pm.clusters, pm.clusterless)
+            assert_false(publish_status(publisher, snapshot, scheduler))
+        finally:
+            shutil.rmtree(temp)
+
+    @patch('plusmoin.pm.load_plugins')
+    @patch('plusmoin.pm.reload_config')
+    def test_reload_settings(self, mock_reload, mock_load_plugins):
+        """Ensure the reloaded configuration is applied to the running
+           service"""
+        pm = Plusmoin([self._m1, self._s1], 0, 0)
+        saved = dict(config)
+        config.update({
+            'nodes': [{'host': 'a', 'port': 1}, {'host': 's', 'port': 1}],
+            'max_sync_delay': 30, 'recover_sync_delay': 20,
+            'max_sync_bytes': None, 'recover_sync_bytes': None,
+            'probe_concurrency': 3, 'probe_timeout': 5,
+            'heartbeat': 60, 'heartbeat_overrun': 'skip',
+            'heartbeat_trigger_keepalive': 120,
+            'discovery': False, 'discovery_forget_after': None
+        })
+        try:
+            scheduler = Scheduler(60)
+            changes = ChangeTracker()
+            assert_true(scheduler is reload_settings(pm, scheduler, changes))
+            assert_equals(30, pm.clusters[0].max_sync_delay)
+            assert_equals(3, pm.probe_concurrency)
+            assert_equals(120, changes.keepalive)
+            config['heartbeat'] = 10
+            scheduler.missed = 4
+            new_scheduler = reload_settings(pm, scheduler, changes)
+            assert_equals(10, new_scheduler.interval)
+            assert_equals(4, new_scheduler.missed)
+            assert_equals(2, mock_load_plugins.call_count)
+            mock_reload.side_effect = ConfigRequired('user')
+            config['heartbeat'] = 5
+            pm.transitions = [('master_up', self._m1, pm.clusters[0])]
+            assert_true(new_scheduler is reload_settings(pm, new_scheduler,
+                                                         changes))
+            assert_equals([], pm.transitions)
+        finally:
+            config.clear()
+            config.update(saved)
+
+    @patch('plusmoin.pm.Node')
+    def test_discovery(self, mock_node):
+        """Ensure replicas listed by a master that are not managed yet are
+           added to the master's cluster"""
+        discovered = MockNode('n:1', 'a:1', True)
+        mock_node.return_value = discovered
+        pm = Plusmoin([self._m1, self._s1], 0, 0, discovery=True)
+        cluster = pm.clusters[0]
+        self._s1.cluster_id = discovered.cluster_id = cluster.cluster_id
+        self._m1.replicas = [('s', 1), ('n', 1)]
+        pm.update_nodes()
+        mock_node.assert_called_once_with('n', 1)
+        assert_items_equal([self._s1, discovered], cluster.slaves)
+        assert_in(('node_discovered', discovered, cluster), pm.transitions)
+        pm.update_nodes()
+        assert_equals(1, mock_node.call_count)
+
+    @patch('plusmoin.pm.db.pool')
+    @patch('plusmoin.pm.Node')
+    def test_discovery_forget(self, mock_node, mock_pool):
+        """Ensure discovered nodes no master lists are removed after
+           forget_after updates, and configured nodes are kept"""
+        discovered = MockNode('n:1', 'a:1', True)
+        mock_node.return_value = discovered
+        pm = Plusmoin([self._m1, self._s1], 0, 0, discovery=True,
+                      forget_after=2)
+        cluster = pm.clusters[0]
+        self._s1.cluster_id = discovered.cluster_id = cluster.cluster_id
+        self._m1.replicas = [('n', 1)]
+        pm.update_nodes()
+        self._m1.replicas = []
+        pm.update_nodes()
+        assert_in(discovered, pm.nodes)
+        pm.update_nodes()
+        assert_items_equal([self._m1, self._s1], pm.nodes)
+        assert_in(('node_removed', discovered, cluster), pm.transitions)
+
+    @patch('plusmoin.pm.db.pool')
+    @patch('plusmoin.pm.Node')
+    def test_discovery_failover(self, mock_node, mock_pool):
+        """Ensure a discovered replica promoted to master is not forgotten"""
+        discovered = MockNode('d:1', 'a:1', True)
+        mock_node.return_value = discovered
+        pm = Plusmoin([self._m1], 0, 0, discovery=True, forget_after=1)
+        cluster = pm.clusters[0]
+        discovered.cluster_id = cluster.cluster_id
+        self._m1.replicas = [('d', 1)]
+        pm.update_nodes()
+        assert_equals([discovered], cluster.slaves)
+        self._m1.fail = True
+        discovered.is_slave = False
+        discovered.master_name = None
+        discovered.replicas = []
+        for i in range(3):
+            pm.update_nodes()
+            assert_in(discovered, pm.nodes)
+            assert_true(cluster.master is discovered)
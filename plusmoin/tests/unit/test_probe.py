@@ -0,0 +1,175 @@
+import threading
+import time
+
+from nose.tools import assert_equals, assert_true, assert_items_equal
+from nose.tools import assert_false
+from plusmoin.lib.db import DbError, NoHeartbeatError
+from plusmoin.lib.probe import probe_node, probe_nodes, write_heartbeats
+
+
+class MockNode(object):
+    def __init__(self, fail=False, delay=0):
+        self.host = 'a'
+        self.port = 1
+        self.timestamp = 1000
+        self.fail = fail
+        self.delay = delay
+        self.probes = 0
+
+    def probe(self):
+        self.apply_probe(*self.fetch_probe())
+
+    def fetch_probe(self):
+        self.probes += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise DbError()
+        return (True, 1, 'a:1', self.timestamp + 1)
+
+    def apply_probe(self, is_slave, cluster_id, master_name, timestamp):
+        self.timestamp = timestamp
+
+    def apply_heartbeat(self, timestamp, error=None):
+        self.applied = (threading.current_thread(), timestamp, error)
+
+
+class TestProbe(object):
+    def test_probe_node(self):
+        """Ensure probe_node records the previous timestamp"""
+        node = MockNode()
+        result = probe_node(node)
+        assert_true(result.node is node)
+        assert_equals(1000, result.previous_timestamp)
+        assert_equals(1001, node.timestamp)
+        assert_equals(None, result.error)
+
+    def test_probe_node_error(self):
+        """Ensure probe_node captures database errors"""
+        node = MockNode(fail=True)
+        result = probe_node(node)
+        assert_true(isinstance(result.error, DbError))
+        assert_false(result.no_heartbeat)
+
+    def test_probe_nodes_no_heartbeat(self):
+        """Ensure slaves without heartbeat information are told apart from
+           nodes that could not be probed"""
+        nodes = [MockNode(), MockNode()]
+
+        def apply_probe(*values):
+            raise NoHeartbeatError()
+        nodes[1].apply_probe = apply_probe
+        results = probe_nodes(nodes, 2)
+        assert_false(results[nodes[0]].no_heartbeat)
+        assert_true(results[nodes[1]].no_heartbeat)
+
+    def test_probe_nodes_serial(self):
+        """Ensure all nodes are probed once with a concurrency of 1"""
+        nodes = [MockNode(), MockNode(fail=True), MockNode()]
+        results = probe_nodes(nodes, 1)
+        assert_items_equal(nodes, results.keys())
+        assert_equals([1, 1, 1], [n.probes for n in nodes])
+        assert_true(isinstance(results[nodes[1]].error, DbError))
+
+    def test_probe_nodes_concurrent(self):
+        """Ensure nodes are probed concurrently, each of them once"""
+        nodes = [MockNode(delay=0.2) for i in range(5)]
+        nodes[2].fail = True
+        start = time.time()
+        results = probe_nodes(nodes, 5)
+        assert_true(time.time() - start < 0.5)
+        assert_equals([1] * 5, [n.probes for n in nodes])
+        assert_equals(
+            [None, None, DbError, None, None],
+            [r.error and type(r.error) for r in
+             [results[n] for n in nodes]]
+        )
+
+    def test_probe_nodes_bounded(self):
+        """Ensure no more than the given number of nodes are probed at the
+           same time"""
+        lock = threading.Lock()
+        state = {'current': 0, 'max': 0}
+
+        class CountingNode(MockNode):
+            def fetch_probe(self):
+                with lock:
+                    state['current'] += 1
+                    state['max'] = max(state['max'], state['current'])
+                time.sleep(0.05)
+                with lock:
+                    state['current'] -= 1
+                return (True, 1, 'a:1', 0)
+        probe_nodes([CountingNode() for i in range(8)], 3)
+        assert_true(state['max'] <= 3)
+
+    def test_probe_nodes_timeout(self):
+        """Ensure a probe that takes too long fails without holding up the
+           other nodes, and is not applied once it finishes"""
+        nodes = [MockNode(), MockNode(delay=0.5), MockNode()]
+        start = time.time()
+        results = probe_nodes(nodes, 3, timeout=0.1)
+        assert_true(time.time() - start < 0.4)
+        assert_equals(None, results[nodes[0]].error)
+        assert_true(isinstance(results[nodes[1]].error, DbError))
+        assert_equals(None, results[nodes[2]].error)
+        time.sleep(0.5)
+        assert_equals(1000, nodes[1].timestamp)
+
+    def test_probe_nodes_timeout_waiting_for_worker(self):
+        """Ensure probes queued behind a hung probe still run"""
+        nodes = [MockNode(delay=0.5), MockNode(), MockNode()]
+        results = probe_nodes(nodes, 1, timeout=0.1)
+        assert_true(isinstance(results[nodes[0]].error, DbError))
+        assert_equals(None, results[nodes[1]].error)
+        assert_equals(None, results[nodes[2]].error)
+
+    def test_probe_nodes_timeout_abandoned(self):
+        """Ensure a node is not probed again while its abandoned probe is
+           still running"""
+        node = MockNode(delay=0.3)
+        results = probe_nodes([node], 1, timeout=0.05)
+        assert_true(isinstance(results[node].error, DbError))
+        results = probe_nodes([node], 1, timeout=0.05)
+        assert_true(isinstance(results[node].error, DbError))
+        assert_equals(1, node.probes)
+        time.sleep(0.4)
+        node.delay = 0
+        results = probe_nodes([node], 1, timeout=0.05)
+        assert_equals(None, results[node].error)
+        assert_equals(2, node.probes)
+
+    def test_write_heartbeats(self):
+        """Ensure a heartbeat write that hangs fails without holding up the
+           other nodes"""
+        written = []
+
+        class HeartbeatNode(MockNode):
+            def write_heartbeat(self, timestamp):
+                time.sleep(self.delay)
+                if self.fail:
+                    raise DbError()
+                written.append((self, timestamp))
+        nodes = [HeartbeatNode(), HeartbeatNode(delay=0.5),
+                 HeartbeatNode(fail=True)]
+        start = time.time()
+        errors = write_heartbeats(nodes, 1234, timeout=0.1)
+        assert_true(time.time() - start < 0.4)
+        assert_equals(None, errors[nodes[0]])
+        assert_true(isinstance(errors[nodes[1]], DbError))
+        assert_true(isinstance(errors[nodes[2]], DbError))
+        assert_equals([(nodes[0], 1234)], written)
+        for node in nodes:
+            assert_true(node.applied[0] is threading.current_thread())
+            assert_equals(1234, node.applied[1])
+        assert_equals(None, nodes[0].applied[2])
+        assert_true(isinstance(nodes[1].applied[2], DbError))
+
+    def test_unexpected_error(self):
+        """Ensure an exception other than DbError is reported as a DbError"""
+        class BrokenNode(MockNode):
+            def fetch_probe(self):
+                raise ValueError()
+        node = BrokenNode()
+        results = probe_nodes([node], 1, timeout=1)
+        assert_true(isinstance(results[node].error, DbError))
+        assert_equals(1000, node.timestamp)
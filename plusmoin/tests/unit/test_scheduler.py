@@ -0,0 +1,93 @@
+from nose.tools import assert_equals, assert_raises
+from plusmoin.lib.scheduler import Scheduler
+
+
+class MockClock(object):
+    """A clock that only moves when sleeping, or when told to"""
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+
+class TestScheduler(object):
+    def setUp(self):
+        self._clock = MockClock()
+
+    def _scheduler(self, overrun='skip'):
+        return Scheduler(10, overrun, clock=self._clock,
+                         sleep=self._clock.sleep)
+
+    def test_first_wait_is_one_interval(self):
+        """Ensure the first iteration starts one interval after creation"""
+        scheduler = self._scheduler()
+        scheduler.wait()
+        assert_equals(1010, self._clock.now)
+
+    def test_iteration_time_is_subtracted(self):
+        """Ensure the time spent in an iteration does not delay the next"""
+        scheduler = self._scheduler()
+        scheduler.wait()
+        self._clock.now += 3
+        scheduler.wait()
+        assert_equals(1020, self._clock.now)
+        assert_equals([10, 7], self._clock.sleeps)
+        assert_equals(0, scheduler.missed)
+
+    def test_overrun_skip(self):
+        """Ensure missed deadlines are skipped and counted with 'skip'"""
+        scheduler = self._scheduler('skip')
+        scheduler.wait()
+        self._clock.now += 25
+        scheduler.wait()
+        assert_equals(1040, self._clock.now)
+        assert_equals(2, scheduler.missed)
+        scheduler.wait()
+        assert_equals(1050, self._clock.now)
+
+    def test_overrun_run(self):
+        """Ensure a late iteration starts straight away with 'run'"""
+        scheduler = self._scheduler('run')
+        scheduler.wait()
+        self._clock.now += 25
+        scheduler.wait()
+        assert_equals(1035, self._clock.now)
+        assert_equals(2, scheduler.missed)
+        scheduler.wait()
+        assert_equals(1045, self._clock.now)
+
+    def test_clock_going_backwards(self):
+        """Ensure the cadence restarts if the clock goes backwards"""
+        scheduler = self._scheduler()
+        scheduler.wait()
+        self._clock.now -= 100
+        scheduler.wait()
+        assert_equals(920, self._clock.now)
+
+    def test_interrupted_sleep(self):
+        """Ensure a sleep cut short, eg. by a signal, is resumed until the
+           deadline"""
+        sleep = self._clock.sleep
+        self._clock.sleep = lambda duration: sleep(min(duration, 4))
+        scheduler = Scheduler(10, clock=self._clock, sleep=self._clock.sleep)
+        scheduler.wait()
+        assert_equals(1010, self._clock.now)
+        assert_equals([4, 4, 2], self._clock.sleeps)
+        scheduler.wait()
+        assert_equals(1020, self._clock.now)
+
+    def test_sleep_ending_wait(self):
+        """Ensure a sleep function returning True ends the wait"""
+        scheduler = Scheduler(10, clock=self._clock, sleep=lambda d: True)
+        scheduler.wait()
+        assert_equals(1000, self._clock.now)
+
+    def test_unknown_policy(self):
+        """Ensure unknown overrun policies are rejected"""
+        assert_raises(ValueError, Scheduler, 10, 'burst')
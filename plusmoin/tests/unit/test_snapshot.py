@@ -0,0 +1,83 @@
+import json
+
+from nose.tools import assert_equals, assert_true
+from plusmoin.lib.snapshot import Snapshot, encode
+
+
+class MockObject(object):
+    def __init__(self, data):
+        self.data = data
+        self.cluster_id = data.get('cluster_id')
+        self.resets = 0
+
+    def to_dict(self, reset=False):
+        if reset:
+            self.resets += 1
+        return dict(self.data)
+
+
+class TestSnapshot(object):
+    def setUp(self):
+        self._clusters = [
+            MockObject({'cluster_id': 1, 'master': {'host': 'a/b', 'port': 5432}}),
+            MockObject({'cluster_id': 2, 'master': None})
+        ]
+        self._clusterless = [MockObject({'host': 'c', 'port': 5432})]
+
+    def test_objects_are_refreshed_once(self):
+        """Ensure the snapshot refreshes each object's dict once"""
+        snapshot = Snapshot(self._clusters, self._clusterless)
+        snapshot.payload(1)
+        snapshot.payload(1, trigger=None)
+        snapshot.status()
+        for obj in self._clusters + self._clusterless:
+            assert_equals(1, obj.resets)
+
+    def test_payload(self):
+        """Ensure the payload's data and encoding match"""
+        snapshot = Snapshot(self._clusters, self._clusterless)
+        payload = snapshot.payload(1, trigger={'host': 'd'}, events=[])
+        expected = {
+            'cluster_id': 1,
+            'master': {'host': 'a/b', 'port': 5432},
+            'clusterless': [{'host': 'c', 'port': 5432}],
+            'trigger': {'host': 'd'},
+            'events': []
+        }
+        assert_equals(expected, payload.data)
+        assert_equals(expected, json.loads(payload.encoded))
+
+    def test_payload_is_stable(self):
+        """Ensure equal payloads are encoded identically"""
+        first = Snapshot(self._clusters, self._clusterless).payload(2)
+        second = Snapshot(self._clusters, self._clusterless).payload(2)
+        assert_equals(first.encoded, second.encoded)
+
+    def test_status(self):
+        """Ensure the status includes all clusters in order"""
+        snapshot = Snapshot(self._clusters, self._clusterless)
+        status = json.loads(snapshot.status(missed_heartbeats=3))
+        assert_equals({
+            'clusters': [
+                {'cluster_id': 1, 'master': {'host': 'a/b', 'port': 5432}},
+                {'cluster_id': 2, 'master': None}
+            ],
+            'clusterless': [{'host': 'c', 'port': 5432}],
+            'missed_heartbeats': 3
+        }, status)
+
+    def test_role(self):
+        """Ensure the role of each known node is reported"""
+        self._clusters[1].data['slaves'] = [{'host': 'd', 'port': 5432}]
+        self._clusters[1].data['lost'] = [{'host': 'e', 'port': 5432}]
+        snapshot = Snapshot(self._clusters, self._clusterless)
+        assert_equals('master', snapshot.role('a/b', 5432))
+        assert_equals('replica', snapshot.role('d', 5432))
+        assert_equals('lost', snapshot.role('e', 5432))
+        assert_equals('clusterless', snapshot.role('c', 5432))
+        assert_equals(None, snapshot.role('a/b', 5433))
+
+    def test_encode_sorts_keys(self):
+        """Ensure encoded keys are sorted"""
+        encoded = encode({'b': 1, 'a': 2})
+        assert_true(encoded.index('"a"') < encoded.index('"b"'))
@@ -0,0 +1,72 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_true, assert_false
+from mock import Mock
+from plusmoin.lib.state import StateFile
+
+
+def mock_node(name, timestamp=0):
+    node = Mock(timestamp=timestamp)
+    node.name = name
+    return node
+
+
+class TestStateFile(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'state.json')
+        cluster = Mock(cluster_id=0, has_master=True,
+                       master=mock_node('a:1', 1234.5),
+                       slaves=[mock_node('b:1')], lost=[mock_node('c:1')])
+        self._clusters = [cluster]
+        self._clusterless = [mock_node('d:1')]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_save_and_load(self):
+        """Ensure a saved state can be loaded back"""
+        state_file = StateFile(self._path)
+        assert_true(state_file.save(self._clusters, self._clusterless))
+        assert_equals({
+            'version': 1,
+            'clusters': [{
+                'cluster_id': 0,
+                'master': 'a:1',
+                'timestamp': 1234.5,
+                'slaves': ['b:1'],
+                'lost': ['c:1']
+            }],
+            'clusterless': ['d:1']
+        }, StateFile(self._path).load())
+
+    def test_save_only_changes(self):
+        """Ensure the state is only written when it changed"""
+        state_file = StateFile(self._path)
+        assert_true(state_file.save(self._clusters, self._clusterless))
+        assert_false(state_file.save(self._clusters, self._clusterless))
+        self._clusters[0].master.timestamp = 1235
+        assert_true(state_file.save(self._clusters, self._clusterless))
+
+    def test_save_cluster_without_master(self):
+        """Ensure clusters without a master are saved"""
+        self._clusters[0].has_master = False
+        StateFile(self._path).save(self._clusters, self._clusterless)
+        state = StateFile(self._path).load()
+        assert_equals(None, state['clusters'][0]['master'])
+
+    def test_load_missing_file(self):
+        """Ensure there is no state when the file does not exist"""
+        assert_equals(None, StateFile(self._path).load())
+
+    def test_load_invalid_state(self):
+        """Ensure invalid or unexpected states are ignored"""
+        for content in ('not json', '[]', '{"version": 2}',
+                        json.dumps({'version': 1, 'clusterless': [],
+                                    'clusters': [{'cluster_id': 1}]})):
+            with open(self._path, 'w') as f:
+                f.write(content)
+            assert_equals(None, StateFile(self._path).load())
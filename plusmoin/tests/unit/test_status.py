@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_true, assert_false
+from plusmoin.lib.status import ChangeTracker, StatusPublisher
+
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestChangeTracker(object):
+    def setUp(self):
+        self._clock = MockClock()
+
+    def test_first_content_is_a_change(self):
+        """Ensure content seen for the first time is reported as changed"""
+        tracker = ChangeTracker(clock=self._clock)
+        assert_true(tracker.changed(0, 'a'))
+
+    def test_identical_content(self):
+        """Ensure identical content is not reported as changed"""
+        tracker = ChangeTracker(clock=self._clock)
+        tracker.changed(0, 'a')
+        assert_false(tracker.changed(0, 'a'))
+        assert_true(tracker.changed(0, 'b'))
+        assert_false(tracker.changed(0, 'b'))
+
+    def test_keys_are_independent(self):
+        """Ensure content is tracked per key"""
+        tracker = ChangeTracker(clock=self._clock)
+        tracker.changed(0, 'a')
+        assert_true(tracker.changed(1, 'a'))
+        assert_false(tracker.changed(0, 'a'))
+
+    def test_keepalive(self):
+        """Ensure identical content is reported again once the keep-alive
+           interval expired"""
+        tracker = ChangeTracker(60, clock=self._clock)
+        tracker.changed(0, 'a')
+        self._clock.now += 30
+        assert_false(tracker.changed(0, 'a'))
+        self._clock.now += 30
+        assert_true(tracker.changed(0, 'a'))
+        self._clock.now += 30
+        assert_false(tracker.changed(0, 'a'))
+
+
+class TestStatusPublisher(object):
+    def setUp(self):
+        self._clock = MockClock()
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'status.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _read(self, path=None):
+        with open(path or self._path) as f:
+            return f.read()
+
+    def test_publish(self):
+        """Ensure the status is written with a version and generation time"""
+        publisher = StatusPublisher(self._path, clock=self._clock)
+        assert_true(publisher.publish('{"clusters": []}'))
+        assert_equals({
+            'version': 1,
+            'generated_at': 1000.0,
+            'clusters': []
+        }, json.loads(self._read()))
+        assert_equals(publisher.document, self._read())
+        assert_equals(['status.json'], os.listdir(self._dir))
+
+    def test_unchanged_status_is_not_published(self):
+        """Ensure an unchanged status is not written again"""
+        publisher = StatusPublisher(self._path, clock=self._clock)
+        publisher.publish('{"clusters": []}')
+        os.unlink(self._path)
+        assert_false(publisher.publish('{"clusters": []}'))
+        assert_false(os.path.exists(self._path))
+        assert_true(publisher.publish('{"clusters": [1]}'))
+        assert_equals(2, json.loads(self._read())['version'])
+
+    def test_version_carries_on(self):
+        """Ensure the version carries on from an existing status file"""
+        with open(self._path, 'w') as f:
+            f.write('{"version": 41}')
+        publisher = StatusPublisher(self._path, clock=self._clock)
+        publisher.publish('{"clusters": []}')
+        assert_equals(42, json.loads(self._read())['version'])
+
+    def test_invalid_existing_file(self):
+        """Ensure an invalid existing status file is ignored"""
+        with open(self._path, 'w') as f:
+            f.write('{"vers')
+        publisher = StatusPublisher(self._path, clock=self._clock)
+        publisher.publish('{"clusters": []}')
+        assert_equals(1, json.loads(self._read())['version'])
+
+    def test_etag_file(self):
+        """Ensure the ETag sidecar file changes with the status"""
+        publisher = StatusPublisher(self._path, True, clock=self._clock)
+        publisher.publish('{"clusters": []}')
+        etag = self._read(self._path + '.etag').strip()
+        assert_equals(publisher.etag, etag)
+        publisher.publish('{"clusters": [1]}')
+        assert_true(etag != self._read(self._path + '.etag').strip())
@@ -0,0 +1,199 @@
+import gzip
+import httplib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+from nose.tools import assert_equals, assert_true
+from plusmoin.lib.snapshot import Snapshot
+from plusmoin.lib.status import StatusPublisher
+from plusmoin.lib.status_server import AgentCheckServer, StatusServer
+
+
+class MockObject(object):
+    def __init__(self, data):
+        self.data = data
+        self.cluster_id = data.get('cluster_id')
+
+    def to_dict(self, reset=False):
+        return dict(self.data)
+
+
+def publish(publisher, master='a', padding=0):
+    """Publish a status with two clusters"""
+    snapshot = Snapshot(
+        [MockObject({'cluster_id': 1,
+                     'master': {'host': master, 'port': 5432},
+                     'slaves': [{'host': 'b', 'port': 5432}],
+                     'lost': []}),
+         MockObject({'cluster_id': 2,
+                     'master': None,
+                     'slaves': [],
+                     'lost': [{'host': 'x' * padding, 'port': 5432}]})],
+        [MockObject({'host': 'c', 'port': 5432})]
+    )
+    publisher.publish(snapshot.status(), snapshot)
+
+
+class TestStatusServer(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._publisher = StatusPublisher(
+            os.path.join(self._dir, 'status.json')
+        )
+        self._server = StatusServer(('127.0.0.1', 0), self._publisher, 5)
+        self._server.start()
+
+    def _publish(self, **kwargs):
+        publish(self._publisher, **kwargs)
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._dir)
+
+
+    def _get(self, path, headers=None):
+        connection = httplib.HTTPConnection(*self._server.server_address)
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return (response, body)
+
+    def test_not_available(self):
+        """Ensure 503 is returned until a status is published"""
+        (response, body) = self._get('/status')
+        assert_equals(503, response.status)
+
+    def test_status(self):
+        """Ensure the whole status is served with its ETag"""
+        self._publish()
+        (response, body) = self._get('/status')
+        assert_equals(200, response.status)
+        assert_equals(self._publisher.document, body)
+        assert_equals(self._publisher.etag, response.getheader('ETag'))
+        assert_equals(1, json.loads(body)['version'])
+
+    def test_cluster(self):
+        """Ensure single clusters and cluster-less nodes can be fetched"""
+        self._publish()
+        (response, body) = self._get('/clusters/1')
+        assert_equals(200, response.status)
+        assert_equals('a', json.loads(body)['master']['host'])
+        (response, body) = self._get('/clusterless')
+        assert_equals([{'host': 'c', 'port': 5432}], json.loads(body))
+        (response, body) = self._get('/clusters/3')
+        assert_equals(404, response.status)
+
+    def test_not_modified(self):
+        """Ensure a matching If-None-Match gets a 304 response"""
+        self._publish()
+        (response, body) = self._get('/clusters/1')
+        etag = response.getheader('ETag')
+        (response, body) = self._get('/clusters/1', {'If-None-Match': etag})
+        assert_equals(304, response.status)
+        assert_equals('', body)
+        # Cluster 1 is unchanged when cluster 2 changes
+        self._publish(padding=1)
+        (response, body) = self._get('/clusters/1', {'If-None-Match': etag})
+        assert_equals(304, response.status)
+        self._publish(master='b')
+        (response, body) = self._get('/clusters/1', {'If-None-Match': etag})
+        assert_equals(200, response.status)
+
+    def test_gzip(self):
+        """Ensure large bodies are compressed for clients that accept it"""
+        self._publish(padding=2000)
+        (response, body) = self._get('/status', {'Accept-Encoding': 'gzip'})
+        assert_equals('gzip', response.getheader('Content-Encoding'))
+        assert_equals(
+            self._publisher.document,
+            gzip.GzipFile(fileobj=StringIO(body)).read()
+        )
+        (response, body) = self._get('/status')
+        assert_equals(None, response.getheader('Content-Encoding'))
+
+    def test_node_checks(self):
+        """Ensure node checks answer 200 or 503 depending on the role"""
+        self._publish()
+        (response, body) = self._get('/node/a:5432/master')
+        assert_equals(200, response.status)
+        (response, body) = self._get('/node/a:5432/replica')
+        assert_equals(503, response.status)
+        (response, body) = self._get('/node/b:5432/replica')
+        assert_equals(200, response.status)
+        (response, body) = self._get('/node/c:5432/master')
+        assert_equals(503, response.status)
+        (response, body) = self._get('/node/d:5432/master')
+        assert_equals(404, response.status)
+        self._publish(master='d')
+        (response, body) = self._get('/node/a:5432/master')
+        assert_equals(404, response.status)
+        (response, body) = self._get('/node/d:5432/master')
+        assert_equals(200, response.status)
+
+    def test_metrics(self):
+        """Ensure metrics are served, even before the status is available"""
+        (response, body) = self._get('/metrics')
+        assert_equals(200, response.status)
+        assert_true('# TYPE plusmoin_iteration_seconds histogram' in body)
+
+    def test_long_poll(self):
+        """Ensure waiting requests return as soon as the resource changes"""
+        self._publish()
+        etag = self._publisher.etag
+        timer = threading.Timer(0.2, self._publish, kwargs={'master': 'b'})
+        timer.start()
+        start = time.time()
+        (response, body) = self._get('/status?wait=2',
+                                     {'If-None-Match': etag})
+        timer.join()
+        assert_equals(200, response.status)
+        assert_true(time.time() - start < 1)
+        assert_equals(2, json.loads(body)['version'])
+
+    def test_long_poll_timeout(self):
+        """Ensure waiting requests get a 304 once the wait expires"""
+        self._publish()
+        start = time.time()
+        (response, body) = self._get('/status?wait=0.3',
+                                     {'If-None-Match': self._publisher.etag})
+        assert_equals(304, response.status)
+        assert_true(time.time() - start >= 0.3)
+
+
+class TestAgentCheckServer(object):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._publisher = StatusPublisher(
+            os.path.join(self._dir, 'status.json')
+        )
+        self._server = AgentCheckServer(('127.0.0.1', 0), self._publisher)
+        self._server.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        shutil.rmtree(self._dir)
+
+    def _check(self, line):
+        connection = socket.create_connection(self._server.server_address)
+        connection.sendall(line)
+        answer = connection.makefile().readline()
+        connection.close()
+        return answer
+
+    def test_checks(self):
+        """Ensure agent checks answer up or down depending on the role"""
+        assert_equals("down\n", self._check("node/a:5432/master\n"))
+        publish(self._publisher)
+        assert_equals("up\n", self._check("node/a:5432/master\n"))
+        assert_equals("down\n", self._check("node/a:5432/replica\n"))
+        assert_equals("up\n", self._check("node/b:5432/replica\n"))
+        assert_equals("down\n", self._check("invalid\n"))
@@ -0,0 +1,352 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from mock import patch
+from nose.tools import assert_equals, assert_true, assert_false, assert_raises
+from nose.tools import assert_in
+from plusmoin.config import config
+from plusmoin.lib import metrics
+from plusmoin.lib.trigger import TriggerExecutor, TriggerWorker
+from plusmoin.lib.trigger import TriggerPluginError, load_plugins, trigger
+from plusmoin.lib.trigger import has_trigger
+from plusmoin.lib.trigger import _get_worker, _workers
+from plusmoin.lib.snapshot import Payload
+
+
+class MockRun(object):
+    """Records trigger invocations, optionally blocking on an event"""
+    def __init__(self, delay=0, result=True):
+        self.delay = delay
+        self.result = result
+        self.calls = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, name, data):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+            self.calls.append((name, data))
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class TestTriggerExecutor(object):
+    def test_runs_all_triggers(self):
+        """Ensure all submitted triggers are run"""
+        run = MockRun()
+        executor = TriggerExecutor(2, run)
+        executor.submit(0, 'master_down', 'a')
+        executor.submit(1, 'slave_up', 'b')
+        assert_true(executor.join(1))
+        assert_equals(
+            sorted([('master_down', 'a'), ('slave_up', 'b')]),
+            sorted(run.calls)
+        )
+
+    def test_order_within_key(self):
+        """Ensure triggers with the same key run in submission order, one at
+           a time"""
+        run = MockRun(delay=0.01)
+        executor = TriggerExecutor(4, run)
+        for i in range(10):
+            executor.submit(0, 'trigger', str(i))
+        assert_true(executor.join(2))
+        assert_equals([str(i) for i in range(10)], [c[1] for c in run.calls])
+        assert_equals(1, run.max_running)
+
+    def test_parallel_across_keys(self):
+        """Ensure triggers with different keys run in parallel"""
+        run = MockRun(delay=0.2)
+        executor = TriggerExecutor(3, run)
+        start = time.time()
+        for i in range(3):
+            executor.submit(i, 'trigger', str(i))
+        assert_true(executor.join(1))
+        assert_true(time.time() - start < 0.5)
+        assert_equals(3, run.max_running)
+
+    def test_concurrency_is_bounded(self):
+        """Ensure no more than the given number of triggers run at once"""
+        run = MockRun(delay=0.05)
+        executor = TriggerExecutor(2, run)
+        for i in range(6):
+            executor.submit(i, 'trigger', str(i))
+        assert_true(executor.join(2))
+        assert_equals(2, run.max_running)
+
+    def test_submit_does_not_wait(self):
+        """Ensure submitting a trigger does not wait for it to run"""
+        run = MockRun(delay=0.5)
+        executor = TriggerExecutor(1, run)
+        start = time.time()
+        executor.submit(0, 'trigger', 'a')
+        executor.submit(0, 'trigger', 'b')
+        assert_true(time.time() - start < 0.1)
+        assert_false(executor.join(0.1))
+        assert_equals(1, executor.stats()['queued'])
+        assert_equals(1, executor.stats()['running'])
+
+    def test_stats(self):
+        """Ensure completed and failed triggers are counted"""
+        executor = TriggerExecutor(1, MockRun(result=False))
+        executor.submit(0, 'trigger', 'a')
+        executor.submit(0, 'trigger', 'b')
+        assert_true(executor.join(1))
+        stats = executor.stats()
+        assert_equals(0, stats['queued'])
+        assert_equals(0, stats['running'])
+        assert_equals(2, stats['completed'])
+        assert_equals(2, stats['failed'])
+        assert_true(stats['max_queue_time'] <= stats['total_queue_time'])
+        output = metrics.registry.render()
+        assert_in('plusmoin_triggers{state="queued"} 0\n', output)
+        assert_in('plusmoin_triggers{state="running"} 0\n', output)
+        assert_in('plusmoin_trigger_failures_total{trigger="trigger"}', output)
+
+    def test_coalesce_heartbeats(self):
+        """Ensure a waiting heartbeat is replaced by a more recent one, while
+           transitions are kept in order"""
+        run = MockRun(delay=0.2)
+        executor = TriggerExecutor(1, run)
+        executor.submit(0, 'plusmoin_heartbeat', 'h1')
+        time.sleep(0.05)
+        executor.submit(0, 'plusmoin_heartbeat', 'h2')
+        executor.submit(0, 'slave_down', 'a')
+        executor.submit(0, 'plusmoin_heartbeat', 'h3')
+        executor.submit(0, 'plusmoin_heartbeat', 'h4')
+        executor.submit(1, 'plusmoin_heartbeat', 'h5')
+        assert_equals(3, executor.stats()['queued'])
+        assert_true(executor.join(2))
+        assert_equals([
+            ('plusmoin_heartbeat', 'h1'),
+            ('slave_down', 'a'),
+            ('plusmoin_heartbeat', 'h4')
+        ], [c for c in run.calls if c[1] != 'h5'])
+        assert_equals(2, executor.stats()['dropped'])
+        assert_in('plusmoin_triggers_dropped_total'
+                  '{trigger="plusmoin_heartbeat"}', metrics.registry.render())
+
+    def test_exception_does_not_stop_worker(self):
+        """Ensure a trigger raising an exception is counted as failed, and
+           does not stop the following triggers"""
+        run = MockRun(result=ValueError())
+        executor = TriggerExecutor(1, run)
+        executor.submit(0, 'trigger', 'a')
+        executor.submit(0, 'trigger', 'b')
+        assert_true(executor.join(1))
+        assert_equals(2, len(run.calls))
+        assert_equals(2, executor.stats()['failed'])
+
+
+class TestTriggerWorker(object):
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._worker = None
+
+    def tearDown(self):
+        if self._worker is not None:
+            self._worker.stop()
+        shutil.rmtree(self._root)
+
+    def _script(self, body):
+        """Create a worker script from the given loop body, which has access
+           to the decoded event as `event`, and return a worker running it"""
+        path = os.path.join(self._root, 'worker.py')
+        with open(path, 'w') as f:
+            f.write(WORKER_SCRIPT.format(
+                log=os.path.join(self._root, 'log'),
+                body=body
+            ))
+        self._worker = TriggerWorker(
+            'name', '{} {}'.format(sys.executable, path), 1
+        )
+        return self._worker
+
+    def _log(self):
+        with open(os.path.join(self._root, 'log')) as f:
+            return f.read().splitlines()
+
+    def test_events_are_acked(self):
+        """Ensure events are streamed to a single process, and acks are
+           reported"""
+        worker = self._script('reply({"ok": True})')
+        assert_true(worker.send(json.dumps({'n': 1})))
+        assert_true(worker.send(json.dumps({'n': 2})))
+        assert_equals(1, worker.restarts)
+        assert_equals(['{"n": 1}', '{"n": 2}'], self._log())
+
+    def test_errors_are_reported(self):
+        """Ensure errors sent by the script are reported as failures"""
+        worker = self._script(
+            'reply({"ok": event["n"] != 2, "error": "boom"})'
+        )
+        assert_true(worker.send(json.dumps({'n': 1})))
+        assert_false(worker.send(json.dumps({'n': 2})))
+        assert_true(worker.send(json.dumps({'n': 3})))
+        assert_equals(1, worker.restarts)
+
+    def test_restart_after_exit(self):
+        """Ensure the script is restarted if it exits"""
+        worker = self._script('sys.exit(0)')
+        assert_false(worker.send(json.dumps({'n': 1})))
+        assert_false(worker.send(json.dumps({'n': 2})))
+        assert_equals(2, worker.restarts)
+
+    def test_timeout(self):
+        """Ensure a script that does not answer in time is restarted"""
+        worker = self._script(
+            'time.sleep(5) if event["n"] == 1 else None\n'
+            '    reply({"ok": True})'
+        )
+        start = time.time()
+        assert_false(worker.send(json.dumps({'n': 1})))
+        assert_true(time.time() - start < 2)
+        assert_true(worker.send(json.dumps({'n': 2})))
+        assert_equals(2, worker.restarts)
+
+    def test_invalid_answer(self):
+        """Ensure invalid answers are reported as failures"""
+        worker = self._script('sys.stdout.write("hello\\n")')
+        assert_false(worker.send(json.dumps({'n': 1})))
+
+    def test_worker_replaced_when_command_changes(self):
+        """Ensure a worker is replaced when its command is changed in the
+           configuration"""
+        triggers = config.get('triggers')
+        timeout = config.get('trigger_timeout')
+        config['trigger_timeout'] = 1
+        config['triggers'] = {'reloaded': 'first'}
+        try:
+            worker = _get_worker('reloaded')
+            assert_true(worker is _get_worker('reloaded'))
+            config['triggers'] = {'reloaded': 'second'}
+            assert_equals('second', _get_worker('reloaded').command)
+        finally:
+            _workers.pop('reloaded', None)
+            config['triggers'] = triggers
+            config['trigger_timeout'] = timeout
+
+
+WORKER_SCRIPT = """
+import json
+import sys
+import time
+
+
+def reply(answer):
+    sys.stdout.write(json.dumps(answer) + "\\n")
+    sys.stdout.flush()
+
+
+for line in iter(sys.stdin.readline, ''):
+    with open({log!r}, 'a') as f:
+        f.write(line)
+    event = json.loads(line)
+    {body}
+"""
+
+
+received = []
+
+
+def record_plugin(name, data):
+    """Trigger plugin used by the tests"""
+    received.append((name, data))
+
+
+def failing_plugin(name, data):
+    """Trigger plugin used by the tests"""
+    raise ValueError()
+
+
+def slow_plugin(name, data):
+    """Trigger plugin used by the tests"""
+    time.sleep(0.5)
+
+
+class TestTriggerPlugins(object):
+    def setUp(self):
+        del received[:]
+        config['triggers'] = {}
+        config['trigger_timeout'] = 0.2
+        config['trigger_plugins'] = {}
+
+    def tearDown(self):
+        config['trigger_plugins'] = {}
+        load_plugins()
+
+    def _load(self, plugins):
+        config['trigger_plugins'] = plugins
+        with patch('plusmoin.lib.trigger.pkg_resources', None):
+            load_plugins()
+
+    def test_plugin_receives_dict(self):
+        """Ensure plugins are called in process with the trigger's dict"""
+        self._load({'slave_up': __name__ + ':record_plugin'})
+        data = {'cluster_id': 1}
+        assert_true(trigger('slave_up', data))
+        assert_equals([('slave_up', data)], received)
+        assert_true(received[0][1] is data)
+
+    def test_payload(self):
+        """Ensure plugins receive a payload's dict, and scripts its existing
+           encoding"""
+        self._load({'slave_up': __name__ + ':record_plugin'})
+        config['triggers'] = {'slave_up': 'script'}
+        payload = Payload({'cluster_id': 1}, '{"cluster_id": 1}')
+        with patch('plusmoin.lib.trigger._run_script') as run_script:
+            run_script.return_value = True
+            assert_true(trigger('slave_up', payload))
+        assert_true(received[0][1] is payload.data)
+        run_script.assert_called_once_with('slave_up', payload.encoded)
+
+    def test_plugins_only_run_for_their_trigger(self):
+        """Ensure plugins only run for the trigger they are configured for"""
+        self._load({'slave_up': __name__ + ':record_plugin'})
+        assert_true(trigger('slave_down', {}))
+        assert_equals([], received)
+
+    def test_has_trigger(self):
+        """Ensure triggers with a plugin or a script are reported as
+           configured"""
+        self._load({'slave_up': __name__ + ':record_plugin'})
+        config['triggers'] = {'slave_down': 'script', 'master_up': None}
+        assert_true(has_trigger('slave_up'))
+        assert_true(has_trigger('slave_down'))
+        assert_false(has_trigger('master_up'))
+        assert_false(has_trigger('master_down'))
+
+    def test_plugin_failure(self):
+        """Ensure a plugin raising an exception is reported as failed"""
+        self._load({'slave_up': [__name__ + ':failing_plugin',
+                                 __name__ + ':record_plugin']})
+        assert_false(trigger('slave_up', {}))
+        assert_equals(1, len(received))
+
+    def test_plugin_timeout(self):
+        """Ensure a slow plugin is reported as failed once the timeout
+           expires"""
+        self._load({'slave_up': __name__ + ':slow_plugin'})
+        start = time.time()
+        assert_false(trigger('slave_up', {}))
+        assert_true(time.time() - start < 0.4)
+
+    def test_invalid_spec(self):
+        """Ensure invalid plugin specs are reported"""
+        assert_raises(TriggerPluginError, self._load,
+                      {'slave_up': 'no_function'})
+        assert_raises(TriggerPluginError, self._load,
+                      {'slave_up': 'no.such.module:function'})
+        assert_raises(TriggerPluginError, self._load,
+                      {'slave_up': __name__ + ':no_such_function'})